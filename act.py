@@ -19,7 +19,12 @@ from __future__ import absolute_import
 from __future__ import division
 from __future__ import print_function
 
+import contextlib
+
 import tensorflow as tf
+from tensorflow.contrib.compiler import jit
+
+import sparse_utils
 
 
 def adaptive_computation_time(halting_proba, eps=1e-2):
@@ -41,8 +46,9 @@ def adaptive_computation_time(halting_proba, eps=1e-2):
       of halting the computation at a given unit for the object.
       Shape is `[batch, max_units - 1]`.
       The values need to be in the range [0, 1].
-    eps: A `float` in the range [0, 1]. Small number to ensure that
-      the computation can halt after the first unit.
+    eps: A `float` in the range [0, 1] or a scalar `float32` `Tensor`.
+      Small number to ensure that the computation can halt after the first
+      unit.
 
   Returns:
     ponder_cost: An 1-D `Tensor` of type `float32`.
@@ -119,47 +125,267 @@ def run_units(inputs, unit, max_units, scope, reuse=False):
   return states, halting_probas, all_flops
 
 
+@contextlib.contextmanager
+def _jit_scope(enabled):
+  """Marks the ops for XLA compilation if `enabled`."""
+  if enabled:
+    with jit.experimental_jit_scope():
+      yield
+  else:
+    yield
+
+
+def _halting_step(halting_proba, eps, halting_cumsum, elements_finished,
+                  remainder, ponder_cost, num_units):
+  """Updates the halting state after a unit.
+
+  All the arguments, apart from `eps`, have the same shape: `[batch]` for ACT
+  and `[batch, height, width]` for SACT.
+
+  Returns:
+    The updated `halting_cumsum`, `elements_finished`, `remainder`,
+    `ponder_cost` and `num_units`, and the halting distribution of the unit.
+  """
+  # The halting computations are performed in float32 even if the units run
+  # in a reduced precision.
+  halting_proba = tf.to_float(halting_proba)
+  zeros = tf.zeros_like(halting_cumsum)
+
+  halting_cumsum += halting_proba
+  # Which objects are no longer calculated after this unit?
+  cur_elements_finished = (halting_cumsum >= 1 - eps)
+  # Zero out halting_proba for the previously finished objects.
+  halting_proba = tf.where(cur_elements_finished, zeros, halting_proba)
+  # Find objects which have halted at the current unit.
+  just_finished = tf.logical_and(tf.logical_not(elements_finished),
+                                 cur_elements_finished)
+  # For such objects, the halting distribution value is the remainder.
+  # For others, it is the halting_proba.
+  cur_halting_distrib = tf.where(just_finished, remainder, halting_proba)
+
+  # Update ponder_cost. Add 1 to objects which are still computed,
+  # remainder to the objects which have just halted and
+  # 0 to the previously halted objects.
+  ponder_cost += tf.where(
+      cur_elements_finished,
+      tf.where(just_finished, remainder, zeros),
+      tf.ones_like(halting_cumsum))
+
+  # Add a unit to the objects that were active during this unit
+  # (not the ones that will be active the next unit).
+  num_units += tf.to_int32(tf.logical_not(elements_finished))
+
+  remainder -= halting_proba
+
+  return (halting_cumsum, cur_elements_finished, remainder, ponder_cost,
+          num_units, cur_halting_distrib)
+
+
+def _run_unit_compact(unit, unit_idx, state, elements_finished):
+  """Runs a unit only for the objects which have not halted yet."""
+  # Split the batch into the objects that are still computed and the
+  # halted ones. Only the former are passed to the unit.
+  partitions = tf.to_int32(elements_finished)
+  indices = tf.dynamic_partition(tf.range(tf.shape(state)[0]), partitions, 2)
+  states = tf.dynamic_partition(state, partitions, 2)
+  num_halted = tf.shape(indices[1])[0]
+
+  (new_state, halting_proba, cur_flops) = unit(states[0], unit_idx)
+
+  # Scatter the results back, halted objects keep their state.
+  new_state = tf.dynamic_stitch(indices, [new_state, states[1]])
+  new_state.set_shape(state.get_shape())
+  if halting_proba is not None:
+    halting_proba = tf.dynamic_stitch(
+        indices,
+        [tf.to_float(tf.reshape(halting_proba, [-1])), tf.zeros([num_halted])])
+  cur_flops = tf.dynamic_stitch(
+      indices, [cur_flops, tf.zeros([num_halted], dtype=tf.int64)])
+  return new_state, halting_proba, cur_flops
+
+
+def _run_unit_unless_finished(unit, unit_idx, state, residual_mask,
+                              elements_finished, sh):
+  """Runs a SACT unit unless all the positions of the batch have halted.
+
+  If the unit is skipped, the state is kept and the halting probabilities are
+  zero. The FLOPs are the same as without early stopping: they are taken from
+  the call of the unit outside of `tf.cond`, which only depend on
+  `residual_mask` and the static shapes, so the skipped units still count the
+  FLOPs which do not depend on the active positions, e.g. the ones of the
+  global halting heads.
+
+  Args:
+    unit: See `spatially_adaptive_computation_time`.
+    unit_idx: Index of the unit.
+    state: The input state of the unit.
+    residual_mask: The mask of the positions to update.
+    elements_finished: A 3-D `bool` `Tensor` with the halted positions, or
+      tiles.
+    sh: The shape of the state, a list.
+
+  Returns:
+    The new state, the halting probabilities of shape [batch, height, width]
+    and the FLOPs.
+  """
+  # Create the variables and the losses outside of tf.cond.
+  (_, _, flops) = unit(state, unit_idx, residual_mask=residual_mask)
+
+  def _unit():
+    (new_state, halting_proba, _) = unit(
+        state, unit_idx, residual_mask=residual_mask)
+    if halting_proba is None:
+      halting_proba = tf.ones(sh[:3])
+    halting_proba = tf.reshape(tf.to_float(halting_proba), sh[:3])
+    return new_state, halting_proba
+
+  def _identity():
+    return state, tf.zeros(sh[:3])
+
+  with tf.variable_scope(tf.get_variable_scope(), reuse=True):
+    (new_state, halting_proba) = tf.cond(tf.reduce_all(elements_finished),
+                                         _identity, _unit)
+  return new_state, halting_proba, tf.to_int64(flops)
+
+
+def _outside_control_flow_getter(getter, *args, **kwargs):
+  """Custom getter which creates the variables outside of control flow.
+
+  The initializers and the regularization losses of the variables created
+  inside `tf.cond` or `tf.while_loop` could not be used outside of it.
+  """
+  with tf.control_dependencies(None):
+    return getter(*args, **kwargs)
+
+
+def _unit_variables_getter(scope_name, unit_scope, unit_indices, index):
+  """Returns a custom getter which selects the variables of a unit.
+
+  The getter expects the variables of a template unit
+  `unit_indices[0]`. For each such variable, it gets the corresponding
+  variables of all the units `unit_indices` and returns the one selected by
+  `index`. The variables are written to a `tf.TensorArray`, which references
+  their values without copying them, unlike `tf.stack`.
+
+  Args:
+    scope_name: Name of the variable scope of the ACT module.
+    unit_scope: Name pattern of the variable scopes of the units.
+    unit_indices: A list of zero-based indices of the units.
+    index: A scalar `int32` `Tensor`, position of the selected unit in
+      `unit_indices`.
+
+  Returns:
+    A custom getter.
+  """
+  def _unit_prefix(unit_idx):
+    return '{}/{}/'.format(scope_name, unit_scope % (unit_idx + 1))
+
+  template_prefix = _unit_prefix(unit_indices[0])
+
+  def _getter(getter, name, *args, **kwargs):
+    if not name.startswith(template_prefix):
+      return _outside_control_flow_getter(getter, name, *args, **kwargs)
+    suffix = name[len(template_prefix):]
+    with tf.control_dependencies(None):
+      variables = [
+          getter(_unit_prefix(unit_idx) + suffix, *args, **kwargs)
+          for unit_idx in unit_indices
+      ]
+      array = tf.TensorArray(
+          variables[0].dtype.base_dtype, size=len(variables),
+          element_shape=variables[0].get_shape(), clear_after_read=False)
+      for (i, variable) in enumerate(variables):
+        array = array.write(i, variable)
+    return array.read(index)
+
+  return _getter
+
+
 def adaptive_computation_time_wrapper(inputs, unit, max_units,
-                                      eps=1e-2, scope='act'):
+                                      eps=1e-2, scope='act',
+                                      jit_halting=False,
+                                      return_halting_distribution=True):
   """A wrapper of `adaptive_computation_time`.
 
   Wraps `adaptive_computation_time` with an interface compatible with
   `adaptive_computation_early_stopping`. Should do the same thing as
   `adaptive_computation_early_stopping` but should work in cases when tf.cond
   fails.
+
+  The halting distribution is computed incrementally and the outputs are
+  accumulated unit by unit, so the states of all units are never stacked.
+  The values and the gradients are the same as the ones of
+  `adaptive_computation_time`.
+
+  If `jit_halting` is set, the halting computations of every unit are
+  compiled with XLA, see `adaptive_computation_early_stopping`. If
+  `return_halting_distribution` is False, the returned halting distribution
+  is None.
   """
-  states, halting_probas, all_flops = run_units(inputs, unit,
-                                                max_units, scope)
+  with tf.variable_scope(scope):
+    state = inputs
+    halting_distribs = []
+    for unit_idx in range(max_units):
+      (new_state, halting_proba, cur_flops) = unit(state, unit_idx)
+
+      if not unit_idx:
+        if new_state.get_shape().is_fully_defined():
+          sh = new_state.get_shape().as_list()
+        else:
+          sh = tf.shape(new_state)
+        batch = sh[0]
+        inputs_rank = new_state.get_shape().ndims
+        halting_cumsum = tf.zeros([batch])
+        elements_finished = tf.fill([batch], False)
+        remainder = tf.ones([batch])
+        # Initialize ponder_cost with one to fix an off-by-one error.
+        ponder_cost = tf.ones([batch])
+        num_units = tf.zeros([batch], dtype=tf.int32)
+        flops = tf.zeros([batch], dtype=tf.int64)
+        outputs = tf.zeros_like(new_state)
 
-  (ponder_cost, num_units, halting_distribution) = \
-      adaptive_computation_time(tf.concat(halting_probas[:-1], 1), eps=eps)
+      # We always halt at the last unit.
+      if unit_idx < max_units - 1:
+        halting_proba = tf.reshape(halting_proba, [batch])
+      else:
+        halting_proba = tf.ones([batch])
 
-  if states[0].get_shape().is_fully_defined():
-    sh = states[0].get_shape().as_list()
-  else:
-    sh = tf.shape(states[0])
-  batch = sh[0]
-  h = tf.reshape(halting_distribution, [batch, 1, max_units])
-  s = tf.reshape(tf.stack(states, axis=1), [batch, max_units, -1])
-  outputs = tf.matmul(h, s)
-  outputs = tf.reshape(outputs, sh)
+      with _jit_scope(jit_halting):
+        # Count the FLOPS of the units which would be executed with early
+        # stopping.
+        flops += cur_flops * tf.to_int64(tf.logical_not(elements_finished))
+
+        (halting_cumsum, elements_finished, remainder, ponder_cost,
+         num_units, cur_halting_distrib) = _halting_step(
+             halting_proba, eps, halting_cumsum, elements_finished, remainder,
+             ponder_cost, num_units)
 
-  flops_per_iteration = [
-      f * tf.to_int64(num_units > i) for (i, f) in enumerate(all_flops)
-  ]
-  flops = tf.add_n(flops_per_iteration)
+        # Add new state to the outputs weighted by the halting distribution.
+        outputs += new_state * tf.cast(
+            tf.reshape(cur_halting_distrib, [-1] + [1] * (inputs_rank - 1)),
+            new_state.dtype)
+
+      halting_distribs.append(tf.reshape(cur_halting_distrib, [batch, 1]))
+      state = new_state
+
+  halting_distribution = None
+  if return_halting_distribution:
+    halting_distribution = tf.concat(halting_distribs, 1)
 
   return (ponder_cost, num_units, flops, halting_distribution, outputs)
 
 
 def adaptive_computation_early_stopping(inputs, unit, max_units,
-                                        eps=1e-2, scope='act'):
+                                        eps=1e-2, scope='act',
+                                        compact_batch=False,
+                                        jit_halting=False,
+                                        return_halting_distribution=True):
   """Builds adaptive computation module with early stopping of computation.
 
   `adaptive_computation_time` requires all units to be always
   computed. This function stops the computation as soon as all objects in the
   batch halt. However, if any object still needs calculation, the
-  unit is executed for all objects.
+  unit is executed for all objects, unless `compact_batch` is set.
 
   See `adaptive_computation_time` description for more information.
 
@@ -181,10 +407,27 @@ def adaptive_computation_early_stopping(inputs, unit, max_units,
       Good: `w = tf.get_variable('weights', [5, 3])`
       Bad: `w = tf.Variable(tf.zeros([5, 3]))  # The name is auto-generated`
     max_units: Maximum number of units.
-    eps: A `float` in the range [0, 1]. Small number to ensure that
-      the computation can halt after the first unit.
+    eps: A `float` in the range [0, 1] or a scalar `float32` `Tensor`.
+      Small number to ensure that the computation can halt after the first
+      unit.
     scope: variable scope or scope name in which the layers are created.
       Defaults to 'act'.
+    compact_batch: If True, starting from the second unit, the unit is called
+      only for the objects which have not halted yet, so `old_state` and the
+      returned values have a smaller (dynamic) batch dimension. The states of
+      the halted objects are copied. Then the cost of a unit is proportional
+      to the number of objects that are still computed. Note that
+      batch normalization in training mode computes the statistics over
+      these objects only.
+    jit_halting: If True, the halting computations of every unit (the
+      update of the halting probabilities, the ponder cost, the number of
+      units, the FLOPs and the outputs) are compiled with XLA into fused
+      kernels. This removes the overhead of running many small element-wise
+      ops. Requires TensorFlow built with XLA support.
+    return_halting_distribution: If False, the halting distribution is not
+      assembled and None is returned instead. Saves the memory and the
+      concatenation of the distribution when only the ponder cost, the
+      number of units and the FLOPs are needed.
 
   Returns:
     ponder_cost: A 1-D `Tensor` of type `float32`.
@@ -211,7 +454,11 @@ def adaptive_computation_early_stopping(inputs, unit, max_units,
   def _body(unit_idx, state, halting_cumsum, elements_finished, remainder,
             ponder_cost, num_units, flops, outputs):
 
-    (new_state, halting_proba, cur_flops) = unit(state, unit_idx)
+    if compact_batch and unit_idx:
+      (new_state, halting_proba, cur_flops) = _run_unit_compact(
+          unit, unit_idx, state, elements_finished)
+    else:
+      (new_state, halting_proba, cur_flops) = unit(state, unit_idx)
 
     # We always halt at the last unit.
     if unit_idx < max_units - 1:
@@ -219,42 +466,21 @@ def adaptive_computation_early_stopping(inputs, unit, max_units,
     else:
       halting_proba = tf.ones([batch])
 
-    halting_cumsum += halting_proba
-    cur_elements_finished = (halting_cumsum >= 1 - eps)
-    # Zero out halting_proba for the previously finished objects.
-    halting_proba = tf.where(cur_elements_finished,
-                             tf.zeros([batch]),
-                             halting_proba)
-    # Find objects which have halted at the current unit.
-    just_finished = tf.logical_and(tf.logical_not(elements_finished),
-                                   cur_elements_finished)
-    # For such objects, the halting distribution value is the remainder.
-    # For others, it is the halting_proba.
-    cur_halting_distrib = tf.where(just_finished,
-                                   remainder,
-                                   halting_proba)
-
-    # Update ponder_cost. Add 1 to objects which are still computed,
-    # remainder to the objects which have just halted and
-    # 0 to the previously halted objects.
-    ponder_cost += tf.where(
-        cur_elements_finished,
-        tf.where(just_finished, remainder, tf.zeros([batch])),
-        tf.ones([batch]))
-
-    # Add a unit to the objects that were active during this unit
-    # (not the ones that will be active the next unit).
-    evaluated_objects = tf.logical_not(elements_finished)
-    num_units += tf.to_int32(evaluated_objects)
-
-    # Update the FLOPS counters for the same objects.
-    flops += cur_flops * tf.to_int64(evaluated_objects)
+    with _jit_scope(jit_halting):
+      (halting_cumsum, cur_elements_finished, remainder, ponder_cost,
+       num_units, cur_halting_distrib) = _halting_step(
+           halting_proba, eps, halting_cumsum, elements_finished, remainder,
+           ponder_cost, num_units)
 
-    # Add new state to the outputs weighted by the halting distribution.
-    outputs += new_state * tf.reshape(cur_halting_distrib,
-                                      [-1] + [1] * (inputs_rank - 1))
+      # Update the FLOPS counters for the objects that were active during
+      # this unit.
+      evaluated_objects = tf.logical_not(elements_finished)
+      flops += cur_flops * tf.to_int64(evaluated_objects)
 
-    remainder -= halting_proba
+      # Add new state to the outputs weighted by the halting distribution.
+      outputs += new_state * tf.cast(
+          tf.reshape(cur_halting_distrib, [-1] + [1] * (inputs_rank - 1)),
+          new_state.dtype)
 
     return (new_state, halting_cumsum, cur_elements_finished, remainder,
             ponder_cost, num_units, flops, cur_halting_distrib, outputs)
@@ -300,13 +526,56 @@ def adaptive_computation_early_stopping(inputs, unit, max_units,
 
       halting_distribs.append(tf.reshape(cur_halting_distrib, [batch, 1]))
 
-  halting_distribution = tf.concat(halting_distribs, 1)
+  halting_distribution = None
+  if return_halting_distribution:
+    halting_distribution = tf.concat(halting_distribs, 1)
 
   return (ponder_cost, num_units, flops, halting_distribution, outputs)
 
 
+def _tile_mean(x, tile_size):
+  """Means of the 4-D `x` over the tiles, see `sparse_utils.pad_to_tiles`.
+
+  The border tiles are averaged over their positions inside of `x`.
+  """
+  tile = [1, tile_size, tile_size, 1]
+  sums = tf.nn.avg_pool(
+      sparse_utils.pad_to_tiles(x, tile_size), tile, tile, 'VALID')
+  counts = tf.nn.avg_pool(
+      sparse_utils.pad_to_tiles(tf.ones_like(x), tile_size), tile, tile,
+      'VALID')
+  return sums / counts
+
+
+def _expand_tiles(x, tile_size, sh):
+  """Repeats the values of the tiles `x` over their positions.
+
+  Args:
+    x: A 3-D `Tensor` of shape [batch, tile_height, tile_width].
+    tile_size: A positive `int`.
+    sh: The shape [batch, height, width, ...] of the states, a list or a
+      1-D `Tensor`.
+
+  Returns:
+    A 3-D `Tensor` of shape [batch, height, width].
+  """
+  tile_sh = tf.shape(x)
+  x = tf.expand_dims(tf.expand_dims(x, 2), 4)
+  x = tf.tile(x, [1, 1, tile_size, 1, tile_size])
+  x = tf.reshape(x, tf.stack([tile_sh[0], tile_sh[1] * tile_size,
+                              tile_sh[2] * tile_size]))
+  x = x[:, :sh[1], :sh[2]]
+  if isinstance(sh, list):
+    x.set_shape(sh[:3])
+  return x
+
+
 def spatially_adaptive_computation_time(inputs, unit, max_units,
-                                        eps=1e-2, scope='act'):
+                                        eps=1e-2, scope='act',
+                                        jit_halting=False, valid_mask=None,
+                                        tile_size=1, first_unit_mask=None,
+                                        early_stopping=False,
+                                        return_halting_distribution=True):
   """Spatially adaptive computation time.
 
   Each spatial position in the states tensor has its own halting distribution.
@@ -317,21 +586,66 @@ def spatially_adaptive_computation_time(inputs, unit, max_units,
   are:
   1) The states are expected to be 4-D tensors (Batch-Height-Width-Channels).
     ACT is applied for first three dimensions.
-  2) unit should have a `residual_mask` argument. It is a `float32` mask
-    with 1's corresponding to the positions which need to be updated.
+  2) unit should have a `residual_mask` argument. It is a mask of the type of
+    the states with 1's corresponding to the positions which need to be updated.
     0's should be frozen. For ResNets this can be achieved by multiplying the
     residual branch responses by `residual_mask`.
-  3) There is no tf.cond part so the computation is not actually saved.
+  3) There is no tf.cond part, unless `early_stopping` is set. The
+    computation is saved only if the unit evaluates the residual branch at
+    the positions selected by `residual_mask` (see
+    `sparse_utils.dense_or_sparse`), rather than computing it densely and
+    masking the result.
 
   Args:
-    inputs: Input states at the first unit, 4-D `Tensor` of type `float32`.
+    inputs: Input states at the first unit, 4-D `Tensor` of a floating point
+      type. The halting computations are performed in `float32`, regardless of
+      the type of the states.
     unit: A function. See `adaptive_computation_early_stopping` for
       detailed explanation.
     max_units: Maximum number of units.
-    eps: A `float` in the range [0, 1]. Small number to ensure that
-      the computation can halt after the first unit.
+    eps: A `float` in the range [0, 1] or a scalar `float32` `Tensor`.
+      Small number to ensure that the computation can halt after the first
+      unit.
     scope: variable scope or scope name in which the layers are created.
       Defaults to 'act'.
+    jit_halting: If True, compiles the halting computations of every unit
+      with XLA, see `adaptive_computation_early_stopping`.
+    valid_mask: An optional 4-D `Tensor` of shape `[batch, height, width, 1]`
+      with ones at the valid positions of the inputs and zeros at the padding,
+      e.g. for batches of padded images. It is resized to the resolution of
+      the states with the nearest neighbor method. The padded positions are
+      considered halted before the first unit: their ponder cost, number of
+      units and outputs are zero and the units are not evaluated there. The
+      FLOPs of the first unit, which is evaluated densely, are rescaled to the
+      fraction of the valid positions.
+    tile_size: A positive `int`. If greater than one, the halting is decided
+      for every `tile_size x tile_size` tile of the states instead of every
+      position: the halting probability of a tile is the mean of the halting
+      probabilities of its positions, and the units update whole tiles. The
+      active positions then form contiguous patches, which are cheaper to
+      evaluate than scattered positions. The tiles start at the top left
+      corner, the ones at the bottom and right borders may be cropped. With
+      `valid_mask`, the tiles which contain a valid position are valid.
+    first_unit_mask: An optional 4-D `Tensor` of shape
+      `[batch, height, width, 1]` at the resolution of `inputs`, e.g. a prior
+      from the halting of the previous block. It is passed to the first unit
+      as `residual_mask`, so the first unit updates the states only at its
+      active positions. A unit with a stride should downsample it with
+      `sparse_utils.downsample_mask`. The positions of the states which are
+      inactive in the downsampled mask halt after the first unit. Requires
+      static spatial sizes and cannot be combined with `valid_mask`.
+    early_stopping: If True, the units after the first one are skipped with
+      `tf.cond` once all the positions of all the objects have halted, like
+      in `adaptive_computation_early_stopping`. The outputs, the ponder cost,
+      the number of units and the FLOPs are the same. The units are called a
+      second time outside of `tf.cond` to create their variables and to count
+      their FLOPs, so they should not have Python side-effects, and their
+      FLOPs should not depend on their outputs. Requires static shapes.
+      Intended for inference.
+    return_halting_distribution: If False, the halting distribution is not
+      stacked and None is returned instead, see
+      `adaptive_computation_early_stopping`. The distribution has
+      `max_units` values for every position.
 
   Returns:
     ponder_cost: A 3-D `Tensor` of type `float32`.
@@ -352,14 +666,36 @@ def spatially_adaptive_computation_time(inputs, unit, max_units,
     outputs: A 4-D `Tensor` of shape [batch, height, width, depth]. Outputs of
       the ACT module, intermediate states weighted by the halting distribution
       tensor.
+
+    With `tile_size`, `ponder_cost`, `num_units` and `halting_distribution`
+    are the values of the tiles repeated over their positions.
+
+  Raises:
+    ValueError: If `first_unit_mask` is combined with `valid_mask`, or if
+      `early_stopping` is used with states of dynamic shape.
   """
+  if first_unit_mask is not None and valid_mask is not None:
+    raise ValueError('first_unit_mask cannot be combined with valid_mask.')
+
+  def _to_positions(x):
+    # Repeats the values of the tiles over their positions. The padded
+    # positions in the valid tiles are zeroed.
+    if tile_size == 1:
+      return x
+    x = _expand_tiles(x, tile_size, sh)
+    if valid_mask is not None:
+      x *= tf.cast(valid, x.dtype)
+    return x
+
   with tf.variable_scope(scope):
     halting_distribs = []
     for unit_idx in range(max_units):
 
       if not unit_idx:
+        if first_unit_mask is not None:
+          first_unit_mask = tf.cast(first_unit_mask, inputs.dtype)
         (state, halting_proba, flops) = unit(
-            inputs, unit_idx, residual_mask=None)
+            inputs, unit_idx, residual_mask=first_unit_mask)
 
         # Initialize the variables which depend on the state shape.
         state_shape_fully_defined = state.get_shape().is_fully_defined()
@@ -368,68 +704,106 @@ def spatially_adaptive_computation_time(inputs, unit, max_units,
           assert len(sh) == 4
         else:
           sh = tf.shape(state)
-        halting_cumsum = tf.zeros(sh[:3])
-        elements_finished = tf.fill(sh[:3], False)
-        remainder = tf.ones(sh[:3])
+        if early_stopping and not state_shape_fully_defined:
+          # The FLOPs of the units would depend on their outputs.
+          raise ValueError('early_stopping requires static shapes.')
+        # The shape of the halting state, one value per tile.
+        if tile_size == 1:
+          halting_sh = sh[:3]
+        elif state_shape_fully_defined:
+          halting_sh = [sh[0], -(-sh[1] // tile_size),
+                        -(-sh[2] // tile_size)]
+        else:
+          halting_sh = tf.stack([sh[0], (sh[1] + tile_size - 1) // tile_size,
+                                 (sh[2] + tile_size - 1) // tile_size])
+        halting_cumsum = tf.zeros(halting_sh)
+        elements_finished = tf.fill(halting_sh, False)
+        remainder = tf.ones(halting_sh)
         # Initialize ponder_cost with one to fix an off-by-one error.
-        ponder_cost = tf.ones(sh[:3])
-        num_units = tf.zeros(sh[:3], dtype=tf.int32)
+        ponder_cost = tf.ones(halting_sh)
+        num_units = tf.zeros(halting_sh, dtype=tf.int32)
+
+        if valid_mask is not None:
+          valid = tf.image.resize_nearest_neighbor(
+              tf.to_float(valid_mask), sh[1:3], align_corners=False)
+          valid_tiles = valid
+          if tile_size > 1:
+            valid_tiles = sparse_utils.tile_max(valid, tile_size)
+          valid = tf.squeeze(valid, [3])
+          valid_tiles = tf.reshape(valid_tiles, halting_sh)
+          # The padded positions have already halted.
+          halting_cumsum = 1. - valid_tiles
+          elements_finished = tf.less(valid_tiles, 0.5)
+          ponder_cost = valid_tiles
+          # The first unit is evaluated densely.
+          valid_fraction = tf.reduce_mean(valid, [1, 2])
+          flops = tf.to_int64(
+              tf.round(tf.to_double(flops) * tf.to_double(valid_fraction)))
+
+        if first_unit_mask is not None:
+          # The tiles updated by the first unit.
+          first_unit_updated = sparse_utils.downsample_mask_like(
+              tf.to_float(first_unit_mask), state)
+          if tile_size > 1:
+            first_unit_updated = sparse_utils.tile_max(first_unit_updated,
+                                                       tile_size)
+          first_unit_updated = tf.reshape(first_unit_updated, halting_sh)
       else:
         # Mask out the residual values for the not calculated outputs.
-        residual_mask = tf.to_float(tf.logical_not(elements_finished))
+        residual_mask = tf.cast(tf.logical_not(elements_finished),
+                                state.dtype)
+        if tile_size > 1:
+          residual_mask = _expand_tiles(residual_mask, tile_size, sh)
         residual_mask = tf.expand_dims(residual_mask, 3)
-        (state, halting_proba, current_flops) = unit(
-            state, unit_idx, residual_mask=residual_mask)
+        if early_stopping:
+          (state, halting_proba, current_flops) = _run_unit_unless_finished(
+              unit, unit_idx, state, residual_mask, elements_finished, sh)
+        else:
+          (state, halting_proba, current_flops) = unit(
+              state, unit_idx, residual_mask=residual_mask)
         flops += current_flops
 
       # We always halt at the last unit.
       if unit_idx < max_units - 1:
-        halting_proba = tf.reshape(halting_proba, sh[:3])
+        if tile_size > 1:
+          halting_proba = tf.reshape(halting_proba, sh[:3])
+          halting_proba = _tile_mean(
+              tf.expand_dims(tf.to_float(halting_proba), 3), tile_size)
+        halting_proba = tf.reshape(halting_proba, halting_sh)
       else:
-        halting_proba = tf.ones(sh[:3])
-
-      halting_cumsum += halting_proba
-      # Which objects are no longer calculated after this unit?
-      cur_elements_finished = (halting_cumsum >= 1 - eps)
-      # Zero out halting_proba for the previously finished positions.
-      halting_proba = tf.where(cur_elements_finished,
-                               tf.zeros(sh[:3]),
-                               halting_proba)
-      # Find positions which have halted at the current unit.
-      just_finished = tf.logical_and(tf.logical_not(elements_finished),
-                                     cur_elements_finished)
-      # For such positions, the halting distribution value is the remainder.
-      # For others, it is the halting_proba.
-      cur_halting_distrib = tf.where(just_finished,
-                                     remainder,
-                                     halting_proba)
-
-      # Update ponder_cost. Add 1 to positions which are still computed,
-      # remainder to the positions which have just halted and
-      # 0 to the previously halted positions.
-      ponder_cost += tf.where(
-          cur_elements_finished,
-          tf.where(just_finished, remainder, tf.zeros(sh[:3])),
-          tf.ones(sh[:3]))
-
-      # Add a unit to the positions that were active during this unit
-      # (not the ones that will be active the next unit).
-      num_units += tf.to_int32(tf.logical_not(elements_finished))
-
-      # Add new state to the outputs weighted by the halting distribution.
-      update = state * tf.expand_dims(cur_halting_distrib, 3)
-      if unit_idx:
-        outputs += update
-      else:
-        outputs = update
-
-      remainder -= halting_proba
+        halting_proba = tf.ones(halting_sh)
+
+      if not unit_idx and first_unit_mask is not None:
+        # The positions which were not updated by the first unit halt.
+        halting_proba = tf.where(first_unit_updated > 0.,
+                                 tf.to_float(halting_proba),
+                                 tf.ones(halting_sh))
+
+      with _jit_scope(jit_halting):
+        (halting_cumsum, cur_elements_finished, remainder, ponder_cost,
+         num_units, cur_halting_distrib) = _halting_step(
+             halting_proba, eps, halting_cumsum, elements_finished, remainder,
+             ponder_cost, num_units)
+
+        # Add new state to the outputs weighted by the halting distribution.
+        cur_halting_distrib = _to_positions(cur_halting_distrib)
+        update = state * tf.cast(tf.expand_dims(cur_halting_distrib, 3),
+                                 state.dtype)
+        if unit_idx:
+          outputs += update
+        else:
+          outputs = update
 
       elements_finished = cur_elements_finished
 
-      halting_distribs.append(cur_halting_distrib)
+      if return_halting_distribution:
+        halting_distribs.append(cur_halting_distrib)
 
-  halting_distribution = tf.stack(halting_distribs, axis=3)
+  halting_distribution = None
+  if return_halting_distribution:
+    halting_distribution = tf.stack(halting_distribs, axis=3)
+  ponder_cost = _to_positions(ponder_cost)
+  num_units = _to_positions(num_units)
 
   if not state_shape_fully_defined:
     # Update static shape info. Faster RCNN code wants to know batch dimension
@@ -437,3 +811,243 @@ def spatially_adaptive_computation_time(inputs, unit, max_units,
     outputs.set_shape(inputs.get_shape().as_list()[:1] + [None] * 3)
 
   return (ponder_cost, num_units, flops, halting_distribution, outputs)
+
+
+def adaptive_computation_while_loop(inputs, unit, max_units, eps=1e-2,
+                                    scope='act', spatial=False,
+                                    compact_batch=False, unit_scope='unit_%d',
+                                    jit_halting=False,
+                                    return_halting_distribution=True,
+                                    realized_flops=None):
+  """Builds ACT or SACT with a single copy of the intermediate units.
+
+  `adaptive_computation_early_stopping` and
+  `spatially_adaptive_computation_time` build the subgraph of every unit
+  separately, so the size of the graph grows with `max_units`. This function
+  builds the first and the last units as usual and iterates a single copy of
+  the units `1, ..., max_units - 2` in a `tf.while_loop`. The variables of
+  every unit are still created with their usual names, so the checkpoints are
+  compatible, and the loop reads the variables of the current unit from a
+  `tf.TensorArray`.
+
+  The units `1, ..., max_units - 2` should perform the same computation up to
+  their variables, and the variables of the unit `unit_idx` should be created
+  in the variable scope `unit_scope % (unit_idx + 1)` nested in `scope`, like
+  in `resnet_act.unit_act`.
+
+  The loop is built without support for back propagation and the variables
+  are read-only inside of it, so this function is intended for inference.
+  In particular, batch normalization should use the moving averages.
+
+  Args:
+    inputs: Input state at the first unit.
+    unit: A function. See `adaptive_computation_early_stopping` and
+      `spatially_adaptive_computation_time`. It is called once for the units
+      `0`, `1` and `max_units - 1`.
+    max_units: Maximum number of units.
+    eps: A `float` in the range [0, 1] or a scalar `float32` `Tensor`.
+      Small number to ensure that the computation can halt after the first
+      unit.
+    scope: variable scope or scope name in which the layers are created.
+      Defaults to 'act'.
+    spatial: If True, builds SACT, as in `spatially_adaptive_computation_time`.
+      Otherwise builds ACT with early stopping, as in
+      `adaptive_computation_early_stopping`.
+    compact_batch: See `adaptive_computation_early_stopping`. Not supported
+      for SACT.
+    unit_scope: Name pattern of the variable scopes of the units.
+    jit_halting: If True, compiles the halting computations of every unit
+      with XLA, see `adaptive_computation_early_stopping`.
+    return_halting_distribution: If False, the halting distribution is not
+      accumulated in the loop and None is returned instead.
+    realized_flops: An optional dict shared with `unit`, in which every call
+      of `unit` stores the FLOPs it executes under its `unit_idx`, like the
+      `realized_flops` argument of `resnet_act.unit_act`. The FLOPs of the
+      units built inside of the loop (or of `tf.cond`) are accumulated for
+      every unit index, zero for the skipped units, and stored in the dict
+      instead. Not supported with `compact_batch`.
+
+  Returns:
+    Same values as `adaptive_computation_early_stopping` or
+    `spatially_adaptive_computation_time`.
+
+  Raises:
+    ValueError: If `spatial` and `compact_batch` are both set, or if
+      `compact_batch` is used with `realized_flops`.
+  """
+  if spatial and compact_batch:
+    raise ValueError('compact_batch is not supported for SACT.')
+  if compact_batch and realized_flops is not None:
+    raise ValueError('realized_flops is not supported with compact_batch.')
+
+  if max_units < 3:
+    # There are no intermediate units to iterate.
+    if spatial:
+      return spatially_adaptive_computation_time(
+          inputs, unit, max_units, eps=eps, scope=scope,
+          jit_halting=jit_halting,
+          return_halting_distribution=return_halting_distribution)
+    return adaptive_computation_early_stopping(
+        inputs, unit, max_units, eps=eps, scope=scope,
+        compact_batch=compact_batch, jit_halting=jit_halting,
+        return_halting_distribution=return_halting_distribution)
+
+  def _run_unit(unit_idx, state, elements_finished):
+    if spatial:
+      # Mask out the residual values for the not calculated outputs.
+      residual_mask = tf.cast(tf.logical_not(elements_finished), state.dtype)
+      residual_mask = tf.expand_dims(residual_mask, 3)
+      return unit(state, unit_idx, residual_mask=residual_mask)
+    if compact_batch:
+      return _run_unit_compact(unit, unit_idx, state, elements_finished)
+    return unit(state, unit_idx)
+
+  def _add_realized_flops(executed_flops, unit_idx, built_unit_idx):
+    # Moves the FLOPs stored by the unit built as `built_unit_idx` inside of
+    # control flow to the accumulator of the unit `unit_idx`.
+    if realized_flops is None:
+      return executed_flops
+    unit_flops = realized_flops.pop(built_unit_idx)
+    return executed_flops + (
+        tf.expand_dims(tf.one_hot(unit_idx, max_units, dtype=tf.int64), 1) *
+        tf.expand_dims(unit_flops, 0))
+
+  def _update(unit_idx, new_state, halting_proba, cur_flops, values):
+    with _jit_scope(jit_halting):
+      return _update_halting(unit_idx, new_state, halting_proba, cur_flops,
+                             values)
+
+  def _update_halting(unit_idx, new_state, halting_proba, cur_flops, values):
+    (halting_cumsum, elements_finished, remainder, ponder_cost, num_units,
+     flops, halting_distribution, outputs) = values
+
+    if halting_proba is None:
+      # We always halt at the last unit.
+      halting_proba = tf.ones_like(halting_cumsum)
+    else:
+      halting_proba = tf.reshape(halting_proba, tf.shape(halting_cumsum))
+      halting_proba.set_shape(halting_cumsum.get_shape())
+
+    if not spatial:
+      # Update the FLOPS counters only for the objects that were active
+      # during this unit.
+      cur_flops *= tf.to_int64(tf.logical_not(elements_finished))
+    flops += cur_flops
+
+    (halting_cumsum, elements_finished, remainder, ponder_cost, num_units,
+     cur_halting_distrib) = _halting_step(
+         halting_proba, eps, halting_cumsum, elements_finished, remainder,
+         ponder_cost, num_units)
+
+    if return_halting_distribution:
+      halting_distribution += (tf.expand_dims(cur_halting_distrib, -1) *
+                               tf.one_hot(unit_idx, max_units))
+
+    # Add new state to the outputs weighted by the halting distribution.
+    weights = cur_halting_distrib
+    for _ in range(new_state.get_shape().ndims - weights.get_shape().ndims):
+      weights = tf.expand_dims(weights, -1)
+    outputs += new_state * tf.cast(weights, new_state.dtype)
+
+    return (halting_cumsum, elements_finished, remainder, ponder_cost,
+            num_units, flops, halting_distribution, outputs)
+
+  with tf.variable_scope(scope) as sc:
+    if spatial:
+      (state, halting_proba, flops) = unit(inputs, 0, residual_mask=None)
+    else:
+      (state, halting_proba, flops) = unit(inputs, 0)
+
+    # Initialize the variables which depend on the state shape.
+    state_shape_fully_defined = state.get_shape().is_fully_defined()
+    if state_shape_fully_defined:
+      sh = state.get_shape().as_list()
+    else:
+      sh = tf.shape(state)
+    halting_sh = sh[:3] if spatial else sh[:1]
+    halting_cumsum = tf.zeros(halting_sh)
+    if return_halting_distribution:
+      halting_distribution = (tf.expand_dims(halting_cumsum, -1) *
+                              tf.zeros([max_units]))
+    else:
+      # A placeholder loop variable.
+      halting_distribution = tf.zeros([])
+    values = (
+        halting_cumsum,
+        tf.fill(halting_sh, False),  # elements_finished
+        tf.ones(halting_sh),  # remainder
+        # Initialize ponder_cost with one to fix an off-by-one error.
+        tf.ones(halting_sh),
+        tf.zeros(halting_sh, dtype=tf.int32),  # num_units
+        tf.zeros_like(flops),
+        halting_distribution,
+        tf.zeros_like(state))  # outputs
+    values = _update(0, state, halting_proba, flops, values)
+    if realized_flops is not None:
+      # The FLOPs executed by every unit, of shape [max_units, batch].
+      executed_flops = tf.tile(
+          tf.expand_dims(tf.zeros_like(flops), 0), [max_units, 1])
+    else:
+      # A placeholder loop variable.
+      executed_flops = tf.zeros([], dtype=tf.int64)
+
+    loop_units = list(range(1, max_units - 1))
+
+    def _cond(unit_idx, state, unused_executed_flops, halting_cumsum,
+              elements_finished, *unused):
+      not_last = tf.less(unit_idx, max_units - 1)
+      if spatial:
+        return not_last
+      return tf.logical_and(
+          not_last, tf.logical_not(tf.reduce_all(elements_finished)))
+
+    def _body(unit_idx, state, executed_flops, *values):
+      getter = _unit_variables_getter(sc.name, unit_scope, loop_units,
+                                      unit_idx - loop_units[0])
+      with tf.variable_scope(sc, custom_getter=getter):
+        (new_state, halting_proba, cur_flops) = _run_unit(
+            loop_units[0], state, values[1])
+      new_state.set_shape(state.get_shape())
+      executed_flops = _add_realized_flops(executed_flops, unit_idx,
+                                           loop_units[0])
+      return (unit_idx + 1, new_state, executed_flops) + _update(
+          unit_idx, new_state, halting_proba, cur_flops, values)
+
+    loop_vars = tf.while_loop(
+        _cond, _body,
+        (tf.constant(loop_units[0]), state, executed_flops) + values,
+        back_prop=False)
+    state = loop_vars[1]
+    executed_flops = loop_vars[2]
+    values = tuple(loop_vars[3:])
+
+    def _last_unit():
+      with tf.variable_scope(sc, custom_getter=_outside_control_flow_getter):
+        (new_state, _, cur_flops) = _run_unit(max_units - 1, state, values[1])
+      last_executed_flops = _add_realized_flops(
+          executed_flops, max_units - 1, max_units - 1)
+      return (last_executed_flops,) + _update(
+          max_units - 1, new_state, None, cur_flops, values)
+
+    if spatial:
+      last_values = _last_unit()
+    else:
+      last_values = tf.cond(tf.reduce_all(values[1]),
+                            lambda: (executed_flops,) + values, _last_unit)
+    executed_flops = last_values[0]
+    values = tuple(last_values[1:])
+    if realized_flops is not None:
+      for unit_idx in loop_units + [max_units - 1]:
+        realized_flops[unit_idx] = executed_flops[unit_idx]
+
+  (_, _, _, ponder_cost, num_units, flops, halting_distribution,
+   outputs) = values
+  if not return_halting_distribution:
+    halting_distribution = None
+
+  if spatial and not state_shape_fully_defined:
+    # Update static shape info. Faster RCNN code wants to know batch dimension
+    # statically.
+    outputs.set_shape(inputs.get_shape().as_list()[:1] + [None] * 3)
+
+  return (ponder_cost, num_units, flops, halting_distribution, outputs)
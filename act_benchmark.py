@@ -0,0 +1,134 @@
+# Copyright 2016 Google Inc. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# ==============================================================================
+
+"""Benchmarks the per-unit overhead of the ACT/SACT halting computations.
+
+The units are small residual units with CIFAR-sized feature maps. The
+overhead of a unit is the difference between the time of an ACT module and
+the time of the same units chained without any halting computations.
+
+Usage:
+  python act_benchmark.py --benchmarks=.
+"""
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import time
+
+import tensorflow as tf
+from tensorflow.contrib.compiler import jit
+
+import act
+
+BATCH_SIZE = 32
+HEIGHT = 8
+WIDTH = 8
+DEPTH = 64
+MAX_UNITS = 10
+NUM_ITERS = 50
+
+
+def _unit(x, unit_idx, residual_mask=None):
+  with tf.variable_scope('unit_%d' % (unit_idx + 1)):
+    weights = tf.get_variable(
+        'weights', [1, 1, DEPTH, DEPTH],
+        initializer=tf.truncated_normal_initializer(stddev=0.01))
+    residual = tf.nn.relu(tf.nn.conv2d(x, weights, [1, 1, 1, 1], 'SAME'))
+    if residual_mask is not None:
+      residual *= residual_mask
+    outputs = x + residual
+    halting_proba = tf.sigmoid(
+        tf.reduce_mean(outputs, [3], keep_dims=True) - 3.)
+    flops = tf.fill([BATCH_SIZE], tf.constant(2 * HEIGHT * WIDTH * DEPTH**2,
+                                              dtype=tf.int64))
+  return outputs, halting_proba, flops
+
+
+def _jit_unit(*args, **kwargs):
+  with jit.experimental_jit_scope():
+    return _unit(*args, **kwargs)
+
+
+class ActBenchmark(tf.test.Benchmark):
+
+  def _timeOp(self, build_fn):
+    with tf.Graph().as_default():
+      inputs = tf.Variable(
+          tf.random_normal([BATCH_SIZE, HEIGHT, WIDTH, DEPTH]),
+          trainable=False)
+      op = tf.group(*build_fn(inputs))
+      with tf.Session() as sess:
+        sess.run(tf.global_variables_initializer())
+        # Warm up, this also compiles the XLA clusters.
+        for _ in range(5):
+          sess.run(op)
+        start_time = time.time()
+        for _ in range(NUM_ITERS):
+          sess.run(op)
+        return (time.time() - start_time) / NUM_ITERS
+
+  def _chainUnits(self, inputs):
+    x = inputs
+    with tf.variable_scope('act'):
+      for unit_idx in range(MAX_UNITS):
+        (x, _, _) = _unit(x, unit_idx)
+    return [x]
+
+  def _reportOverhead(self, name, wall_time, baseline_time):
+    overhead = (wall_time - baseline_time) / MAX_UNITS
+    self.report_benchmark(
+        iters=NUM_ITERS,
+        wall_time=wall_time,
+        name=name,
+        extras={'per_unit_overhead': overhead})
+    print('{}: {:.3f} ms per batch, {:.3f} ms overhead per unit'.format(
+        name, 1e3 * wall_time, 1e3 * overhead))
+
+  def benchmarkSactHalting(self):
+    baseline_time = self._timeOp(self._chainUnits)
+    self._reportOverhead('units_without_halting', baseline_time,
+                         baseline_time)
+
+    configs = [
+        ('sact', False, _unit),
+        ('sact_jit_halting', True, _unit),
+        ('sact_jit_halting_and_units', True, _jit_unit),
+    ]
+    for (name, jit_halting, unit) in configs:
+      wall_time = self._timeOp(
+          lambda inputs: act.spatially_adaptive_computation_time(
+              inputs, unit, MAX_UNITS, jit_halting=jit_halting))
+      self._reportOverhead(name, wall_time, baseline_time)
+
+  def benchmarkActEarlyStoppingHalting(self):
+    baseline_time = self._timeOp(self._chainUnits)
+
+    def _global_unit(x, unit_idx):
+      (outputs, halting_proba, flops) = _unit(x, unit_idx)
+      # Keep the computation running for all the units.
+      return outputs, 1e-3 * tf.reduce_mean(halting_proba, [1, 2, 3]), flops
+
+    for (name, jit_halting) in (('act_early_stopping', False),
+                                ('act_early_stopping_jit_halting', True)):
+      wall_time = self._timeOp(
+          lambda inputs: act.adaptive_computation_early_stopping(
+              inputs, _global_unit, MAX_UNITS, jit_halting=jit_halting))
+      self._reportOverhead(name, wall_time, baseline_time)
+
+
+if __name__ == '__main__':
+  tf.test.main()
@@ -0,0 +1,271 @@
+# Copyright 2016 Google Inc. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# ==============================================================================
+
+"""NumPy implementation of the ACT and SACT halting rules.
+
+Recomputes the ponder cost, the number of units and the FLOPs of a trained
+model for a different value of `eps` from the data exported by
+`imagenet_export`, without TensorFlow.
+
+The export contains the halting probabilities computed by every unit and the
+FLOPs of every unit as a function of its active positions, see
+`resnet_act.stack_blocks`, as well as the model type and the `eps` of every
+block. The results are exact for ACT models. The SACT models compute the
+halting probabilities of the halted positions from their frozen states, so
+the results are only exact for values of `eps` at least as large as the one
+used for the export, and smaller values are rejected.
+
+Usage:
+  python act_numpy.py --input_file=export.h5 --eps=0.01,0.05,0.1
+"""
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import argparse
+
+import numpy as np
+
+
+def adaptive_computation_time(halting_proba, eps=1e-2):
+  """NumPy version of `act.adaptive_computation_time`.
+
+  Args:
+    halting_proba: A `float32` array of shape `[..., max_units - 1]`.
+      Probabilities of halting the computation at a given unit.
+    eps: A `float` in the range [0, 1].
+
+  Returns:
+    ponder_cost: A `float32` array of shape `[...]`.
+    num_units: An `int32` array of shape `[...]`.
+    halting_distribution: A `float32` array of shape `[..., max_units]`.
+  """
+  halting_proba = np.asarray(halting_proba, dtype=np.float32)
+  max_units = halting_proba.shape[-1] + 1
+  zero_col = np.zeros(halting_proba.shape[:-1] + (1,), dtype=np.float32)
+
+  halting_padded = np.concatenate([halting_proba, zero_col], -1)
+  halting_cumsum = np.cumsum(halting_proba, axis=-1, dtype=np.float32)
+  halting_cumsum_padded = np.concatenate([zero_col, halting_cumsum], -1)
+
+  # Halting iteration (zero-based), always halt at the final unit.
+  halt_flag = halting_cumsum >= np.float32(1 - eps)
+  halt_flag_final = np.concatenate(
+      [halt_flag, np.ones(zero_col.shape, dtype=bool)], -1)
+  n = np.argmax(halt_flag_final, axis=-1)
+
+  # Fancy indexing to obtain the value of the remainder.
+  remainder = np.float32(1) - halting_cumsum_padded.reshape(
+      [-1, max_units])[np.arange(n.size), n.ravel()].reshape(n.shape)
+
+  num_units = (n + 1).astype(np.int32)
+  ponder_cost = num_units.astype(np.float32) + remainder
+
+  unit_index = np.arange(max_units)
+  halting_distribution = np.where(unit_index < n[..., None], halting_padded,
+                                  np.float32(0))
+  halting_distribution = np.where(unit_index == n[..., None],
+                                  remainder[..., None], halting_distribution)
+
+  return ponder_cost, num_units, halting_distribution
+
+
+def spatially_adaptive_computation_time(halting_proba, eps=1e-2):
+  """NumPy version of the halting recurrence of SACT.
+
+  Follows the unit by unit computation of
+  `act.spatially_adaptive_computation_time`, which is also used by
+  `act.adaptive_computation_early_stopping`, so the results are exactly the
+  same. The recurrence is vectorized over all the leading dimensions.
+
+  Args:
+    halting_proba: A `float32` array of shape `[..., max_units - 1]`.
+      For SACT, the leading dimensions are `[batch, height, width]`.
+    eps: A `float` in the range [0, 1].
+
+  Returns:
+    ponder_cost: A `float32` array of shape `[...]`.
+    num_units: An `int32` array of shape `[...]`.
+    halting_distribution: A `float32` array of shape `[..., max_units]`.
+  """
+  halting_proba = np.asarray(halting_proba, dtype=np.float32)
+  max_units = halting_proba.shape[-1] + 1
+  sh = halting_proba.shape[:-1]
+  threshold = np.float32(1 - eps)
+
+  halting_cumsum = np.zeros(sh, dtype=np.float32)
+  elements_finished = np.zeros(sh, dtype=bool)
+  remainder = np.ones(sh, dtype=np.float32)
+  # Initialize ponder_cost with one to fix an off-by-one error.
+  ponder_cost = np.ones(sh, dtype=np.float32)
+  num_units = np.zeros(sh, dtype=np.int32)
+  halting_distribs = []
+
+  for unit_idx in range(max_units):
+    # We always halt at the last unit.
+    if unit_idx < max_units - 1:
+      cur_halting_proba = halting_proba[..., unit_idx]
+    else:
+      cur_halting_proba = np.ones(sh, dtype=np.float32)
+
+    halting_cumsum = halting_cumsum + cur_halting_proba
+    cur_elements_finished = halting_cumsum >= threshold
+    cur_halting_proba = np.where(cur_elements_finished, np.float32(0),
+                                 cur_halting_proba)
+    just_finished = np.logical_and(np.logical_not(elements_finished),
+                                   cur_elements_finished)
+    cur_halting_distrib = np.where(just_finished, remainder, cur_halting_proba)
+    ponder_cost = ponder_cost + np.where(
+        cur_elements_finished,
+        np.where(just_finished, remainder, np.float32(0)),
+        np.float32(1))
+    num_units += np.logical_not(elements_finished)
+    remainder = remainder - cur_halting_proba
+    elements_finished = cur_elements_finished
+    halting_distribs.append(cur_halting_distrib)
+
+  halting_distribution = np.stack(halting_distribs, axis=-1)
+  return ponder_cost, num_units, halting_distribution
+
+
+def _dilate(mask):
+  """The 3x3 halo of the positions of `mask`, see `cifar_model.residual`.
+
+  Args:
+    mask: A `bool` array of shape `[batch, height, width, ...]`.
+
+  Returns:
+    A `bool` array of the shape of `mask`.
+  """
+  pad = [(0, 0), (1, 1), (1, 1)] + [(0, 0)] * (mask.ndim - 3)
+  padded = np.pad(mask, pad, 'constant')
+  height, width = mask.shape[1:3]
+  halo = np.zeros_like(mask)
+  for dy in range(3):
+    for dx in range(3):
+      halo |= padded[:, dy:dy + height, dx:dx + width]
+  return halo
+
+
+def block_flops(num_units, unit_flops):
+  """Computes the FLOPs of a block from the FLOPs of its units.
+
+  The FLOPs of the unit `k` are `c + a * |D| + b * |M|`, where `M` are the
+  positions which use the unit, `D` is their 3x3 halo, `|.|` is the number
+  of positions and `(c, a, b) = unit_flops[:, k]`, see
+  `resnet_act._unit_flops`. An ACT unit is counted only for the objects
+  which use it, a SACT unit is always counted.
+
+  Args:
+    num_units: An integer array of shape `[batch]` (ACT) or
+      `[batch, height, width]` (SACT).
+    unit_flops: An integer array of shape `[batch, max_units, 3]`.
+
+  Returns:
+    An `int64` array of shape `[batch]`.
+  """
+  num_units = np.asarray(num_units)
+  unit_flops = np.asarray(unit_flops, dtype=np.int64)
+  max_units = unit_flops.shape[1]
+  active = num_units[..., None] > np.arange(max_units)
+  if num_units.ndim == 1:
+    return np.sum(active * unit_flops[:, :, 0], axis=1)
+  num_active = active.sum(axis=(1, 2))
+  num_halo = _dilate(active).sum(axis=(1, 2))
+  flops = (unit_flops[:, :, 0] + unit_flops[:, :, 1] * num_halo +
+           unit_flops[:, :, 2] * num_active)
+  return flops.sum(axis=1)
+
+
+def what_if(halting_proba, unit_flops, eps, model_type):
+  """Recomputes the ponder cost, number of units and FLOPs of a block.
+
+  Args:
+    halting_proba: Exported halting probabilities of the block, of shape
+      `[batch, max_units - 1]` or `[batch, height, width, max_units - 1]`.
+    unit_flops: Exported FLOPs of the units of the block, see `block_flops`.
+    eps: The new value of `eps`.
+    model_type: One of 'act', 'act_early_stopping' or 'sact'. Selects the
+      implementation of the halting rule which matches the model.
+
+  Returns:
+    ponder_cost, num_units and flops of the block.
+  """
+  if model_type == 'act':
+    (ponder_cost, num_units, _) = adaptive_computation_time(halting_proba, eps)
+  else:
+    (ponder_cost, num_units, _) = spatially_adaptive_computation_time(
+        halting_proba, eps)
+  return ponder_cost, num_units, block_flops(num_units, unit_flops)
+
+
+def main():
+  parser = argparse.ArgumentParser(description=__doc__)
+  parser.add_argument('--input_file', required=True,
+                      help='An HDF5 file produced by imagenet_export.')
+  parser.add_argument('--eps', default='0.01',
+                      help='Comma separated values of eps to evaluate.')
+  args = parser.parse_args()
+  values_of_eps = [float(x) for x in args.eps.split(',')]
+
+  import h5py  # pylint: disable=g-import-not-at-top
+
+  def _decode(value):
+    if isinstance(value, bytes):
+      return value.decode('utf-8')
+    return value
+
+  f = h5py.File(args.input_file, 'r')
+  if 'model_types' not in f.attrs:
+    parser.error('{} does not store the model types of the blocks, export it '
+                 'again with imagenet_export.'.format(args.input_file))
+  blocks = []
+  for (block_scope, model_type, exported_eps) in zip(
+      f.attrs['block_scopes'], f.attrs['model_types'], f.attrs['eps']):
+    block_scope = _decode(block_scope)
+    model_type = _decode(model_type)
+    if '{}/halting_proba'.format(block_scope) not in f:
+      parser.error('{} does not store the halting probabilities of the '
+                   'units, export it again with imagenet_export.'.format(
+                       args.input_file))
+    if model_type == 'sact' and min(values_of_eps) < exported_eps:
+      # The halting probabilities of the halted positions were computed from
+      # their frozen states.
+      parser.error('{} was exported with eps={}, smaller values are not '
+                   'supported for the SACT block {}.'.format(
+                       args.input_file, exported_eps, block_scope))
+    blocks.append(
+        (block_scope, model_type,
+         np.array(f['{}/halting_proba'.format(block_scope)]),
+         np.array(f['{}/unit_flops'.format(block_scope)]),
+         np.array(f['{}/flops'.format(block_scope)])))
+  other_flops = np.array(f['flops']) - sum(b[4] for b in blocks)
+
+  for eps in values_of_eps:
+    total_flops = other_flops.astype(np.float64)
+    print('eps = {}'.format(eps))
+    for (block_scope, model_type, halting_proba, unit_flops, _) in blocks:
+      (ponder_cost, num_units, flops) = what_if(
+          halting_proba, unit_flops, eps, model_type)
+      total_flops += flops
+      print('  {}: ponder cost {:.3f}, num units {:.3f}, GFLOPs {:.3f}'.format(
+          block_scope, np.mean(ponder_cost), np.mean(num_units),
+          np.mean(flops) / 1e9))
+    print('  total GFLOPs {:.3f}'.format(np.mean(total_flops) / 1e9))
+
+
+if __name__ == '__main__':
+  main()
@@ -0,0 +1,153 @@
+# Copyright 2016 Google Inc. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# ==============================================================================
+
+"""Tests for the NumPy implementation of adaptive computation time."""
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import numpy as np
+import tensorflow as tf
+from tensorflow.contrib import slim
+
+import act
+import act_numpy
+import cifar_model
+
+
+# Halting probabilities of the test cases in act_test.py.
+HALTING_PROBAS = [
+    [[0.999] * 4],
+    [[0.999] + [0.5] * 3],
+    [[0.01, 0.50, 0.60, 0.70]],
+    [[0.01] * 4],
+    [[0.999] * 4, [0.01, 0.50, 0.60, 0.70], [0.01] * 4],
+]
+
+
+class ActNumpyTest(tf.test.TestCase):
+
+  def _runTensorFlowEarlyStopping(self, halting_probas, eps):
+    halting_probas = np.array(halting_probas, dtype=np.float32)
+    batch = halting_probas.shape[0]
+    max_units = halting_probas.shape[1] + 1
+    halting_probas_tf = tf.constant(halting_probas)
+
+    def unit(x, unit_idx):
+      if unit_idx < max_units - 1:
+        halting_proba = tf.reshape(halting_probas_tf[:, unit_idx], [-1, 1])
+      else:
+        halting_proba = None
+      return (x, halting_proba, tf.zeros([batch], dtype=tf.int64))
+
+    (cost, num_units, _, distrib, _) = act.adaptive_computation_early_stopping(
+        tf.zeros([batch, 1]), unit, max_units, eps=eps)
+    with self.test_session() as sess:
+      return sess.run((cost, num_units, distrib))
+
+  def testAdaptiveComputationTime(self):
+    for halting_probas in HALTING_PROBAS:
+      for eps in (1e-2, 0.1):
+        expected = act.adaptive_computation_time(
+            tf.constant(halting_probas, dtype=tf.float32), eps=eps)
+        with self.test_session() as sess:
+          expected_out = sess.run(expected)
+        actual_out = act_numpy.adaptive_computation_time(halting_probas, eps)
+        for (expected_value, actual_value) in zip(expected_out, actual_out):
+          self.assertEqual(expected_value.dtype, actual_value.dtype)
+          self.assertAllEqual(expected_value, actual_value)
+
+  def testEarlyStopping(self):
+    for halting_probas in HALTING_PROBAS:
+      for eps in (1e-2, 0.1):
+        expected_out = self._runTensorFlowEarlyStopping(halting_probas, eps)
+        actual_out = act_numpy.spatially_adaptive_computation_time(
+            halting_probas, eps)
+        for (expected_value, actual_value) in zip(expected_out, actual_out):
+          self.assertAllEqual(expected_value, actual_value)
+
+  def testSpatiallyAdaptiveComputationTime(self):
+    # Same setting as act_test.SactTest.testSimple.
+    sh = [1, 1, 2, 1]
+    halting_probas = [
+        np.array([0.9, 0.1]).reshape(sh),
+        np.array([0.5, 0.1]).reshape(sh),
+    ]
+    max_units = 3
+
+    def unit(x, unit_idx, residual_mask):
+      if unit_idx < max_units - 1:
+        halting_proba = tf.constant(halting_probas[unit_idx], dtype=tf.float32)
+      else:
+        halting_proba = None
+      return (x, halting_proba, tf.zeros([1], dtype=tf.int64))
+
+    (cost, num_units, _, distrib, _) = act.spatially_adaptive_computation_time(
+        tf.zeros(sh), unit, max_units)
+    with self.test_session() as sess:
+      expected_out = sess.run((cost, num_units, distrib))
+
+    actual_out = act_numpy.spatially_adaptive_computation_time(
+        np.concatenate(halting_probas, axis=3))
+    for (expected_value, actual_value) in zip(expected_out, actual_out):
+      self.assertAllEqual(expected_value, actual_value)
+
+  def testWhatIf(self):
+    rng = np.random.RandomState(0)
+    images = rng.uniform(size=[2, 32, 32, 3]).astype(np.float32)
+    model_types = ['act', 'act_early_stopping', 'sact']
+    with slim.arg_scope(cifar_model.resnet_arg_scope(is_training=False)):
+      _, end_points = cifar_model.resnet(
+          tf.constant(images),
+          model=[3],
+          num_classes=10,
+          model_type=','.join(model_types),
+          base_channels=2,
+          return_unit_data=True)
+    names = ['{}/{}'.format(scope, name)
+             for scope in end_points['block_scopes']
+             for name in ('halting_proba', 'unit_flops', 'num_units', 'flops')]
+    values_of_eps = (0.01, 0.93, 0.99)
+    with self.test_session() as sess:
+      sess.run(tf.global_variables_initializer())
+      outputs = {}
+      for eps in values_of_eps:
+        feed_dict = {end_points['{}/eps'.format(scope)]: eps
+                     for scope in end_points['block_scopes']}
+        outputs[eps] = sess.run({name: end_points[name] for name in names},
+                                feed_dict=feed_dict)
+
+    # Both smaller and larger values of eps than the exported one.
+    exported = outputs[0.93]
+    for (scope, model_type) in zip(end_points['block_scopes'], model_types):
+      for eps in values_of_eps:
+        expected = outputs[eps]
+        (_, num_units, flops) = act_numpy.what_if(
+            exported['{}/halting_proba'.format(scope)],
+            exported['{}/unit_flops'.format(scope)], eps, model_type)
+        # The FLOPs of the units do not depend on the halting.
+        self.assertAllEqual(
+            act_numpy.block_flops(expected['{}/num_units'.format(scope)],
+                                  exported['{}/unit_flops'.format(scope)]),
+            expected['{}/flops'.format(scope)])
+        if model_type != 'sact':
+          self.assertAllEqual(num_units,
+                              expected['{}/num_units'.format(scope)])
+          self.assertAllEqual(flops, expected['{}/flops'.format(scope)])
+
+
+if __name__ == '__main__':
+  tf.test.main()
@@ -217,6 +217,43 @@ class ActWrapperTest(tf.test.TestCase):
       self.assertEqual(decay_cost_out, 5.0)
 
 
+  def testGradientsMatchStackedOutputs(self):
+    batch = 3
+    max_units = 4
+    unit_outputs = tf.random_normal(shape=[batch, max_units, 2])
+    halting_probas = tf.random_uniform(shape=[batch, max_units], maxval=0.5)
+
+    def unit(x, unit_idx):
+      return (unit_outputs[:, unit_idx, :],
+              tf.reshape(halting_probas[:, unit_idx], [-1, 1]),
+              tf.zeros([batch], dtype=tf.int64))
+
+    (cost, _, _, distrib, outputs) = act.adaptive_computation_time_wrapper(
+        tf.zeros([batch, 2]), unit, max_units)
+
+    # Reference: weight the stacked states by the halting distribution.
+    (expected_cost, _, expected_distrib) = act.adaptive_computation_time(
+        halting_probas[:, :-1])
+    expected_outputs = tf.squeeze(
+        tf.matmul(expected_distrib[:, None, :], unit_outputs), [1])
+
+    loss = tf.reduce_sum(outputs * outputs) + tf.reduce_sum(cost)
+    expected_loss = (tf.reduce_sum(expected_outputs * expected_outputs) +
+                     tf.reduce_sum(expected_cost))
+    grads = tf.gradients(loss, [unit_outputs, halting_probas])
+    expected_grads = tf.gradients(expected_loss,
+                                  [unit_outputs, halting_probas])
+    with self.test_session() as sess:
+      (distrib_out, expected_distrib_out, outputs_out, expected_outputs_out,
+       grads_out, expected_grads_out) = sess.run(
+           (distrib, expected_distrib, outputs, expected_outputs, grads,
+            expected_grads))
+      self.assertAllClose(distrib_out, expected_distrib_out)
+      self.assertAllClose(outputs_out, expected_outputs_out)
+      for (grad_out, expected_grad_out) in zip(grads_out, expected_grads_out):
+        self.assertAllClose(grad_out, expected_grad_out)
+
+
 class ActEarlyStoppingTest(tf.test.TestCase):
 
   def _runAct(self, unit_outputs, halting_probas):
@@ -334,10 +371,189 @@ class ActEarlyStoppingTest(tf.test.TestCase):
       (outputs_out, decay_cost_out) = sess.run((outputs, decay_cost))
       self.assertEqual(decay_cost_out, 5.0)
 
+  def testFeedableEps(self):
+    inputs = tf.zeros([1, 1])
+    eps = tf.placeholder_with_default(1e-2, [])
+
+    def unit(x, unit_idx):
+      return (x, tf.constant(0.3, shape=[1, 1]),
+              tf.constant(0, shape=[1], dtype=tf.int64))
+
+    (_, num_units, _, _, _) = act.adaptive_computation_early_stopping(
+        inputs, unit, 5, eps=eps)
+    with self.test_session() as sess:
+      self.assertAllEqual(sess.run(num_units), [4])
+      self.assertAllEqual(sess.run(num_units, feed_dict={eps: 0.15}), [3])
+
+  def _runCompact(self, compact_batch):
+    g = tf.Graph()
+    with g.as_default():
+      return self._buildAndRunCompact(g, compact_batch)
+
+  def _buildAndRunCompact(self, g, compact_batch):
+    # Object 0 halts after the first unit, object 1 after the second one,
+    # object 2 runs all four units.
+    halting_probas = tf.constant(
+        [[0.995] * 4, [0.6] * 4, [0.1] * 4], dtype=tf.float32)
+    rows_counter = tf.Variable(0, trainable=False)
+
+    def unit(x, unit_idx):
+      # The first column of the state stores the index of the object.
+      ids = tf.to_int32(x[:, 0])
+      assign_op = rows_counter.assign_add(tf.shape(x)[0])
+      with tf.control_dependencies([assign_op]):
+        new_x = x + tf.constant([[0., 1.]])
+      halting_proba = tf.gather(halting_probas[:, unit_idx], ids)
+      flops = 2 * tf.ones_like(ids, dtype=tf.int64)
+      return (new_x, tf.reshape(halting_proba, [-1, 1]), flops)
+
+    inputs = tf.constant([[0., 0.], [1., 10.], [2., 20.]])
+    (cost, num_units, flops, distrib, outputs
+    ) = act.adaptive_computation_early_stopping(
+        inputs, unit, 4, compact_batch=compact_batch)
+    cost_grad = tf.gradients(cost, halting_probas)
+    with self.test_session(graph=g) as sess:
+      sess.run(tf.global_variables_initializer())
+      return sess.run((cost, num_units, flops, distrib, outputs, cost_grad,
+                       rows_counter))
+
+  def testCompactBatch(self):
+    expected = self._runCompact(compact_batch=False)
+    actual = self._runCompact(compact_batch=True)
+    for (expected_out, actual_out) in zip(expected[:-1], actual[:-1]):
+      self.assertAllClose(expected_out, actual_out)
+    self.assertAllEqual(actual[1], [1, 2, 4])
+    self.assertAllEqual(actual[2], [2, 4, 8])
+    self.assertEqual(expected[-1], 12)
+    self.assertEqual(actual[-1], 7)
+
+
+class ActWhileLoopTest(tf.test.TestCase):
+
+  def _run(self, build_fn, inputs, spatial):
+    g = tf.Graph()
+    with g.as_default():
+      unit_calls = []
+
+      def unit(x, unit_idx, residual_mask=None):
+        unit_calls.append(unit_idx)
+        with tf.variable_scope('unit_%d' % (unit_idx + 1)):
+          # The variables are initialized with unit-specific values below,
+          # the while loop creates all of them with the initializer of the
+          # second unit.
+          w = tf.get_variable(
+              'w', [], initializer=tf.zeros_initializer(),
+              regularizer=tf.nn.l2_loss)
+          h = tf.get_variable('h', [], initializer=tf.zeros_initializer())
+        residual = w * tf.ones_like(x)
+        if residual_mask is not None:
+          residual *= residual_mask
+        halting_proba = tf.minimum(h * x, 1.)
+        if not spatial:
+          halting_proba = halting_proba[:, :1]
+        flops = 2 * tf.ones(tf.shape(x)[:1], dtype=tf.int64)
+        return (x + residual, halting_proba, flops)
+
+      outputs = build_fn(tf.constant(inputs), unit)
+      decay_cost = tf.add_n(
+          tf.get_collection(tf.GraphKeys.REGULARIZATION_LOSSES))
+
+      assign_ops = []
+      for v in tf.global_variables():
+        # Variable names are 'act/unit_<unit_idx + 1>/<w or h>'.
+        (_, unit_scope, name) = v.op.name.split('/')
+        unit_idx = int(unit_scope.split('_')[1]) - 1
+        value = unit_idx + 1. if name == 'w' else 0.05 * unit_idx
+        assign_ops.append(v.assign(value))
+
+      with self.test_session(graph=g) as sess:
+        sess.run(tf.global_variables_initializer())
+        sess.run(assign_ops)
+        outputs_out = sess.run(outputs + (decay_cost,))
+    return outputs_out, len(unit_calls)
+
+  def testEarlyStopping(self):
+    inputs = np.array([[0.5, 0.], [1.0, 1.], [2.0, 2.]], dtype=np.float32)
+    max_units = 6
+    expected, expected_calls = self._run(
+        lambda x, unit: act.adaptive_computation_early_stopping(
+            x, unit, max_units), inputs, False)
+    actual, actual_calls = self._run(
+        lambda x, unit: act.adaptive_computation_while_loop(
+            x, unit, max_units), inputs, False)
+    for (expected_out, actual_out) in zip(expected, actual):
+      self.assertAllClose(expected_out, actual_out)
+    self.assertEqual(expected_calls, 2 * max_units)
+    self.assertEqual(actual_calls, 3)
+
+  def testEarlyStoppingAllHalted(self):
+    # All the objects halt before the last unit.
+    inputs = np.array([[10.], [20.]], dtype=np.float32)
+    max_units = 6
+    expected, _ = self._run(
+        lambda x, unit: act.adaptive_computation_early_stopping(
+            x, unit, max_units), inputs, False)
+    actual, _ = self._run(
+        lambda x, unit: act.adaptive_computation_while_loop(
+            x, unit, max_units, compact_batch=True), inputs, False)
+    for (expected_out, actual_out) in zip(expected, actual):
+      self.assertAllClose(expected_out, actual_out)
+    self.assertAllEqual(actual[1], [3, 2])
+
+  def testSpatial(self):
+    inputs = np.array([0.5, 1.0, 2.0, 4.0],
+                      dtype=np.float32).reshape([1, 2, 2, 1])
+    max_units = 6
+    expected, expected_calls = self._run(
+        lambda x, unit: act.spatially_adaptive_computation_time(
+            x, unit, max_units), inputs, True)
+    actual, actual_calls = self._run(
+        lambda x, unit: act.adaptive_computation_while_loop(
+            x, unit, max_units, spatial=True), inputs, True)
+    for (expected_out, actual_out) in zip(expected, actual):
+      self.assertAllClose(expected_out, actual_out)
+    self.assertEqual(expected_calls, max_units)
+    self.assertEqual(actual_calls, 3)
+
+  def testWithoutHaltingDistribution(self):
+    inputs = np.array([0.5, 1.0, 2.0, 4.0],
+                      dtype=np.float32).reshape([1, 2, 2, 1])
+    max_units = 6
+
+    def build_fn(return_halting_distribution):
+      def _build(x, unit):
+        (ponder_cost, num_units, flops, halting_distribution,
+         outputs) = act.adaptive_computation_while_loop(
+             x, unit, max_units, spatial=True,
+             return_halting_distribution=return_halting_distribution)
+        if not return_halting_distribution:
+          self.assertIsNone(halting_distribution)
+        return (ponder_cost, num_units, flops, outputs)
+      return _build
+
+    expected, _ = self._run(build_fn(True), inputs, True)
+    actual, _ = self._run(build_fn(False), inputs, True)
+    for (expected_out, actual_out) in zip(expected, actual):
+      self.assertAllClose(expected_out, actual_out)
+
 
 class SactTest(tf.test.TestCase):
 
   def testSimple(self):
+    self._runSimple(jit_halting=False)
+
+  def testJitHalting(self):
+    self._runSimple(jit_halting=True)
+    compiled_ops = []
+    for op in tf.get_default_graph().get_operations():
+      try:
+        if op.get_attr('_XlaCompile'):
+          compiled_ops.append(op)
+      except ValueError:
+        pass
+    self.assertTrue(compiled_ops)
+
+  def _runSimple(self, jit_halting):
     # Batch x Height x Width x Channels
     sh = [1, 1, 2, 1]
     unit_outputs = [
@@ -363,7 +579,8 @@ class SactTest(tf.test.TestCase):
 
     inputs = tf.random_normal(shape=sh)
     (cost, num_units, flops, distrib, outputs
-    ) = act.spatially_adaptive_computation_time(inputs, unit, max_units)
+    ) = act.spatially_adaptive_computation_time(
+        inputs, unit, max_units, jit_halting=jit_halting)
     with self.test_session() as sess:
       (cost_out, num_units_out, flops_out, distrib_out, outputs_out,
        residual_masks_out) = sess.run(
@@ -406,6 +623,40 @@ class SactTest(tf.test.TestCase):
       (inputs_out, outputs_out) = sess.run((inputs, outputs))
       self.assertAllClose(inputs_out, outputs_out)
 
+  def testValidMask(self):
+    # Batch x Height x Width x Channels, the last position is padding.
+    sh = [1, 1, 3, 1]
+    max_units = 3
+    residual_masks = []
+
+    def unit(x, unit_idx, residual_mask):
+      residual = tf.ones(sh)
+      if residual_mask is not None:
+        residual_masks.append(residual_mask)
+        residual *= residual_mask
+      return (x + residual, tf.fill(sh, 0.6),
+              tf.constant(3, shape=[1], dtype=tf.int64))
+
+    valid_mask = tf.constant([1., 1., 0.], shape=sh)
+    (cost, num_units, flops, distrib, outputs
+    ) = act.spatially_adaptive_computation_time(
+        tf.zeros(sh), unit, max_units, valid_mask=valid_mask)
+    with self.test_session() as sess:
+      (cost_out, num_units_out, flops_out, distrib_out, outputs_out,
+       residual_masks_out) = sess.run(
+           (cost, num_units, flops, distrib, outputs, residual_masks))
+    # Batch x Height x Width
+    sh = [1, 1, 3]
+    self.assertAllClose(cost_out, np.array([2.4, 2.4, 0.]).reshape(sh))
+    self.assertAllEqual(num_units_out, np.array([2, 2, 0]).reshape(sh))
+    # The first unit is counted for two thirds of the positions.
+    self.assertAllEqual(flops_out, [2 + 3 + 3])
+    distrib_expected = np.array([[0.6, 0.4, 0.], [0.6, 0.4, 0.], [0., 0., 0.]])
+    self.assertAllClose(distrib_out, distrib_expected.reshape(sh + [3]))
+    self.assertAllClose(outputs_out, np.array([1.4, 1.4, 0.]).reshape(sh + [1]))
+    for residual_mask_out in residual_masks_out:
+      self.assertAllClose(residual_mask_out[0, 0, :, 0], [1., 1., 0.])
+
   def testResidualMask(self):
     # Batch x Height x Width x Channels
     sh = [1, 1, 2, 1]
@@ -446,6 +697,115 @@ class SactTest(tf.test.TestCase):
 
     self.assertAllClose(final_outputs_out, np.array([1.1, 2.7]).reshape(sh))
 
+  def testTileHalting(self):
+    # Batch x Height x Width x Channels, two tiles of size 2 and 1.
+    sh = [1, 1, 3, 1]
+    unit_outputs = [
+        np.array([1.0, 2.0, 3.0]).reshape(sh),
+        np.array([4.0, 5.0, 6.0]).reshape(sh),
+        np.array([7.0, 8.0, 9.0]).reshape(sh),
+    ]
+    halting_probas = [
+        np.array([0.8, 0.6, 0.1]).reshape(sh),
+        np.array([0.5, 0.3, 0.1]).reshape(sh),
+        np.array([0.8, 0.1, 0.1]).reshape(sh),  # unused
+    ]
+    max_units = 3
+    residual_masks = []
+
+    def unit(_, unit_idx, residual_mask):
+      residual_masks.append(residual_mask)
+      return (tf.constant(unit_outputs[unit_idx], dtype=tf.float32),
+              tf.constant(halting_probas[unit_idx], dtype=tf.float32),
+              tf.constant(2, shape=[1], dtype=tf.int64))
+
+    (cost, num_units, _, distrib, outputs
+    ) = act.spatially_adaptive_computation_time(
+        tf.zeros(sh), unit, max_units, tile_size=2)
+    with self.test_session() as sess:
+      (cost_out, num_units_out, distrib_out, outputs_out,
+       residual_masks_out) = sess.run(
+           (cost, num_units, distrib, outputs, residual_masks[1:]))
+    # Batch x Height x Width
+    sh = [1, 1, 3]
+    # The halting probabilities of the tiles are 0.7, 0.4 and 0.1, 0.1.
+    self.assertAllClose(cost_out, np.array([2.3, 2.3, 3.8]).reshape(sh))
+    self.assertAllEqual(num_units_out, np.array([2, 2, 3]).reshape(sh))
+    distrib_expected = np.array(
+        [[0.7, 0.3, 0.0], [0.7, 0.3, 0.0], [0.1, 0.1, 0.8]])
+    self.assertAllClose(distrib_out, distrib_expected.reshape(sh + [3]))
+    self.assertAllClose(outputs_out, np.array([1.9, 2.9, 8.1]).reshape(sh))
+    self.assertAllClose(residual_masks_out[0],
+                        np.array([1., 1., 1.]).reshape(sh + [1]))
+    self.assertAllClose(residual_masks_out[1],
+                        np.array([0., 0., 1.]).reshape(sh + [1]))
+
+  def testFirstUnitMask(self):
+    # Batch x Height x Width x Channels
+    sh = [1, 1, 4, 1]
+    max_units = 3
+    residual_masks = []
+
+    def unit(x, unit_idx, residual_mask):
+      residual_masks.append(residual_mask)
+      return (x + residual_mask, tf.fill(sh, 0.6),
+              tf.constant(3, shape=[1], dtype=tf.int64))
+
+    first_unit_mask = tf.constant([1., 1., 0., 0.], shape=sh)
+    (cost, num_units, _, distrib, outputs
+    ) = act.spatially_adaptive_computation_time(
+        tf.zeros(sh), unit, max_units, first_unit_mask=first_unit_mask)
+    with self.test_session() as sess:
+      (cost_out, num_units_out, distrib_out, outputs_out,
+       residual_masks_out) = sess.run(
+           (cost, num_units, distrib, outputs, residual_masks))
+    # Batch x Height x Width
+    sh = [1, 1, 4]
+    # The last two positions halt after the first unit.
+    self.assertAllClose(cost_out, np.array([2.4, 2.4, 2., 2.]).reshape(sh))
+    self.assertAllEqual(num_units_out, np.array([2, 2, 1, 1]).reshape(sh))
+    distrib_expected = np.array(
+        [[0.6, 0.4, 0.], [0.6, 0.4, 0.], [1., 0., 0.], [1., 0., 0.]])
+    self.assertAllClose(distrib_out, distrib_expected.reshape(sh + [3]))
+    self.assertAllClose(outputs_out,
+                        np.array([1.4, 1.4, 0., 0.]).reshape(sh + [1]))
+    # The first two units.
+    for residual_mask_out in residual_masks_out[:2]:
+      self.assertAllClose(residual_mask_out[0, 0, :, 0], [1., 1., 0., 0.])
+
+  def testEarlyStopping(self):
+    # Batch x Height x Width x Channels
+    sh = [2, 1, 2, 1]
+    max_units = 4
+    # The first object halts after the first unit, the second one after the
+    # second unit.
+    halting_proba = tf.constant([1., 1., 0.6, 0.6], shape=sh)
+
+    def unit(x, unit_idx, residual_mask=None):
+      del unit_idx  # Unused.
+      if residual_mask is None:
+        residual_mask = tf.ones(sh)
+      return (x + residual_mask, halting_proba,
+              tf.constant(3, shape=[2], dtype=tf.int64))
+
+    inputs = tf.zeros(sh)
+    expected = act.spatially_adaptive_computation_time(inputs, unit,
+                                                       max_units)
+    actual = act.spatially_adaptive_computation_time(
+        inputs, unit, max_units, early_stopping=True)
+    with self.test_session() as sess:
+      (expected_out, actual_out) = sess.run((expected, actual))
+    (expected_cost, expected_num_units, expected_flops, expected_distrib,
+     expected_outputs) = expected_out
+    (cost, num_units, flops, distrib, outputs) = actual_out
+    self.assertAllClose(cost, expected_cost)
+    self.assertAllEqual(num_units, expected_num_units)
+    self.assertAllClose(distrib, expected_distrib)
+    self.assertAllClose(outputs, expected_outputs)
+    # The last two units are skipped, but they still count their FLOPs.
+    self.assertAllEqual(expected_flops, [12, 12])
+    self.assertAllEqual(flops, expected_flops)
+
 
 if __name__ == '__main__':
   tf.test.main()
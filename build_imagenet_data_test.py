@@ -0,0 +1,125 @@
+# Copyright 2016 Google Inc. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# ==============================================================================
+
+"""Tests for external/build_imagenet_data.
+
+Converts a few small images and reads the shard back with datasets_imagenet.
+Requires `external` in the PYTHONPATH.
+"""
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import os
+import tempfile
+
+import numpy as np
+from PIL import Image
+import tensorflow as tf
+
+from external import dataset_utils
+from external import datasets_imagenet
+import build_imagenet_data
+
+_BOUNDING_BOX_XML = """<annotation>
+  <filename>n01_a</filename>
+  <size><width>40</width><height>20</height><depth>3</depth></size>
+  <object>
+    <name>n01</name>
+    <bndbox><xmin>4</xmin><ymin>5</ymin><xmax>20</xmax><ymax>10</ymax></bndbox>
+  </object>
+</annotation>
+"""
+
+
+class BuildImagenetDataTest(tf.test.TestCase):
+
+  def setUp(self):
+    super(BuildImagenetDataTest, self).setUp()
+    self._temp_dir = tempfile.mkdtemp(dir=self.get_temp_dir())
+    # (synset, name, width, height, color, format) of every image. The last
+    # one is a PNG file, which is re-encoded as a JPEG.
+    self._images = [
+        ('n01', 'n01_a', 40, 20, (255, 0, 0), 'JPEG'),
+        ('n01', 'n01_b', 24, 32, (0, 255, 0), 'JPEG'),
+        ('n02', 'n02_c', 16, 16, (0, 0, 255), 'PNG'),
+    ]
+    self._train_dir = os.path.join(self._temp_dir, 'train')
+    for synset, name, width, height, color, image_format in self._images:
+      synset_dir = os.path.join(self._train_dir, synset)
+      if not os.path.exists(synset_dir):
+        os.makedirs(synset_dir)
+      Image.new('RGB', (width, height), color).save(
+          os.path.join(synset_dir, name + '.JPEG'), format=image_format)
+    self._bounding_box_dir = os.path.join(self._temp_dir, 'bounding_boxes')
+    os.makedirs(self._bounding_box_dir)
+    with open(os.path.join(self._bounding_box_dir, 'n01_a.xml'), 'w') as f:
+      f.write(_BOUNDING_BOX_XML)
+
+  def _testRoundTrip(self, max_side, expected_sizes):
+    synsets = ['n01', 'n02']
+    labels = {'n01': 1, 'n02': 2}
+    bounding_boxes = build_imagenet_data._read_bounding_boxes(
+        self._bounding_box_dir)
+    image_files = build_imagenet_data._find_image_files(self._train_dir,
+                                                        synsets)
+    images = [
+        (filename, labels[synset], synset, synset,
+         bounding_boxes.get(os.path.splitext(os.path.basename(filename))[0],
+                            []))
+        for filename, synset in image_files]
+
+    output_dir = os.path.join(self._temp_dir, 'output')
+    os.makedirs(output_dir)
+    dataset_utils.write_label_file(
+        {0: 'background', 1: 'n01', 2: 'n02'}, output_dir)
+    num_images = build_imagenet_data._write_shard(
+        (os.path.join(output_dir, 'train-00000-of-00001'), images, max_side,
+         95))
+    self.assertEqual(num_images, len(self._images))
+
+    dataset = datasets_imagenet.get_split('train', output_dir)
+    serialized = tf.placeholder(tf.string, [])
+    items = dataset.decoder.decode(serialized,
+                                   ['image', 'label', 'object/bbox'])
+    outputs = []
+    with self.test_session() as sess:
+      for filename in tf.gfile.Glob(dataset.data_sources):
+        for record in tf.python_io.tf_record_iterator(filename):
+          outputs.append(sess.run(items, feed_dict={serialized: record}))
+
+    self.assertEqual(len(outputs), len(self._images))
+    for (image, label, bbox), (synset, name, _, _, color, _), size in zip(
+        outputs, self._images, expected_sizes):
+      self.assertEqual(image.shape, size + (3,))
+      # The images have a single color, which JPEG keeps almost exactly.
+      self.assertAllClose(image.reshape((-1, 3)).mean(axis=0), color,
+                          atol=4)
+      self.assertEqual(label, labels[synset])
+      if name == 'n01_a':
+        self.assertAllClose(bbox, [[0.25, 0.1, 0.5, 0.5]])
+      else:
+        self.assertEqual(bbox.shape, (0, 4))
+
+  def testRoundTrip(self):
+    self._testRoundTrip(0, [(20, 40), (32, 24), (16, 16)])
+
+  def testMaxSide(self):
+    self._testRoundTrip(32, [(16, 32), (32, 24), (16, 16)])
+
+
+if __name__ == '__main__':
+  tf.test.main()
@@ -0,0 +1,97 @@
+# Copyright 2016 Google Inc. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# ==============================================================================
+
+"""Search of per-block halting thresholds for a computational budget."""
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import collections
+
+
+OperatingPoint = collections.namedtuple('OperatingPoint',
+                                        ['eps', 'accuracy', 'cost'])
+
+
+def pareto_frontier(points):
+  """Selects the operating points which are not dominated by other points.
+
+  Args:
+    points: An iterable of `OperatingPoint`s.
+
+  Returns:
+    A list of `OperatingPoint`s sorted by increasing cost. Every point has a
+    higher accuracy than all the cheaper points.
+  """
+  frontier = []
+  for point in sorted(points, key=lambda p: (p.cost, -p.accuracy)):
+    if not frontier or point.accuracy > frontier[-1].accuracy:
+      frontier.append(point)
+  return frontier
+
+
+def greedy_threshold_search(evaluate_fn, num_blocks, eps_values, budget):
+  """Greedily increases the halting thresholds until the budget is met.
+
+  Starts with the smallest threshold in every block. At every step, tries to
+  move the threshold of each block to the next value and keeps the move which
+  loses the least accuracy per unit of saved cost.
+
+  Args:
+    evaluate_fn: A function which takes a list of per-block thresholds and
+      returns a tuple `(accuracy, cost)`.
+    num_blocks: Number of ACT blocks.
+    eps_values: An increasing list of the thresholds to consider.
+    budget: The maximum cost.
+
+  Returns:
+    selected: The last `OperatingPoint` of the search. Its cost is within the
+      budget unless no move could reduce the cost further.
+    path: A list of the `OperatingPoint`s selected at every step.
+    frontier: Pareto frontier of all the evaluated `OperatingPoint`s.
+  """
+  evaluated = {}
+
+  def _evaluate(levels):
+    if levels not in evaluated:
+      eps = [eps_values[level] for level in levels]
+      (accuracy, cost) = evaluate_fn(eps)
+      evaluated[levels] = OperatingPoint(eps, accuracy, cost)
+    return evaluated[levels]
+
+  levels = (0,) * num_blocks
+  selected = _evaluate(levels)
+  path = [selected]
+  while selected.cost > budget:
+    best = None
+    for block_idx in range(num_blocks):
+      if levels[block_idx] + 1 >= len(eps_values):
+        continue
+      candidate_levels = (levels[:block_idx] + (levels[block_idx] + 1,) +
+                          levels[block_idx + 1:])
+      candidate = _evaluate(candidate_levels)
+      saved_cost = selected.cost - candidate.cost
+      if saved_cost <= 0:
+        continue
+      score = (selected.accuracy - candidate.accuracy) / saved_cost
+      if best is None or score < best[0]:
+        best = (score, candidate_levels, candidate)
+    if best is None:
+      break
+    (_, levels, selected) = best
+    path.append(selected)
+
+  return selected, path, pareto_frontier(evaluated.values())
@@ -0,0 +1,71 @@
+# Copyright 2016 Google Inc. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# ==============================================================================
+
+"""Tests for calibration_utils."""
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import tensorflow as tf
+
+import calibration_utils
+
+
+class CalibrationUtilsTest(tf.test.TestCase):
+
+  def testParetoFrontier(self):
+    op = calibration_utils.OperatingPoint
+    points = [
+        op([0.1], 0.70, 5.0),
+        op([0.2], 0.60, 3.0),
+        op([0.3], 0.65, 4.0),
+        op([0.4], 0.62, 4.5),  # Dominated by [0.3].
+        op([0.5], 0.75, 6.0),
+    ]
+    frontier = calibration_utils.pareto_frontier(points)
+    self.assertEqual([p.eps for p in frontier],
+                     [[0.2], [0.3], [0.1], [0.5]])
+
+  def testGreedyThresholdSearch(self):
+    # The first block saves a lot of cost for little accuracy,
+    # the second block is expensive in accuracy.
+    calls = []
+
+    def evaluate_fn(eps):
+      calls.append(eps)
+      accuracy = 1.0 - 0.1 * eps[0] - 1.0 * eps[1]
+      cost = 10.0 - 5.0 * eps[0] - 5.0 * eps[1]
+      return accuracy, cost
+
+    (selected, path, frontier) = calibration_utils.greedy_threshold_search(
+        evaluate_fn, 2, [0.0, 0.5, 1.0], budget=5.0)
+    self.assertEqual(selected.eps, [1.0, 0.0])
+    self.assertAlmostEqual(selected.cost, 5.0)
+    self.assertEqual([p.eps for p in path],
+                     [[0.0, 0.0], [0.5, 0.0], [1.0, 0.0]])
+    # Every configuration is evaluated at most once.
+    self.assertEqual(len(calls), len(set(tuple(eps) for eps in calls)))
+    self.assertIn(selected, frontier)
+
+  def testGreedyThresholdSearchUnreachableBudget(self):
+    (selected, _, _) = calibration_utils.greedy_threshold_search(
+        lambda eps: (1.0, 10.0 - sum(eps)), 2, [0.0, 1.0], budget=0.0)
+    self.assertEqual(selected.eps, [1.0, 1.0])
+    self.assertAlmostEqual(selected.cost, 8.0)
+
+
+if __name__ == '__main__':
+  tf.test.main()
@@ -23,18 +23,26 @@ import tensorflow as tf
 from tensorflow.contrib import slim
 
 import cifar_data_provider
+import utils
 
 
 class CifarDataProviderTest(tf.test.TestCase):
 
-  def _testCifar10(self, split_name, expected_num_samples):
+  def _testCifar10(self, split_name, expected_num_samples,
+                   use_tf_data=False, in_memory=False):
+    if use_tf_data and not utils.tf_version_at_least(
+        utils.TF_DATA_MIN_VERSION):
+      self.skipTest('tf.data input pipelines need a newer TensorFlow.')
     data_tup = cifar_data_provider.provide_data(
-        split_name, 4, dataset_dir='testdata/cifar10')
+        split_name, 4, dataset_dir='testdata/cifar10',
+        use_tf_data=use_tf_data, in_memory=in_memory)
     images, _, one_hot_labels, num_samples, num_classes = data_tup
 
     self.assertEqual(num_samples, expected_num_samples)
     self.assertEqual(num_classes, 10)
     with self.test_session() as sess:
+      # The in-memory examples are stored in local variables.
+      sess.run(tf.local_variables_initializer())
       with slim.queues.QueueRunners(sess):
         images_out, one_hot_labels_out = sess.run([images, one_hot_labels])
         self.assertEqual(images_out.shape, (4, 32, 32, 3))
@@ -46,6 +54,18 @@ class CifarDataProviderTest(tf.test.TestCase):
   def testCifar10TestSet(self):
     self._testCifar10('test', 10000)
 
+  def testCifar10TrainSetTfData(self):
+    self._testCifar10('train', 50000, use_tf_data=True)
+
+  def testCifar10TestSetTfData(self):
+    self._testCifar10('test', 10000, use_tf_data=True)
+
+  def testCifar10TrainSetInMemory(self):
+    self._testCifar10('train', 50000, in_memory=True)
+
+  def testCifar10TestSetInMemory(self):
+    self._testCifar10('test', 10000, in_memory=True)
+
 
 if __name__ == '__main__':
   tf.test.main()
@@ -26,6 +26,8 @@ from tensorflow.contrib import slim
 
 import cifar_data_provider
 import cifar_model
+import mixed_precision
+import resnet_act
 import summary_utils
 import training_utils
 import utils
@@ -72,6 +74,21 @@ tf.app.flags.DEFINE_string(
     'Directory with CIFAR-10 data, should contain files '
     '"cifar10_train.tfrecord" and "cifar10_test.tfrecord".')
 
+tf.app.flags.DEFINE_bool(
+    'use_tf_data', False,
+    'Read the data with a tf.data input pipeline instead of queue runners. '
+    'Requires TensorFlow 1.12 or newer.')
+
+tf.app.flags.DEFINE_integer(
+    'shuffle_buffer_size', 10000,
+    'With --use_tf_data, the number of training examples in the shuffle '
+    'buffer.')
+
+tf.app.flags.DEFINE_bool(
+    'in_memory_data', False,
+    'Decode the whole split into memory once and augment and whiten the '
+    'batches with vectorized operations. Cannot be used with --use_tf_data.')
+
 # Evaluation settings
 tf.app.flags.DEFINE_string('checkpoint_dir', '/tmp/resnet_act_cifar/',
                            'Directory where the model was written to.')
@@ -95,10 +112,34 @@ tf.app.flags.DEFINE_string(
     'model_type', 'vanilla',
     'Options: vanilla (basic ResNet model), act (Adaptive Computation Time), '
     'act_early_stopping (act implementation which actually saves time), '
-    'sact (Spatially Adaptive Computation Time)')
+    'sact (Spatially Adaptive Computation Time), '
+    'or a comma separated list with the type of every block, e.g. '
+    'vanilla,sact,sact')
 
 tf.app.flags.DEFINE_float('tau', 1.0, 'The value of tau (ponder relative cost).')
 
+tf.app.flags.DEFINE_float(
+    'target_flops', 0.0,
+    'If positive, tau is adapted during training, starting from --tau, so '
+    'that the model reaches this mean number of GFLOPs per image. --tau '
+    'should then be positive.')
+
+tf.app.flags.DEFINE_float(
+    'target_ponder_cost', 0.0,
+    'If positive, tau is adapted during training, starting from --tau, so '
+    'that the model reaches this mean total ponder cost. --tau should then '
+    'be positive.')
+
+tf.app.flags.DEFINE_float(
+    'tau_rate', 0.01,
+    'The step size of the updates of log(tau) for --target_flops and '
+    '--target_ponder_cost.')
+
+tf.app.flags.DEFINE_bool(
+    'flops_weighted_ponder_cost', False,
+    'Weight the ponder cost of every block by the FLOPs of its residual '
+    'units, normalized to average to one over the blocks.')
+
 tf.app.flags.DEFINE_string(
   'model',
   '5',
@@ -108,8 +149,81 @@ tf.app.flags.DEFINE_string(
 tf.app.flags.DEFINE_string('finetune_path', '',
                            'Path for the initial checkpoint for finetuning.')
 
+tf.app.flags.DEFINE_float(
+    'sparse_threshold', 0.0,
+    'For evaluation of sact models: residual units with at most this fraction '
+    'of active positions are computed only at these positions. '
+    'Zero disables sparse evaluation.')
+
+tf.app.flags.DEFINE_bool(
+    'compact_batch', False,
+    'For evaluation of act_early_stopping models: run each residual unit only '
+    'for the images which have not halted yet.')
+
+tf.app.flags.DEFINE_bool(
+    'use_while_loop', False,
+    'For evaluation of act_early_stopping and sact models: build a single '
+    'copy of the intermediate residual units of each block and iterate it in '
+    'a tf.while_loop, which makes the graph smaller and faster to build. '
+    'Inference only: the loop is built without back-propagation, so it '
+    'cannot be used for training. Not supported with --precision=float16, '
+    '--tile_size, --cross_block_halting or --sact_early_stopping.')
+
+tf.app.flags.DEFINE_bool(
+    'jit_halting', False,
+    'For act, act_early_stopping and sact models: compile the halting '
+    'computations of every residual unit with XLA.')
+
+tf.app.flags.DEFINE_bool(
+    'jit_units', False, 'Compile every residual unit with XLA.')
+
+tf.app.flags.DEFINE_bool(
+    'recompute_units', False,
+    'Recompute every residual unit during the backward pass instead of '
+    'keeping its activations. Reduces the memory used by training.')
+
+tf.app.flags.DEFINE_string(
+    'precision', 'float32',
+    'Type of the convolutions and the activations: float32 or float16. The '
+    'variables and the halting computations are float32. float16 only saves '
+    'memory and time on GPUs, the CPU kernels of TensorFlow emulate it. '
+    'bfloat16 is not supported.')
+
+tf.app.flags.DEFINE_string(
+    'halting_head', 'conv',
+    'For sact models, the halting head: conv (3x3 convolution of the unit '
+    'outputs), conv1x1, separable (1x1 convolution to a single channel '
+    'followed by a 3x3 convolution) or bottleneck (3x3 convolution of the '
+    'narrow features of the residual branch).')
+
+tf.app.flags.DEFINE_string(
+    'tile_size', '1',
+    'For sact blocks, the size of the tiles for which the halting is decided, '
+    'or an underscore separated list with the size for every block '
+    '(e.g. 1_1_4_2). Tiles larger than one position give contiguous active '
+    'regions.')
+
+tf.app.flags.DEFINE_bool(
+    'cross_block_halting', False,
+    'For sact models, compute the first unit of a block only where the '
+    'previous block used more than one unit. The other positions halt after '
+    'the first unit.')
+
+tf.app.flags.DEFINE_bool(
+    'sact_early_stopping', False,
+    'For evaluation of sact models: skip the remaining residual units of a '
+    'block once all the positions of the batch have halted.')
+
+tf.app.flags.DEFINE_float(
+    'loss_scale', 1.0,
+    'The loss is multiplied by this value before computing the gradients. '
+    'Prevents the underflow of the float16 gradients, e.g. 128.')
+
 
 def train():
+  if FLAGS.use_while_loop:
+    raise ValueError('--use_while_loop is only supported with --mode=eval.')
+
   if not tf.gfile.Exists(FLAGS.train_log_dir):
     tf.gfile.MakeDirs(FLAGS.train_log_dir)
 
@@ -120,7 +234,12 @@ def train():
     # across the different devices.
     with tf.device(tf.train.replica_device_setter(FLAGS.ps_tasks)):
       data_tuple = cifar_data_provider.provide_data(
-          'train', FLAGS.batch_size, dataset_dir=FLAGS.dataset_dir)
+          'train',
+          FLAGS.batch_size,
+          dataset_dir=FLAGS.dataset_dir,
+          use_tf_data=FLAGS.use_tf_data,
+          shuffle_buffer_size=FLAGS.shuffle_buffer_size,
+          in_memory=FLAGS.in_memory_data)
       images, _, one_hot_labels, _, num_classes = data_tuple
 
       # Define the model:
@@ -130,23 +249,43 @@ def train():
             images,
             model=model,
             num_classes=num_classes,
-            model_type=FLAGS.model_type)
+            model_type=FLAGS.model_type,
+            jit_halting=FLAGS.jit_halting,
+            jit_units=FLAGS.jit_units,
+            recompute_units=FLAGS.recompute_units,
+            dtype=tf.as_dtype(FLAGS.precision),
+            halting_head=FLAGS.halting_head,
+            tile_size=utils.split_and_int(FLAGS.tile_size),
+            cross_block_halting=FLAGS.cross_block_halting)
 
         # Specify the loss function:
         tf.losses.softmax_cross_entropy(
             onehot_labels=one_hot_labels, logits=logits)
-        if FLAGS.model_type in ('act', 'act_early_stopping', 'sact'):
-          training_utils.add_all_ponder_costs(end_points, weights=FLAGS.tau)
+        tau = FLAGS.tau
+        if FLAGS.target_flops > 0 or FLAGS.target_ponder_cost > 0:
+          tau = training_utils.adaptive_tau(
+              end_points,
+              FLAGS.tau,
+              target_flops=FLAGS.target_flops * 1e9,
+              target_ponder_cost=FLAGS.target_ponder_cost,
+              rate=FLAGS.tau_rate)
+          tf.summary.scalar('Tau', tau)
+        if (resnet_act.is_adaptive(FLAGS.model_type) and
+            FLAGS.flops_weighted_ponder_cost):
+          training_utils.add_all_flops_weighted_ponder_costs(
+              end_points, weights=tau)
+        elif resnet_act.is_adaptive(FLAGS.model_type):
+          training_utils.add_all_ponder_costs(end_points, weights=tau)
         total_loss = tf.losses.get_total_loss()
         tf.summary.scalar('Total Loss', total_loss)
 
         metric_map = {}  # summary_utils.flops_metric_map(end_points, False)
-        if FLAGS.model_type in ('act', 'act_early_stopping', 'sact'):
+        if resnet_act.is_adaptive(FLAGS.model_type):
           metric_map.update(summary_utils.act_metric_map(end_points, False))
         for name, value in metric_map.iteritems():
           tf.summary.scalar(name, value)
 
-        if FLAGS.model_type == 'sact':
+        if resnet_act.has_sact(FLAGS.model_type):
           summary_utils.add_heatmaps_image_summary(end_points)
 
         init_fn = training_utils.finetuning_init_fn(FLAGS.finetune_path)
@@ -163,6 +302,9 @@ def train():
                                                     values)
         tf.summary.scalar('Learning Rate', learning_rate)
         optimizer = tf.train.MomentumOptimizer(learning_rate, 0.9)
+        if FLAGS.loss_scale != 1.0:
+          optimizer = mixed_precision.LossScaleOptimizer(optimizer,
+                                                         FLAGS.loss_scale)
 
         # Set up training.
         train_op = slim.learning.create_train_op(total_loss, optimizer)
@@ -190,9 +332,12 @@ def train():
 def evaluate():
   g = tf.Graph()
   with g.as_default():
-    data_tuple = cifar_data_provider.provide_data(FLAGS.split_name,
-                                                  FLAGS.eval_batch_size,
-                                                  dataset_dir=FLAGS.dataset_dir)
+    data_tuple = cifar_data_provider.provide_data(
+        FLAGS.split_name,
+        FLAGS.eval_batch_size,
+        dataset_dir=FLAGS.dataset_dir,
+        use_tf_data=FLAGS.use_tf_data,
+        in_memory=FLAGS.in_memory_data)
     images, _, one_hot_labels, num_samples, num_classes = data_tuple
 
     # Define the model:
@@ -202,13 +347,27 @@ def evaluate():
           images,
           model=model,
           num_classes=num_classes,
-          model_type=FLAGS.model_type)
+          model_type=FLAGS.model_type,
+          sparse_threshold=FLAGS.sparse_threshold,
+          compact_batch=FLAGS.compact_batch,
+          use_while_loop=FLAGS.use_while_loop,
+          jit_halting=FLAGS.jit_halting,
+          jit_units=FLAGS.jit_units,
+          dtype=tf.as_dtype(FLAGS.precision),
+          halting_head=FLAGS.halting_head,
+          tile_size=utils.split_and_int(FLAGS.tile_size),
+          cross_block_halting=FLAGS.cross_block_halting,
+          sact_early_stopping=FLAGS.sact_early_stopping)
 
       predictions = tf.argmax(logits, 1)
 
       tf.losses.softmax_cross_entropy(
           onehot_labels=one_hot_labels, logits=logits)
-      if FLAGS.model_type in ('act', 'act_early_stopping', 'sact'):
+      if (resnet_act.is_adaptive(FLAGS.model_type) and
+          FLAGS.flops_weighted_ponder_cost):
+        training_utils.add_all_flops_weighted_ponder_costs(
+            end_points, weights=FLAGS.tau)
+      elif resnet_act.is_adaptive(FLAGS.model_type):
         training_utils.add_all_ponder_costs(end_points, weights=FLAGS.tau)
 
       loss = tf.losses.get_total_loss()
@@ -222,7 +381,7 @@ def evaluate():
                 tf.contrib.metrics.streaming_mean(loss),
       }
       metric_map.update(summary_utils.flops_metric_map(end_points, True))
-      if FLAGS.model_type in ('act', 'act_early_stopping', 'sact'):
+      if resnet_act.is_adaptive(FLAGS.model_type):
         metric_map.update(summary_utils.act_metric_map(end_points, True))
       names_to_values, names_to_updates = tf.contrib.metrics.aggregate_metric_map(
           metric_map)
@@ -232,7 +391,7 @@ def evaluate():
         summ = tf.Print(summ, [value], name)
         tf.add_to_collection(tf.GraphKeys.SUMMARIES, summ)
 
-      if FLAGS.model_type == 'sact':
+      if resnet_act.has_sact(FLAGS.model_type):
         summary_utils.add_heatmaps_image_summary(end_points)
 
       # This ensures that we make a single pass over all of the data.
@@ -28,7 +28,9 @@ from tensorflow.contrib import slim
 from tensorflow.contrib.slim.nets import resnet_utils
 
 import flopsometer
+import mixed_precision
 import resnet_act
+import sparse_utils
 
 
 def lrelu(x, leakiness=0.1):
@@ -40,47 +42,107 @@ def residual(inputs,
              stride,
              activate_before_residual,
              residual_mask=None,
+             sparse_threshold=None,
+             return_features=False,
+             realized_flops=None,
              scope=None):
+  """Residual unit.
+
+  If `stride` is greater than one, `residual_mask` has the resolution of the
+  inputs and is downsampled with `sparse_utils.downsample_mask`. In that case
+  the residual branch is evaluated densely.
+
+  If `return_features` is set, also returns the outputs of the first
+  convolution of the residual branch. With `residual_mask`, they are valid
+  only at the active positions.
+
+  If `realized_flops` is a list, the flops actually executed by the unit are
+  appended to it: all the positions if the residual branch is evaluated
+  densely, only the active positions and their halo if it is sparse.
+  """
   with tf.variable_scope(scope, 'residual', [inputs]):
     depth_in = slim.utils.last_dimension(inputs.get_shape(), min_rank=4)
-    preact = slim.batch_norm(inputs, scope='preact')
+    preact = mixed_precision.batch_norm(inputs, scope='preact')
     if activate_before_residual:
       shortcut = preact
     else:
       shortcut = inputs
 
     if residual_mask is not None:
-      # Max-pooling trick only works correctly when stride is 1.
-      # We assume that stride=2 happens in the first layer where
-      # residual_mask is None.
-      assert stride == 1
+      if stride > 1:
+        # The strided conv1 is sparse at the resolution of the outputs, but
+        # sparse_conv2d supports only stride 1.
+        residual_mask = sparse_utils.downsample_mask(residual_mask, stride)
+        sparse_threshold = None
       diluted_residual_mask = slim.max_pool2d(
           residual_mask, [3, 3], stride=1, padding='SAME')
     else:
       diluted_residual_mask = None
 
-    flops = 0
-    conv_output, current_flops = flopsometer.conv2d(
-        preact,
-        depth,
-        3,
-        stride=stride,
-        padding='SAME',
-        output_mask=diluted_residual_mask,
-        scope='conv1')
-    flops += current_flops
-
-    conv_output, current_flops = flopsometer.conv2d(
-        conv_output,
-        depth,
-        3,
-        stride=1,
-        padding='SAME',
-        activation_fn=None,
-        normalizer_fn=None,
-        output_mask=residual_mask,
-        scope='conv2')
-    flops += current_flops
+    def _dense_residual():
+      flops = 0
+      dense_flops = 0
+      conv_output, current_flops, current_dense_flops = flopsometer.conv2d(
+          preact,
+          depth,
+          3,
+          stride=stride,
+          padding='SAME',
+          output_mask=diluted_residual_mask,
+          return_dense_flops=True,
+          scope='conv1')
+      flops += current_flops
+      dense_flops += current_dense_flops
+      features = conv_output
+
+      conv_output, current_flops, current_dense_flops = flopsometer.conv2d(
+          conv_output,
+          depth,
+          3,
+          stride=1,
+          padding='SAME',
+          activation_fn=None,
+          normalizer_fn=None,
+          output_mask=residual_mask,
+          return_dense_flops=True,
+          scope='conv2')
+      flops += current_flops
+      dense_flops += current_dense_flops
+
+      return conv_output, flops, features, dense_flops
+
+    def _sparse_residual():
+      # conv1 is evaluated on the 3x3 halo of the active positions,
+      # conv2 only on the active positions.
+      diluted_positions = sparse_utils.active_positions(diluted_residual_mask)
+      positions = sparse_utils.active_positions(residual_mask)
+
+      flops = 0
+      conv_output, current_flops = flopsometer.sparse_conv2d(
+          preact, diluted_positions, depth, 3, scope='conv1')
+      conv_output = sparse_utils.scatter_positions(
+          conv_output, diluted_positions, preact)
+      flops += current_flops
+      features = conv_output
+
+      conv_output, current_flops = flopsometer.sparse_conv2d(
+          conv_output,
+          positions,
+          depth,
+          3,
+          activation_fn=None,
+          normalizer_fn=None,
+          scope='conv2')
+      conv_output = sparse_utils.scatter_positions(
+          conv_output, positions, preact)
+      flops += current_flops
+
+      return conv_output, flops, features, flops
+
+    conv_output, flops, features, executed_flops = sparse_utils.dense_or_sparse(
+        residual_mask, sparse_threshold, _dense_residual, _sparse_residual)
+    if realized_flops is not None:
+      realized_flops.append(executed_flops)
 
     if depth_in != depth:
       shortcut = slim.avg_pool2d(shortcut, stride, stride, padding='VALID')
@@ -92,6 +154,8 @@ def residual(inputs,
 
     outputs = shortcut + conv_output
 
+    if return_features:
+      return outputs, flops, features
     return outputs, flops
 
 
@@ -100,13 +164,40 @@ def resnet(inputs,
            num_classes,
            model_type='vanilla',
            base_channels=16,
+           sparse_threshold=None,
+           compact_batch=False,
+           use_while_loop=False,
+           jit_halting=False,
+           jit_units=False,
+           recompute_units=False,
+           dtype=tf.float32,
+           halting_head='conv',
+           tile_size=1,
+           cross_block_halting=False,
+           sact_early_stopping=False,
+           return_halting_distribution=False,
+           return_unit_data=False,
            scope='resnet_residual'):
-  """Builds a CIFAR-10 resnet model."""
+  """Builds a CIFAR-10 resnet model.
+
+  `model_type` is the type of all the blocks, or a comma separated list with
+  the type of every block, e.g. 'vanilla,sact,sact', see
+  `resnet_act.parse_model_type`. Similarly, `tile_size` is the size of the
+  halting tiles of all the SACT blocks or a list with the size for every
+  block, see `resnet_act.stack_blocks`.
+
+  If `dtype` is float16, the convolutions and the activations use float16,
+  while the trainable variables are stored in float32 and the halting
+  computations and the logits are float32, see `mixed_precision`.
+  """
+  if dtype != tf.float32 and use_while_loop:
+    raise ValueError('use_while_loop is only supported for float32 models.')
   num_blocks = 3
   num_units = model
   if len(num_units) == 1:
     num_units *= num_blocks
   assert len(num_units) == num_blocks
+  model_types = resnet_act.parse_model_type(model_type, num_blocks)
 
   b = resnet_utils.Block
   bc = base_channels
@@ -119,20 +210,34 @@ def resnet(inputs,
       [(4 * bc, 2, False)] + [(4 * bc, 1, False)] * (num_units[2] - 1))
   ]
 
-  with tf.variable_scope(scope, [inputs]):
+  with tf.variable_scope(
+      scope, [inputs],
+      custom_getter=mixed_precision.get_custom_getter(dtype)):
     end_points = {'inputs': inputs}
     end_points['flops'] = 0
-    net = inputs
+    net = tf.cast(inputs, dtype)
     net, current_flops = flopsometer.conv2d(
         net, bc, 3, activation_fn=None, normalizer_fn=None)
     end_points['flops'] += current_flops
     net, end_points = resnet_act.stack_blocks(
         net,
         blocks,
-        model_type=model_type,
-        end_points=end_points)
+        model_type=model_types,
+        end_points=end_points,
+        sparse_threshold=sparse_threshold,
+        compact_batch=compact_batch,
+        use_while_loop=use_while_loop,
+        jit_halting=jit_halting,
+        jit_units=jit_units,
+        recompute_units=recompute_units,
+        halting_head=halting_head,
+        tile_size=tile_size,
+        cross_block_halting=cross_block_halting,
+        sact_early_stopping=sact_early_stopping,
+        return_halting_distribution=return_halting_distribution,
+        return_unit_data=return_unit_data)
     net = tf.reduce_mean(net, [1, 2], keep_dims=True)
-    net = slim.batch_norm(net)
+    net = mixed_precision.batch_norm(net)
     net, current_flops = flopsometer.conv2d(
         net,
         num_classes, [1, 1],
@@ -141,6 +246,7 @@ def resnet(inputs,
         scope='logits')
     end_points['flops'] += current_flops
     net = tf.squeeze(net, [1, 2], name='SpatialSqueeze')
+    net = tf.to_float(net)
 
     return net, end_points
 
@@ -162,7 +268,7 @@ def resnet_arg_scope(is_training=True):
         [slim.conv2d],
         weights_regularizer=slim.l2_regularizer(0.0002),
         weights_initializer=slim.variance_scaling_initializer(),
-        normalizer_fn=slim.batch_norm,
+        normalizer_fn=mixed_precision.batch_norm,
         normalizer_params=batch_norm_params):
       with slim.arg_scope([slim.batch_norm], **batch_norm_params) as arg_sc:
         return arg_sc
@@ -24,6 +24,7 @@ import tensorflow as tf
 from tensorflow.contrib import slim
 
 import cifar_model
+import resnet_act
 import summary_utils
 import training_utils
 
@@ -45,7 +46,7 @@ class CifarModelTest(tf.test.TestCase):
             num_classes=num_classes,
             model_type=model_type,
             base_channels=1)
-        if model_type in ('act', 'act_early_stopping', 'sact'):
+        if resnet_act.is_adaptive(model_type):
           metrics = summary_utils.act_metric_map(end_points,
               not is_training)
           metrics.update(summary_utils.flops_metric_map(end_points,
@@ -59,7 +60,7 @@ class CifarModelTest(tf.test.TestCase):
           one_hot_labels = slim.one_hot_encoding(labels, num_classes)
           tf.losses.softmax_cross_entropy(
               onehot_labels=one_hot_labels, logits=logits)
-          if model_type in ('act', 'act_early_stopping', 'sact'):
+          if resnet_act.is_adaptive(model_type):
             training_utils.add_all_ponder_costs(end_points, weights=1.0)
           total_loss = tf.losses.get_total_loss()
           optimizer = tf.train.MomentumOptimizer(0.1, 0.9)
@@ -112,6 +113,507 @@ class CifarModelTest(tf.test.TestCase):
         expected_flops = 505775360
         self.assertAllEqual(flops, [expected_flops] * 3)
 
+  def testSparseSact(self):
+    self._runSparseSact(halting_head='conv')
+
+  def testSparseSactBottleneckHead(self):
+    self._runSparseSact(halting_head='bottleneck')
+
+  def testSparseSactSeparableHead(self):
+    self._runSparseSact(halting_head='separable')
+
+  def _runSparseSact(self, halting_head):
+    batch_size = 2
+    height, width = 32, 32
+    num_classes = 10
+
+    with slim.arg_scope(cifar_model.resnet_arg_scope(is_training=False)):
+      with self.test_session() as sess:
+        images = tf.random_uniform((batch_size, height, width, 3))
+        logits, end_points = cifar_model.resnet(
+            images,
+            model=[3],
+            num_classes=num_classes,
+            model_type='sact',
+            base_channels=2,
+            halting_head=halting_head)
+        with tf.variable_scope(tf.get_variable_scope(), reuse=True):
+          sparse_logits, sparse_end_points = cifar_model.resnet(
+              images,
+              model=[3],
+              num_classes=num_classes,
+              model_type='sact',
+              base_channels=2,
+              sparse_threshold=1.0,
+              halting_head=halting_head)
+
+        sess.run(tf.global_variables_initializer())
+        (logits_out, flops_out, sparse_logits_out,
+         sparse_flops_out, block_flops_out) = sess.run(
+             (logits, end_points['flops'], sparse_logits,
+              sparse_end_points['flops'],
+              {name: sparse_end_points[name]
+               for scope in sparse_end_points['sact_block_scopes']
+               for name in ('{}/flops'.format(scope),
+                            '{}/realized_flops'.format(scope))}))
+        self.assertAllClose(logits_out, sparse_logits_out)
+        self.assertAllEqual(flops_out, sparse_flops_out)
+        # Every unit is evaluated at the counted positions only.
+        for scope in sparse_end_points['sact_block_scopes']:
+          self.assertAllEqual(
+              block_flops_out['{}/realized_flops'.format(scope)],
+              block_flops_out['{}/flops'.format(scope)])
+
+  def _graphSize(self, model_type, use_while_loop):
+    g = tf.Graph()
+    with g.as_default():
+      images = tf.random_uniform((2, 32, 32, 3))
+      with slim.arg_scope(cifar_model.resnet_arg_scope(is_training=False)):
+        cifar_model.resnet(
+            images,
+            model=[6],
+            num_classes=10,
+            model_type=model_type,
+            base_channels=2,
+            use_while_loop=use_while_loop)
+    return g.as_graph_def().ByteSize()
+
+  def testWhileLoop(self):
+    batch_size = 2
+    height, width = 32, 32
+    num_classes = 10
+
+    for model_type in ('act_early_stopping', 'sact'):
+      with tf.Graph().as_default() as g:
+        with slim.arg_scope(cifar_model.resnet_arg_scope(is_training=False)):
+          images = tf.random_uniform((batch_size, height, width, 3))
+          logits, end_points = cifar_model.resnet(
+              images,
+              model=[4],
+              num_classes=num_classes,
+              model_type=model_type,
+              base_channels=2)
+          num_variables = len(tf.global_variables())
+          with tf.variable_scope(tf.get_variable_scope(), reuse=True):
+            loop_logits, loop_end_points = cifar_model.resnet(
+                images,
+                model=[4],
+                num_classes=num_classes,
+                model_type=model_type,
+                base_channels=2,
+                use_while_loop=True)
+          self.assertEqual(len(tf.global_variables()), num_variables)
+
+        names = ['flops'] + ['{}/realized_flops'.format(scope)
+                             for scope in end_points['block_scopes']]
+        with self.test_session(graph=g) as sess:
+          sess.run(tf.global_variables_initializer())
+          (logits_out, end_points_out, loop_logits_out,
+           loop_end_points_out) = sess.run(
+               (logits, {name: end_points[name] for name in names},
+                loop_logits, {name: loop_end_points[name] for name in names}))
+          self.assertAllClose(logits_out, loop_logits_out)
+          for name in names:
+            self.assertAllEqual(end_points_out[name],
+                                loop_end_points_out[name])
+
+      self.assertLess(self._graphSize(model_type, True),
+                      self._graphSize(model_type, False))
+
+  def testWhileLoopTrainingRaises(self):
+    with tf.Graph().as_default():
+      images = tf.random_uniform((2, 32, 32, 3))
+      with slim.arg_scope(cifar_model.resnet_arg_scope(is_training=True)):
+        with self.assertRaises(ValueError):
+          cifar_model.resnet(
+              images,
+              model=[4],
+              num_classes=10,
+              model_type='sact',
+              base_channels=2,
+              use_while_loop=True)
+
+  def testRecomputeUnits(self):
+    batch_size = 2
+    height, width = 32, 32
+    num_classes = 10
+
+    for model_type in ('vanilla', 'act', 'sact'):
+      with tf.Graph().as_default() as g:
+        with slim.arg_scope(cifar_model.resnet_arg_scope(is_training=True)):
+          images = tf.random_uniform((batch_size, height, width, 3))
+          logits, end_points = cifar_model.resnet(
+              images,
+              model=[2],
+              num_classes=num_classes,
+              model_type=model_type,
+              base_channels=2)
+          num_update_ops = len(tf.get_collection(tf.GraphKeys.UPDATE_OPS))
+          with tf.variable_scope(tf.get_variable_scope(), reuse=True):
+            recompute_logits, recompute_end_points = cifar_model.resnet(
+                images,
+                model=[2],
+                num_classes=num_classes,
+                model_type=model_type,
+                base_channels=2,
+                recompute_units=True)
+
+        variables = tf.trainable_variables()
+        grads = tf.gradients(tf.reduce_sum(logits), variables)
+        recompute_grads = tf.gradients(
+            tf.reduce_sum(recompute_logits), variables)
+        # The recomputation does not add batch norm updates.
+        self.assertEqual(
+            len(tf.get_collection(tf.GraphKeys.UPDATE_OPS)),
+            2 * num_update_ops)
+
+        with self.test_session(graph=g) as sess:
+          sess.run(tf.global_variables_initializer())
+          (logits_out, flops_out, grads_out, recompute_logits_out,
+           recompute_flops_out, recompute_grads_out) = sess.run(
+               (logits, end_points['flops'], grads, recompute_logits,
+                recompute_end_points['flops'], recompute_grads))
+          self.assertAllClose(logits_out, recompute_logits_out)
+          self.assertAllEqual(flops_out, recompute_flops_out)
+          for (grad_out, recompute_grad_out) in zip(grads_out,
+                                                    recompute_grads_out):
+            self.assertAllClose(grad_out, recompute_grad_out)
+
+  def testTrainPerBlockModelType(self):
+    self._runBatch(is_training=True, model_type='vanilla,sact,sact')
+
+  def testFlopsWeightedPonderCost(self):
+    batch_size = 2
+    height, width = 32, 32
+    num_classes = 10
+
+    with slim.arg_scope(cifar_model.resnet_arg_scope(is_training=True)):
+      with self.test_session() as sess:
+        images = tf.random_uniform((batch_size, height, width, 3))
+        _, end_points = cifar_model.resnet(
+            images,
+            model=[2],
+            num_classes=num_classes,
+            model_type='act',
+            base_channels=1)
+        training_utils.add_all_ponder_costs(end_points, weights=1.0)
+        training_utils.add_all_flops_weighted_ponder_costs(end_points,
+                                                           weights=1.0)
+        (ponder_loss, weighted_ponder_loss) = tf.losses.get_losses()
+        sess.run(tf.global_variables_initializer())
+        # All the objects halt after the first unit of every block, so all
+        # the blocks have the same ponder cost and the normalized weights
+        # average to one.
+        feed_dict = {end_points['{}/eps'.format(scope)]: 0.99
+                     for scope in end_points['act_block_scopes']}
+        (ponder_loss_out, weighted_ponder_loss_out) = sess.run(
+            (ponder_loss, weighted_ponder_loss), feed_dict=feed_dict)
+        self.assertAllClose(ponder_loss_out, 6.)
+        self.assertAllClose(weighted_ponder_loss_out, ponder_loss_out)
+
+  def testAdaptiveTau(self):
+    batch_size = 2
+    height, width = 32, 32
+    num_classes = 10
+
+    with slim.arg_scope(cifar_model.resnet_arg_scope(is_training=True)):
+      with self.test_session() as sess:
+        images = tf.random_uniform((batch_size, height, width, 3))
+        _, end_points = cifar_model.resnet(
+            images,
+            model=[2],
+            num_classes=num_classes,
+            model_type='sact',
+            base_channels=1)
+        with self.assertRaises(ValueError):
+          training_utils.adaptive_tau(end_points, 1.0)
+        with self.assertRaises(ValueError):
+          training_utils.adaptive_tau(end_points, 0.0, target_flops=1e12)
+        # The model is below the budget, so tau decreases.
+        tau = training_utils.adaptive_tau(
+            end_points, 1.0, target_flops=1e12, rate=0.1)
+        update_ops = tf.get_collection(tf.GraphKeys.UPDATE_OPS)
+        sess.run(tf.global_variables_initializer())
+        self.assertAllClose(sess.run(tau), 1.0)
+        sess.run(update_ops)
+        self.assertLess(sess.run(tau), 1.0)
+
+  def testRealizedFlops(self):
+    batch_size = 2
+    height, width = 32, 32
+    num_classes = 10
+
+    with slim.arg_scope(cifar_model.resnet_arg_scope(is_training=False)):
+      with self.test_session() as sess:
+        images = tf.random_uniform((batch_size, height, width, 3))
+        _, end_points = cifar_model.resnet(
+            images,
+            model=[3],
+            num_classes=num_classes,
+            model_type='act_early_stopping,act,sact',
+            base_channels=2)
+        metrics = summary_utils.flops_metric_map(end_points, False)
+        self.assertIn('Total Flops Realized/mean', metrics)
+        sess.run(tf.global_variables_initializer())
+        names = ['{}/{}'.format(scope, name)
+                 for scope in end_points['block_scopes']
+                 for name in ('flops', 'realized_flops')]
+
+        def _run(eps):
+          feed_dict = {end_points['{}/eps'.format(scope)]: eps
+                       for scope in end_points['act_block_scopes']}
+          return sess.run({name: end_points[name] for name in names},
+                          feed_dict=feed_dict)
+
+        # All the objects and positions halt after the first unit.
+        end_points_out = _run(0.99)
+        # No object or position halts before the last unit, so the counted
+        # flops are the sums of the flops of all the units evaluated densely.
+        dense_end_points_out = _run(-1.)
+        self.assertAllEqual(end_points_out['block_1/realized_flops'],
+                            end_points_out['block_1/flops'])
+        self.assertAllEqual(dense_end_points_out['block_1/realized_flops'],
+                            dense_end_points_out['block_1/flops'])
+        # All the units are executed.
+        for scope in ('block_2', 'block_3'):
+          for out in (end_points_out, dense_end_points_out):
+            self.assertAllEqual(
+                out['{}/realized_flops'.format(scope)],
+                dense_end_points_out['{}/flops'.format(scope)])
+          self.assertTrue(np.all(
+              end_points_out['{}/flops'.format(scope)] <
+              end_points_out['{}/realized_flops'.format(scope)]))
+
+  def testResidualRealizedFlops(self):
+    inputs = tf.random_uniform((1, 8, 8, 4))
+    # A single active position, i.e. 1/64 of the positions.
+    mask = np.zeros([1, 8, 8, 1], dtype=np.float32)
+    mask[0, 4, 4, 0] = 1.
+    residual_mask = tf.constant(mask)
+
+    with slim.arg_scope(cifar_model.resnet_arg_scope(is_training=False)):
+      _, dense_flops = cifar_model.residual(
+          inputs, 4, 1, False, scope='residual')
+      flops = {}
+      realized_flops = {}
+      for sparse_threshold in (1e-3, 0.5):
+        unit_realized_flops = []
+        with tf.variable_scope(tf.get_variable_scope(), reuse=True):
+          _, flops[sparse_threshold] = cifar_model.residual(
+              inputs, 4, 1, False, residual_mask=residual_mask,
+              sparse_threshold=sparse_threshold,
+              realized_flops=unit_realized_flops, scope='residual')
+        self.assertEqual(len(unit_realized_flops), 1)
+        realized_flops[sparse_threshold] = unit_realized_flops[0]
+
+    with self.test_session() as sess:
+      sess.run(tf.global_variables_initializer())
+      (dense_flops_out, flops_out, realized_flops_out) = sess.run(
+          (dense_flops, flops, realized_flops))
+    self.assertAllEqual(flops_out[1e-3], flops_out[0.5])
+    self.assertTrue(np.all(flops_out[0.5] < dense_flops_out))
+    # Above the threshold, the residual branch is evaluated densely.
+    self.assertAllEqual(realized_flops_out[1e-3], dense_flops_out)
+    # Below the threshold, only at the active position and its halo.
+    self.assertAllEqual(realized_flops_out[0.5], flops_out[0.5])
+
+  def testPerBlockModelType(self):
+    batch_size = 2
+    height, width = 32, 32
+    num_classes = 10
+
+    with slim.arg_scope(cifar_model.resnet_arg_scope(is_training=False)):
+      with self.test_session() as sess:
+        images = tf.random_uniform((batch_size, height, width, 3))
+        _, end_points = cifar_model.resnet(
+            images,
+            model=[2],
+            num_classes=num_classes,
+            model_type='vanilla,sact,sact',
+            base_channels=1)
+        self.assertEqual(end_points['act_block_scopes'],
+                         ['block_2', 'block_3'])
+        self.assertEqual(end_points['sact_block_scopes'],
+                         ['block_2', 'block_3'])
+        self.assertNotIn('block_1/ponder_cost', end_points)
+
+        metrics = summary_utils.act_metric_map(end_points, False)
+        self.assertFalse(
+            [name for name in metrics if name.startswith('block_1/')])
+        sess.run(tf.global_variables_initializer())
+        (flops_out, ponder_map_out) = sess.run(
+            (end_points['block_1/flops'],
+             summary_utils.sact_map(end_points, 'ponder_cost')))
+        # The vanilla block evaluates all of its units.
+        self.assertAllEqual(flops_out, [flops_out[0]] * batch_size)
+        self.assertEqual(ponder_map_out.shape, (batch_size, height, width, 1))
+
+  def testTileSact(self):
+    batch_size = 2
+    height, width = 32, 32
+    num_classes = 10
+
+    with slim.arg_scope(cifar_model.resnet_arg_scope(is_training=False)):
+      with self.test_session() as sess:
+        images = tf.random_uniform((batch_size, height, width, 3))
+        _, end_points = cifar_model.resnet(
+            images,
+            model=[3],
+            num_classes=num_classes,
+            model_type='sact',
+            base_channels=2,
+            tile_size=[1, 4, 2])
+        self.assertNotIn('block_1/tile_flops', end_points)
+        # The halting distributions are not requested.
+        self.assertNotIn('block_2/halting_distribution', end_points)
+        metrics = summary_utils.flops_metric_map(end_points, False)
+        self.assertIn('Total Flops Rounded to Tiles/mean', metrics)
+        sess.run(tf.global_variables_initializer())
+        (num_units_out, flops_out, tile_flops_out) = sess.run(
+            (end_points['block_2/num_units'], end_points['block_2/flops'],
+             end_points['block_2/tile_flops']))
+        # The halting is the same in every 4x4 tile.
+        for y in range(0, 16, 4):
+          for x in range(0, 16, 4):
+            tile = num_units_out[:, y:y + 4, x:x + 4]
+            self.assertAllEqual(tile, np.broadcast_to(
+                tile[:, :1, :1], tile.shape))
+        # The tiles cover the 16x16 map exactly.
+        self.assertAllEqual(tile_flops_out, flops_out)
+
+  def testCrossBlockHalting(self):
+    batch_size = 2
+    height, width = 32, 32
+    num_classes = 10
+
+    with slim.arg_scope(cifar_model.resnet_arg_scope(is_training=False)):
+      with self.test_session() as sess:
+        images = tf.random_uniform((batch_size, height, width, 3))
+        _, end_points = cifar_model.resnet(
+            images,
+            model=[2],
+            num_classes=num_classes,
+            model_type='sact',
+            base_channels=2)
+        with tf.variable_scope(tf.get_variable_scope(), reuse=True):
+          _, cross_end_points = cifar_model.resnet(
+              images,
+              model=[2],
+              num_classes=num_classes,
+              model_type='sact',
+              base_channels=2,
+              cross_block_halting=True)
+        sess.run(tf.global_variables_initializer())
+        # All the positions of block_1 halt after the first unit.
+        feed_dict = {end_points['block_1/eps']: 0.99,
+                     cross_end_points['block_1/eps']: 0.99}
+        (flops_out, cross_flops_out) = sess.run(
+            (end_points['block_2/flops'], cross_end_points['block_2/flops']),
+            feed_dict=feed_dict)
+        self.assertTrue(np.all(cross_flops_out < flops_out))
+
+  def testSactEarlyStopping(self):
+    batch_size = 2
+    height, width = 32, 32
+    num_classes = 10
+
+    with slim.arg_scope(cifar_model.resnet_arg_scope(is_training=False)):
+      with self.test_session() as sess:
+        images = tf.random_uniform((batch_size, height, width, 3))
+        logits, end_points = cifar_model.resnet(
+            images,
+            model=[3],
+            num_classes=num_classes,
+            model_type='sact',
+            base_channels=2)
+        with tf.variable_scope(tf.get_variable_scope(), reuse=True):
+          early_logits, early_end_points = cifar_model.resnet(
+              images,
+              model=[3],
+              num_classes=num_classes,
+              model_type='sact',
+              base_channels=2,
+              sact_early_stopping=True)
+        sess.run(tf.global_variables_initializer())
+        # All the positions halt after the first unit of every block.
+        feed_dict = {}
+        for block_scope in end_points['sact_block_scopes']:
+          eps_name = '{}/eps'.format(block_scope)
+          feed_dict[end_points[eps_name]] = 0.99
+          feed_dict[early_end_points[eps_name]] = 0.99
+        (logits_out, early_logits_out, num_units_out, early_num_units_out,
+         flops_out, early_flops_out) = sess.run(
+             (logits, early_logits, end_points['block_3/num_units'],
+              early_end_points['block_3/num_units'], end_points['flops'],
+              early_end_points['flops']),
+             feed_dict=feed_dict)
+        self.assertAllClose(logits_out, early_logits_out)
+        self.assertAllEqual(num_units_out, early_num_units_out)
+        self.assertAllEqual(flops_out, early_flops_out)
+
+  def testMixedPrecision(self):
+    batch_size = 2
+    height, width = 32, 32
+    num_classes = 10
+
+    with slim.arg_scope(cifar_model.resnet_arg_scope(is_training=False)):
+      with self.test_session() as sess:
+        images = tf.random_uniform((batch_size, height, width, 3))
+        logits, end_points = cifar_model.resnet(
+            images,
+            model=[3],
+            num_classes=num_classes,
+            model_type='sact',
+            base_channels=2)
+        num_variables = len(tf.global_variables())
+        with tf.variable_scope(tf.get_variable_scope(), reuse=True):
+          half_logits, half_end_points = cifar_model.resnet(
+              images,
+              model=[3],
+              num_classes=num_classes,
+              model_type='sact',
+              base_channels=2,
+              dtype=tf.float16)
+        # The float32 variables are shared.
+        self.assertEqual(len(tf.global_variables()), num_variables)
+        self.assertEqual(half_logits.dtype, tf.float32)
+
+        names = ['{}/{}'.format(block_scope, name)
+                 for block_scope in end_points['block_scopes']
+                 for name in ('num_units', 'ponder_cost')]
+        sess.run(tf.global_variables_initializer())
+        # The untrained halting heads never halt before the last unit. The
+        # biases of the local halting logits make all the positions of
+        # block_2 halt at the first unit and the ones of block_3 at the
+        # second unit, far from the threshold.
+        halting_biases = {
+            'block_2/unit_1': 10.,
+            'block_3/unit_1': -10.,
+            'block_3/unit_2': 10.,
+        }
+        variables = {v.op.name: v for v in tf.global_variables()}
+        for (unit_scope, bias) in halting_biases.items():
+          variable = variables[
+              'resnet_residual/{}/halting_proba/local_conv/biases'.format(
+                  unit_scope)]
+          sess.run(variable.assign([bias]))
+        (values, half_values) = sess.run(
+            ([logits, end_points['flops']] + [end_points[n] for n in names],
+             [half_logits, half_end_points['flops']] +
+             [half_end_points[n] for n in names]))
+        self.assertAllClose(values[0], half_values[0], atol=1e-2)
+        # The halting decisions are the same as in float32.
+        self.assertAllEqual(values[1], half_values[1])
+        for (name, value, half_value) in zip(names, values[2:],
+                                             half_values[2:]):
+          if name.endswith('num_units'):
+            expected_num_units = {'block_1': 3, 'block_2': 1, 'block_3': 2}
+            self.assertAllEqual(
+                value, np.full(value.shape, expected_num_units[name[:7]]))
+            self.assertAllEqual(value, half_value)
+          else:
+            self.assertAllClose(value, half_value, atol=1e-2)
+
   def testVisualizationBasic(self):
     batch_size = 3
     height, width = 32, 32
@@ -0,0 +1,106 @@
+# Copyright 2016 Google Inc. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# ==============================================================================
+
+"""Tests for external/download_and_convert_cifar10.
+
+Converts a small fake CIFAR-10 tarball and reads the records back with
+datasets_cifar10. Requires `external` in the PYTHONPATH.
+"""
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import cPickle
+import os
+import tarfile
+import tempfile
+
+import numpy as np
+import tensorflow as tf
+
+from external import datasets_cifar10
+import download_and_convert_cifar10
+
+
+class DownloadAndConvertCifar10Test(tf.test.TestCase):
+
+  def setUp(self):
+    super(DownloadAndConvertCifar10Test, self).setUp()
+    num_images = 5
+    rng = np.random.RandomState(0)
+    self._data = {
+        'data': rng.randint(256, size=(num_images, 3 * 32 * 32)).astype(
+            np.uint8),
+        'labels': list(rng.randint(10, size=num_images)),
+    }
+    temp_dir = tempfile.mkdtemp(dir=self.get_temp_dir())
+    pickle_path = os.path.join(temp_dir, 'test_batch')
+    with open(pickle_path, 'wb') as f:
+      cPickle.dump(self._data, f)
+    self._tarball = os.path.join(temp_dir, 'cifar-10-python.tar.gz')
+    with tarfile.open(self._tarball, 'w:gz') as tar:
+      tar.add(pickle_path,
+              arcname=os.path.join(download_and_convert_cifar10._TARBALL_DIR,
+                                   'test_batch'))
+
+  def _testRoundTrip(self, image_format, num_shards):
+    dataset_dir = tempfile.mkdtemp(dir=self.get_temp_dir())
+    examples = download_and_convert_cifar10._convert_data_file(
+        (self._tarball,
+         os.path.join(download_and_convert_cifar10._TARBALL_DIR,
+                      'test_batch'),
+         image_format))
+    download_and_convert_cifar10._write_shards(examples, dataset_dir, 'test',
+                                               image_format, num_shards)
+
+    # The format of the images is detected from the filenames.
+    dataset = datasets_cifar10.get_split('test', dataset_dir)
+    filenames = sorted(tf.gfile.Glob(dataset.data_sources))
+    self.assertEqual(len(filenames), num_shards)
+    self.assertEqual(image_format == 'raw',
+                     os.path.basename(filenames[0]).startswith('cifar10_raw_'))
+
+    serialized = tf.placeholder(tf.string, [])
+    image, label = dataset.decoder.decode(serialized, ['image', 'label'])
+    images, labels = [], []
+    with self.test_session() as sess:
+      for filename in filenames:
+        for record in tf.python_io.tf_record_iterator(filename):
+          image_out, label_out = sess.run([image, label],
+                                          feed_dict={serialized: record})
+          images.append(image_out)
+          labels.append(label_out)
+
+    expected_images = self._data['data'].reshape(
+        (-1, 3, 32, 32)).transpose((0, 2, 3, 1))
+    self.assertAllEqual(np.stack(images), expected_images)
+    self.assertAllEqual(labels, self._data['labels'])
+
+  def testPng(self):
+    self._testRoundTrip('png', 1)
+
+  def testRaw(self):
+    self._testRoundTrip('raw', 1)
+
+  def testPngSharded(self):
+    self._testRoundTrip('png', 2)
+
+  def testRawSharded(self):
+    self._testRoundTrip('raw', 3)
+
+
+if __name__ == '__main__':
+  tf.test.main()
@@ -0,0 +1,352 @@
+# Copyright 2016 The TensorFlow Authors. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# ==============================================================================
+r"""Converts a local copy of ImageNet to sharded TFRecords of TF-Example protos.
+
+Reads the JPEG images of the ILSVRC 2012 train and validation sets and the
+bounding box annotations in the Pascal VOC XML format, and writes the
+`train-?????-of-?????` and `validation-?????-of-?????` shards, and the
+`labels.txt` file, read by `datasets_imagenet.get_split`. The shards are
+written in parallel by a pool of processes. Nothing is downloaded.
+
+The images of a split are expected in a subdirectory per synset, e.g.
+`train/n01440764/n01440764_10026.JPEG`. Alternatively, the validation images
+can all be in one directory, with --validation_labels_file listing the synset
+of every image in the sorted order of the filenames.
+
+The synsets are numbered from 1 in the order of --synsets_file (by default,
+sorted order of the training subdirectories); 0 is the background class.
+The images which are not RGB JPEGs or, with --max_side, whose larger side
+exceeds this value are re-encoded as RGB JPEGs.
+
+Usage:
+PYTHONPATH=external python external/build_imagenet_data.py \
+    --train_directory=/data/ILSVRC2012/train \
+    --validation_directory=/data/ILSVRC2012/validation \
+    --bounding_box_directory=/data/ILSVRC2012/bounding_boxes \
+    --metadata_file=/data/ILSVRC2012/imagenet_metadata.txt \
+    --output_directory="${HOME}/tensorflow/imagenet"
+
+Based on https://github.com/tensorflow/models/blob/master/inception/inception/data/build_imagenet_data.py
+"""
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import multiprocessing
+import os
+import random
+import StringIO
+from xml.etree import ElementTree
+
+import numpy as np
+from PIL import Image
+import tensorflow as tf
+
+import dataset_utils
+
+FLAGS = tf.app.flags.FLAGS
+
+tf.app.flags.DEFINE_string(
+    'train_directory', None, 'The directory with the training images.')
+
+tf.app.flags.DEFINE_string(
+    'validation_directory', None, 'The directory with the validation images.')
+
+tf.app.flags.DEFINE_string(
+    'validation_labels_file', None,
+    'If set, the validation images are all in --validation_directory and this '
+    'file contains the synset of every image, one per line, in the sorted '
+    'order of the filenames.')
+
+tf.app.flags.DEFINE_string(
+    'bounding_box_directory', None,
+    'The directory, searched recursively, with the XML bounding box '
+    'annotations. Optional.')
+
+tf.app.flags.DEFINE_string(
+    'synsets_file', None,
+    'A file with the 1000 synsets, one per line, in the order of the labels. '
+    'Defaults to the sorted subdirectories of --train_directory.')
+
+tf.app.flags.DEFINE_string(
+    'metadata_file', None,
+    'A file with the human readable names of the synsets: a synset and its '
+    'name separated by a tab on every line. If not set, the synsets are used '
+    'as names.')
+
+tf.app.flags.DEFINE_string(
+    'output_directory', None, 'The directory where the shards are written.')
+
+tf.app.flags.DEFINE_integer(
+    'train_shards', 1024, 'The number of shards of the training set.')
+
+tf.app.flags.DEFINE_integer(
+    'validation_shards', 128, 'The number of shards of the validation set.')
+
+tf.app.flags.DEFINE_integer(
+    'num_processes', multiprocessing.cpu_count(),
+    'The number of processes which write the shards in parallel.')
+
+tf.app.flags.DEFINE_integer(
+    'max_side', 0,
+    'If positive, the images with a larger side are downscaled to this size '
+    'and re-encoded.')
+
+tf.app.flags.DEFINE_integer(
+    'jpeg_quality', 95, 'The quality of the re-encoded JPEG images.')
+
+
+def _float_feature(values):
+  """Returns a TF-Feature of floats."""
+  return tf.train.Feature(float_list=tf.train.FloatList(value=values))
+
+
+def _read_bounding_boxes(bounding_box_directory):
+  """Reads the bounding boxes of all the XML files in a directory tree.
+
+  Args:
+    bounding_box_directory: The directory with the XML annotations.
+
+  Returns:
+    A dict from the image name without the extension to the list of its
+    bounding boxes [xmin, ymin, xmax, ymax], relative to the image size.
+  """
+  bounding_boxes = {}
+  for root, _, filenames in os.walk(bounding_box_directory):
+    for filename in filenames:
+      if not filename.endswith('.xml'):
+        continue
+      annotation = ElementTree.parse(os.path.join(root, filename)).getroot()
+      width = float(annotation.find('size/width').text)
+      height = float(annotation.find('size/height').text)
+      boxes = []
+      for bndbox in annotation.findall('object/bndbox'):
+        xmin, ymin, xmax, ymax = [
+            float(bndbox.find(name).text)
+            for name in ('xmin', 'ymin', 'xmax', 'ymax')]
+        box = [xmin / width, ymin / height, xmax / width, ymax / height]
+        box = [min(max(x, 0.), 1.) for x in box]
+        if box[0] < box[2] and box[1] < box[3]:
+          boxes.append(box)
+      if boxes:
+        bounding_boxes[os.path.splitext(filename)[0]] = boxes
+  return bounding_boxes
+
+
+def _read_synset_names(synsets, metadata_file):
+  """Returns a dict from every synset to its human readable name."""
+  names = dict((synset, synset) for synset in synsets)
+  if metadata_file:
+    with tf.gfile.Open(metadata_file) as f:
+      for line in f:
+        parts = line.strip().split('\t')
+        if len(parts) == 2 and parts[0] in names:
+          names[parts[0]] = parts[1]
+  return names
+
+
+def _find_image_files(directory, synsets, labels_file=None):
+  """Lists the images of a split with their synsets.
+
+  Args:
+    directory: The directory with the images of the split.
+    synsets: The list of the synsets.
+    labels_file: If set, a file with the synset of every image of the flat
+      `directory`, in the sorted order of the filenames.
+
+  Returns:
+    A list of (filename, synset) tuples.
+
+  Raises:
+    ValueError: if the labels file does not match the images.
+  """
+  if labels_file:
+    filenames = sorted(tf.gfile.Glob(os.path.join(directory, '*.JPEG')))
+    with tf.gfile.Open(labels_file) as f:
+      image_synsets = [line.strip() for line in f if line.strip()]
+    if len(image_synsets) != len(filenames):
+      raise ValueError('%s has %d labels for %d images.' % (
+          labels_file, len(image_synsets), len(filenames)))
+    return zip(filenames, image_synsets)
+
+  image_files = []
+  for synset in synsets:
+    filenames = tf.gfile.Glob(os.path.join(directory, synset, '*.JPEG'))
+    image_files.extend((filename, synset) for filename in sorted(filenames))
+  return image_files
+
+
+def _read_image(filename, max_side, jpeg_quality):
+  """Reads an image, re-encoding it as an RGB JPEG if needed.
+
+  Args:
+    filename: The path of the image.
+    max_side: If positive, the maximum size of the larger side of the image.
+    jpeg_quality: The quality of the re-encoded images.
+
+  Returns:
+    image_buffer: The JPEG-encoded image.
+    height: The height of the image.
+    width: The width of the image.
+  """
+  with tf.gfile.Open(filename, 'rb') as f:
+    image_buffer = f.read()
+  image = Image.open(StringIO.StringIO(image_buffer))
+  width, height = image.size
+  downscale = max_side > 0 and max(width, height) > max_side
+  # A few ImageNet images are PNG or CMYK JPEG files.
+  if image.format != 'JPEG' or image.mode != 'RGB' or downscale:
+    image = image.convert('RGB')
+    if downscale:
+      scale = max_side / max(width, height)
+      width = max(1, int(round(width * scale)))
+      height = max(1, int(round(height * scale)))
+      image = image.resize((width, height), Image.ANTIALIAS)
+    output = StringIO.StringIO()
+    image.save(output, format='JPEG', quality=jpeg_quality)
+    image_buffer = output.getvalue()
+  return image_buffer, height, width
+
+
+def _convert_to_example(filename, image_buffer, label, synset, human,
+                        bounding_boxes, height, width):
+  """Builds a TF-Example proto with the fields read by datasets_imagenet."""
+  xmin, ymin, xmax, ymax = [[box[i] for box in bounding_boxes]
+                            for i in range(4)]
+  return tf.train.Example(features=tf.train.Features(feature={
+      'image/height': dataset_utils.int64_feature(height),
+      'image/width': dataset_utils.int64_feature(width),
+      'image/colorspace': dataset_utils.bytes_feature('RGB'),
+      'image/channels': dataset_utils.int64_feature(3),
+      'image/class/label': dataset_utils.int64_feature(label),
+      'image/class/synset': dataset_utils.bytes_feature(synset),
+      'image/class/text': dataset_utils.bytes_feature(human),
+      'image/object/bbox/xmin': _float_feature(xmin),
+      'image/object/bbox/ymin': _float_feature(ymin),
+      'image/object/bbox/xmax': _float_feature(xmax),
+      'image/object/bbox/ymax': _float_feature(ymax),
+      'image/object/class/label': dataset_utils.int64_feature(
+          [label] * len(bounding_boxes)),
+      'image/format': dataset_utils.bytes_feature('jpeg'),
+      'image/filename': dataset_utils.bytes_feature(
+          os.path.basename(filename)),
+      'image/encoded': dataset_utils.bytes_feature(image_buffer),
+  }))
+
+
+def _write_shard(args):
+  """Writes one shard.
+
+  Args:
+    args: A tuple with the path of the shard, the list of its images as
+      (filename, label, synset, human, bounding_boxes) tuples, the maximum
+      side and the JPEG quality of the re-encoded images.
+
+  Returns:
+    The number of written images.
+  """
+  output_filename, images, max_side, jpeg_quality = args
+  with tf.python_io.TFRecordWriter(output_filename) as writer:
+    for filename, label, synset, human, bounding_boxes in images:
+      image_buffer, height, width = _read_image(filename, max_side,
+                                                jpeg_quality)
+      example = _convert_to_example(filename, image_buffer, label, synset,
+                                    human, bounding_boxes, height, width)
+      writer.write(example.SerializeToString())
+  print('>> Wrote %d images to %s' % (len(images), output_filename))
+  return len(images)
+
+
+def _process_split(split_name, image_files, num_shards, labels, names,
+                   bounding_boxes, pool):
+  """Writes the balanced shards of a split in parallel.
+
+  The images are shuffled with a fixed seed, so that every shard has about
+  the same number of images and a mix of all the classes.
+
+  Args:
+    split_name: Either 'train' or 'validation'.
+    image_files: A list of (filename, synset) tuples.
+    num_shards: The number of shards.
+    labels: A dict from the synsets to the labels.
+    names: A dict from the synsets to the human readable names.
+    bounding_boxes: A dict from the image names to their bounding boxes.
+    pool: The `multiprocessing.Pool` which writes the shards.
+  """
+  image_files = list(image_files)
+  random.Random(12345).shuffle(image_files)
+  images = [
+      (filename, labels[synset], synset, names[synset],
+       bounding_boxes.get(os.path.splitext(os.path.basename(filename))[0],
+                          []))
+      for filename, synset in image_files]
+
+  shards = []
+  for shard, indices in enumerate(
+      np.array_split(np.arange(len(images)), num_shards)):
+    output_filename = os.path.join(
+        FLAGS.output_directory,
+        '%s-%05d-of-%05d' % (split_name, shard, num_shards))
+    shards.append((output_filename, [images[i] for i in indices],
+                   FLAGS.max_side, FLAGS.jpeg_quality))
+  num_images = sum(pool.map(_write_shard, shards, chunksize=1))
+  print('Finished writing %d %s images.' % (num_images, split_name))
+
+
+def main(_):
+  if not FLAGS.synsets_file and not FLAGS.train_directory:
+    raise ValueError('Either --synsets_file or --train_directory is required.')
+
+  if not tf.gfile.Exists(FLAGS.output_directory):
+    tf.gfile.MakeDirs(FLAGS.output_directory)
+
+  if FLAGS.synsets_file:
+    with tf.gfile.Open(FLAGS.synsets_file) as f:
+      synsets = [line.strip() for line in f if line.strip()]
+  else:
+    synsets = sorted(tf.gfile.ListDirectory(FLAGS.train_directory))
+  labels = dict((synset, i + 1) for i, synset in enumerate(synsets))
+  names = _read_synset_names(synsets, FLAGS.metadata_file)
+
+  # Writing the labels file avoids downloading the names in get_split.
+  labels_to_names = {0: 'background'}
+  for synset in synsets:
+    labels_to_names[labels[synset]] = names[synset]
+  dataset_utils.write_label_file(labels_to_names, FLAGS.output_directory)
+
+  bounding_boxes = {}
+  if FLAGS.bounding_box_directory:
+    bounding_boxes = _read_bounding_boxes(FLAGS.bounding_box_directory)
+    print('Read the bounding boxes of %d images.' % len(bounding_boxes))
+
+  pool = multiprocessing.Pool(FLAGS.num_processes)
+  try:
+    if FLAGS.validation_directory:
+      _process_split(
+          'validation',
+          _find_image_files(FLAGS.validation_directory, synsets,
+                            FLAGS.validation_labels_file),
+          FLAGS.validation_shards, labels, names, bounding_boxes, pool)
+    if FLAGS.train_directory:
+      _process_split(
+          'train', _find_image_files(FLAGS.train_directory, synsets),
+          FLAGS.train_shards, labels, names, bounding_boxes, pool)
+  finally:
+    pool.close()
+    pool.join()
+
+
+if __name__ == '__main__':
+  tf.app.run()
@@ -31,7 +31,11 @@ from . import dataset_utils
 
 slim = tf.contrib.slim
 
-_FILE_PATTERN = 'cifar10_%s.tfrecord'
+_FILE_PATTERN = 'cifar10_%s.tfrecord*'
+
+_RAW_FILE_PATTERN = 'cifar10_raw_%s.tfrecord*'
+
+_IMAGE_SHAPE = [32, 32, 3]
 
 SPLITS_TO_SIZES = {'train': 50000, 'test': 10000}
 
@@ -43,7 +47,14 @@ _ITEMS_TO_DESCRIPTIONS = {
 }
 
 
-def get_split(split_name, dataset_dir, file_pattern=None, reader=None):
+def _decode_raw_image(keys_to_tensors):
+  """Decodes an image stored as raw uint8 pixels."""
+  image = tf.decode_raw(keys_to_tensors['image/encoded'], tf.uint8)
+  return tf.reshape(image, _IMAGE_SHAPE)
+
+
+def get_split(split_name, dataset_dir, file_pattern=None, reader=None,
+              raw_images=None):
   """Gets a dataset tuple with instructions for reading cifar10.
 
   Args:
@@ -53,6 +64,10 @@ def get_split(split_name, dataset_dir, file_pattern=None, reader=None):
       It is assumed that the pattern contains a '%s' string so that the split
       name can be inserted.
     reader: The TensorFlow reader type.
+    raw_images: Whether the images are stored as raw uint8 pixels instead of
+      PNG-encoded. If None, raw images are read if `dataset_dir` contains
+      files written by download_and_convert_cifar10.py with
+      --image_format=raw.
 
   Returns:
     A `Dataset` namedtuple.
@@ -63,8 +78,12 @@ def get_split(split_name, dataset_dir, file_pattern=None, reader=None):
   if split_name not in SPLITS_TO_SIZES:
     raise ValueError('split name %s was not recognized.' % split_name)
 
+  if raw_images is None:
+    raw_images = bool(tf.gfile.Glob(
+        os.path.join(dataset_dir, _RAW_FILE_PATTERN % split_name)))
+
   if not file_pattern:
-    file_pattern = _FILE_PATTERN
+    file_pattern = _RAW_FILE_PATTERN if raw_images else _FILE_PATTERN
   file_pattern = os.path.join(dataset_dir, file_pattern % split_name)
 
   # Allowing None in the signature so that dataset_factory can use the default.
@@ -78,8 +97,14 @@ def get_split(split_name, dataset_dir, file_pattern=None, reader=None):
           [], tf.int64, default_value=tf.zeros([], dtype=tf.int64)),
   }
 
+  if raw_images:
+    image_handler = slim.tfexample_decoder.ItemHandlerCallback(
+        ['image/encoded'], _decode_raw_image)
+  else:
+    image_handler = slim.tfexample_decoder.Image(shape=_IMAGE_SHAPE)
+
   items_to_handlers = {
-      'image': slim.tfexample_decoder.Image(shape=[32, 32, 3]),
+      'image': image_handler,
       'label': slim.tfexample_decoder.Tensor('image/class/label'),
   }
 
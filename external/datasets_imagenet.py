@@ -52,6 +52,7 @@ _SPLITS_TO_SIZES = {
 
 _ITEMS_TO_DESCRIPTIONS = {
     'image': 'A color image of varying height and width.',
+    'image/encoded': 'The encoded image.',
     'label': 'The label id of the image, integer between 0 and 999',
     'label_text': 'The text of the label.',
     'object/bbox': 'A list of bounding boxes.',
@@ -168,6 +169,7 @@ def get_split(split_name, dataset_dir, file_pattern=None, reader=None):
 
   items_to_handlers = {
       'image': slim.tfexample_decoder.Image('image/encoded', 'image/format'),
+      'image/encoded': slim.tfexample_decoder.Tensor('image/encoded'),
       'label': slim.tfexample_decoder.Tensor('image/class/label'),
       'label_text': slim.tfexample_decoder.Tensor('image/class/text'),
       'object/bbox': slim.tfexample_decoder.BoundingBox(
@@ -14,12 +14,15 @@
 # ==============================================================================
 r"""Downloads and converts cifar10 data to TFRecords of TF-Example protos.
 
-This module downloads the cifar10 data, uncompresses it, reads the files
-that make up the cifar10 data and creates two TFRecord datasets: one for train
-and one for test. Each TFRecord dataset is comprised of a set of TF-Example
-protocol buffers, each of which contain a single image and label.
+This module downloads the cifar10 data, or reads an already downloaded
+tarball, reads the files that make up the cifar10 data and creates two
+TFRecord datasets: one for train and one for test. Each TFRecord dataset is
+comprised of a set of TF-Example protocol buffers, each of which contain a
+single image and label. The images are stored either PNG-encoded or as raw
+uint8 pixels, which the readers do not need to decode, and every dataset can
+be split into several shards.
 
-The script should take several minutes to run.
+The data files are converted in parallel, one process per file.
 
 Copied from https://github.com/tensorflow/models/blob/master/slim/datasets/download_and_convert_cifar10.py
 """
@@ -28,6 +31,7 @@ from __future__ import division
 from __future__ import print_function
 
 import cPickle
+import multiprocessing
 import os
 import sys
 import tarfile
@@ -45,9 +49,30 @@ tf.app.flags.DEFINE_string(
     None,
     'The directory where the output TFRecords and temporary files are saved.')
 
+tf.app.flags.DEFINE_string(
+    'tarball',
+    None,
+    'An already downloaded cifar-10-python.tar.gz. If not set, the tarball is '
+    'downloaded to --dataset_dir.')
+
+tf.app.flags.DEFINE_string(
+    'image_format', 'png',
+    'Either "png" or "raw" (uncompressed uint8 pixels, which are larger but '
+    'faster to read).')
+
+tf.app.flags.DEFINE_integer(
+    'num_shards', 1, 'The number of output files of every split.')
+
+tf.app.flags.DEFINE_integer(
+    'num_processes', 6,
+    'The number of processes which convert the data files in parallel.')
+
 # The URL where the CIFAR data can be downloaded.
 _DATA_URL = 'https://www.cs.toronto.edu/~kriz/cifar-10-python.tar.gz'
 
+# The directory of the data files inside the tarball.
+_TARBALL_DIR = 'cifar-10-batches-py'
+
 # The number of training files.
 _NUM_TRAIN_FILES = 5
 
@@ -69,68 +94,91 @@ _CLASS_NAMES = [
 ]
 
 
-def _add_to_tfrecord(filename, tfrecord_writer, offset=0):
-  """Loads data from the cifar10 pickle files and writes files to a TFRecord.
+def _convert_data_file(args):
+  """Loads a cifar10 pickle file from the tarball and converts its examples.
 
   Args:
-    filename: The filename of the cifar10 pickle file.
-    tfrecord_writer: The TFRecord writer to use for writing.
-    offset: An offset into the absolute number of images previously written.
+    args: A tuple with the path of the tarball, the name of the pickle file
+      inside the tarball and the image format, "png" or "raw".
 
   Returns:
-    The new offset.
+    A list with the serialized TF-Example protos of the images in the file.
   """
-  with tf.gfile.Open(filename, 'r') as f:
-    data = cPickle.load(f)
+  tarball, filename, image_format = args
+  with tarfile.open(tarball, 'r:gz') as tar:
+    data = cPickle.load(tar.extractfile(filename))
 
   images = data['data']
   num_images = images.shape[0]
 
-  images = images.reshape((num_images, 3, 32, 32))
+  images = images.reshape((num_images, 3, 32, 32)).transpose((0, 2, 3, 1))
   labels = data['labels']
 
-  with tf.Graph().as_default():
-    image_placeholder = tf.placeholder(dtype=tf.uint8)
-    encoded_image = tf.image.encode_png(image_placeholder)
-
-    with tf.Session('') as sess:
-
-      for j in range(num_images):
-        sys.stdout.write('\r>> Reading file [%s] image %d/%d' % (
-            filename, offset + j + 1, offset + num_images))
-        sys.stdout.flush()
-
-        image = np.squeeze(images[j]).transpose((1, 2, 0))
-        label = labels[j]
-
-        png_string = sess.run(encoded_image,
-                              feed_dict={image_placeholder: image})
-
-        example = dataset_utils.image_to_tfexample(
-            png_string, 'png', _IMAGE_SIZE, _IMAGE_SIZE, label)
-        tfrecord_writer.write(example.SerializeToString())
-
-  return offset + num_images
-
-
-def _get_output_filename(dataset_dir, split_name):
+  if image_format == 'png':
+    # Encodes all the images of the file with a single session run.
+    with tf.Graph().as_default():
+      images_placeholder = tf.placeholder(
+          dtype=tf.uint8, shape=[None, _IMAGE_SIZE, _IMAGE_SIZE, 3])
+      encoded_images = tf.map_fn(tf.image.encode_png, images_placeholder,
+                                 dtype=tf.string, back_prop=False,
+                                 parallel_iterations=16)
+      with tf.Session('') as sess:
+        encoded = sess.run(encoded_images,
+                           feed_dict={images_placeholder: images})
+  else:
+    encoded = [np.ascontiguousarray(image).tobytes() for image in images]
+
+  print('>> Converted file [%s] with %d images' % (filename, num_images))
+  return [
+      dataset_utils.image_to_tfexample(
+          encoded[j], image_format, _IMAGE_SIZE, _IMAGE_SIZE,
+          labels[j]).SerializeToString()
+      for j in range(num_images)]
+
+
+def _get_output_filename(dataset_dir, split_name, image_format='png',
+                         shard=0, num_shards=1):
   """Creates the output filename.
 
   Args:
     dataset_dir: The dataset directory where the dataset is stored.
     split_name: The name of the train/test split.
+    image_format: Either "png" or "raw".
+    shard: The index of the output shard.
+    num_shards: The number of output shards of the split.
 
   Returns:
     An absolute file path.
   """
-  return '%s/cifar10_%s.tfrecord' % (dataset_dir, split_name)
-
-
-def _download_and_uncompress_dataset(dataset_dir):
-  """Downloads cifar10 and uncompresses it locally.
+  if image_format == 'raw':
+    filename = '%s/cifar10_raw_%s.tfrecord' % (dataset_dir, split_name)
+  else:
+    filename = '%s/cifar10_%s.tfrecord' % (dataset_dir, split_name)
+  if num_shards > 1:
+    filename += '-%05d-of-%05d' % (shard, num_shards)
+  return filename
+
+
+def _write_shards(examples, dataset_dir, split_name, image_format,
+                  num_shards):
+  """Writes serialized examples evenly split into `num_shards` TFRecords."""
+  for shard, indices in enumerate(
+      np.array_split(np.arange(len(examples)), num_shards)):
+    filename = _get_output_filename(dataset_dir, split_name, image_format,
+                                    shard, num_shards)
+    with tf.python_io.TFRecordWriter(filename) as tfrecord_writer:
+      for j in indices:
+        tfrecord_writer.write(examples[j])
+
+
+def _download_dataset(dataset_dir):
+  """Downloads the cifar10 tarball, unless it is already there.
 
   Args:
     dataset_dir: The directory where the temporary files are stored.
+
+  Returns:
+    The path of the tarball.
   """
   filename = _DATA_URL.split('/')[-1]
   filepath = os.path.join(dataset_dir, filename)
@@ -144,21 +192,7 @@ def _download_and_uncompress_dataset(dataset_dir):
     print()
     statinfo = os.stat(filepath)
     print('Successfully downloaded', filename, statinfo.st_size, 'bytes.')
-    tarfile.open(filepath, 'r:gz').extractall(dataset_dir)
-
-
-def _clean_up_temporary_files(dataset_dir):
-  """Removes temporary files used to create the dataset.
-
-  Args:
-    dataset_dir: The directory where the temporary files are stored.
-  """
-  filename = _DATA_URL.split('/')[-1]
-  filepath = os.path.join(dataset_dir, filename)
-  tf.gfile.Remove(filepath)
-
-  tmp_dir = os.path.join(dataset_dir, 'cifar-10-batches-py')
-  tf.gfile.DeleteRecursively(tmp_dir)
+  return filepath
 
 
 def main(_):
@@ -168,40 +202,48 @@ def main(_):
     dataset_dir: The dataset directory where the dataset is stored.
   """
   dataset_dir = FLAGS.dataset_dir
+  image_format = FLAGS.image_format
+  if image_format not in ('png', 'raw'):
+    raise ValueError('Unknown image format: %s' % image_format)
 
   if not tf.gfile.Exists(dataset_dir):
     tf.gfile.MakeDirs(dataset_dir)
 
-  training_filename = _get_output_filename(dataset_dir, 'train')
-  testing_filename = _get_output_filename(dataset_dir, 'test')
+  training_pattern = _get_output_filename(dataset_dir, 'train', image_format)
+  testing_pattern = _get_output_filename(dataset_dir, 'test', image_format)
 
-  if tf.gfile.Exists(training_filename) and tf.gfile.Exists(testing_filename):
+  if (tf.gfile.Glob(training_pattern + '*') and
+      tf.gfile.Glob(testing_pattern + '*')):
     print('Dataset files already exist. Exiting without re-creating them.')
     return
 
-  dataset_utils.download_and_uncompress_tarball(_DATA_URL, dataset_dir)
+  tarball = FLAGS.tarball or _download_dataset(dataset_dir)
+
+  filenames = [os.path.join(_TARBALL_DIR, 'data_batch_%d' % (i + 1))
+               for i in range(_NUM_TRAIN_FILES)]  # 1-indexed.
+  filenames.append(os.path.join(_TARBALL_DIR, 'test_batch'))
 
-  # First, process the training data:
-  with tf.python_io.TFRecordWriter(training_filename) as tfrecord_writer:
-    offset = 0
-    for i in range(_NUM_TRAIN_FILES):
-      filename = os.path.join(dataset_dir,
-                              'cifar-10-batches-py',
-                              'data_batch_%d' % (i + 1))  # 1-indexed.
-      offset = _add_to_tfrecord(filename, tfrecord_writer, offset)
+  pool = multiprocessing.Pool(FLAGS.num_processes)
+  try:
+    examples = pool.map(_convert_data_file,
+                        [(tarball, filename, image_format)
+                         for filename in filenames])
+  finally:
+    pool.close()
+    pool.join()
 
-  # Next, process the testing data:
-  with tf.python_io.TFRecordWriter(testing_filename) as tfrecord_writer:
-    filename = os.path.join(dataset_dir,
-                            'cifar-10-batches-py',
-                            'test_batch')
-    _add_to_tfrecord(filename, tfrecord_writer)
+  # The training data are written in the order of the data files.
+  _write_shards(sum(examples[:_NUM_TRAIN_FILES], []), dataset_dir, 'train',
+                image_format, FLAGS.num_shards)
+  _write_shards(examples[_NUM_TRAIN_FILES], dataset_dir, 'test', image_format,
+                FLAGS.num_shards)
 
   # Finally, write the labels file:
   labels_to_class_names = dict(zip(range(len(_CLASS_NAMES)), _CLASS_NAMES))
   dataset_utils.write_label_file(labels_to_class_names, dataset_dir)
 
-  _clean_up_temporary_files(dataset_dir)
+  if not FLAGS.tarball:
+    tf.gfile.Remove(tarball)
   print('\nFinished converting the Cifar10 dataset!')
 
 
@@ -156,6 +156,71 @@ def distorted_bounding_box_crop(image,
     return cropped_image, distort_bbox
 
 
+def decode_and_distorted_bounding_box_crop(image_buffer,
+                                           bbox,
+                                           height,
+                                           width,
+                                           min_object_covered=0.1,
+                                           aspect_ratio_range=(0.75, 1.33),
+                                           area_range=(0.05, 1.0),
+                                           max_attempts=100,
+                                           scope=None):
+  """Decodes only a randomly distorted crop of a JPEG image.
+
+  Samples the crop window like `distorted_bounding_box_crop`, from the shape
+  stored in the JPEG header, and decodes only this window. If the crop is at
+  least 2, 4 or 8 times larger than [height, width], it is decoded at the
+  corresponding reduced DCT scale.
+
+  Args:
+    image_buffer: scalar string Tensor with the JPEG-encoded image.
+    bbox: 3-D float Tensor of bounding boxes arranged [1, num_boxes, coords]
+      where each coordinate is [0, 1) and the coordinates are arranged
+      as [ymin, xmin, ymax, xmax]. If num_boxes is 0 then it would use the whole
+      image.
+    height: integer, the height to which the crop is resized afterwards.
+    width: integer, the width to which the crop is resized afterwards.
+    min_object_covered: see `distorted_bounding_box_crop`.
+    aspect_ratio_range: see `distorted_bounding_box_crop`.
+    area_range: see `distorted_bounding_box_crop`.
+    max_attempts: see `distorted_bounding_box_crop`.
+    scope: Optional scope for name_scope.
+  Returns:
+    A tuple, a 3-D uint8 Tensor cropped_image and the distorted bbox
+  """
+  with tf.name_scope(scope, 'decode_and_distorted_bounding_box_crop',
+                     [image_buffer, bbox]):
+    sample_distorted_bounding_box = tf.image.sample_distorted_bounding_box(
+        tf.image.extract_jpeg_shape(image_buffer),
+        bounding_boxes=bbox,
+        min_object_covered=min_object_covered,
+        aspect_ratio_range=aspect_ratio_range,
+        area_range=area_range,
+        max_attempts=max_attempts,
+        use_image_if_no_bounding_boxes=True)
+    bbox_begin, bbox_size, distort_bbox = sample_distorted_bounding_box
+    offset_y, offset_x, _ = tf.unstack(bbox_begin)
+    crop_height, crop_width, _ = tf.unstack(bbox_size)
+
+    def decode_crop(ratio):
+      # The crop window is in the coordinates of the downscaled image.
+      def _decode():
+        crop_window = tf.stack([offset_y // ratio, offset_x // ratio,
+                                crop_height // ratio, crop_width // ratio])
+        return tf.image.decode_and_crop_jpeg(image_buffer, crop_window,
+                                             channels=3, ratio=ratio)
+      return _decode
+
+    pred_fn_pairs = [
+        (tf.logical_and(crop_height >= ratio * height,
+                        crop_width >= ratio * width), decode_crop(ratio))
+        for ratio in (8, 4, 2)]
+    cropped_image = tf.case(pred_fn_pairs, default=decode_crop(1),
+                            exclusive=False)
+    cropped_image.set_shape([None, None, 3])
+    return cropped_image, distort_bbox
+
+
 def preprocess_for_train(image, height, width, bbox,
                          fast_mode=True,
                          scope=None):
@@ -206,35 +271,78 @@ def preprocess_for_train(image, height, width, bbox,
     tf.summary.image('images_with_distorted_bounding_box',
                      image_with_distorted_box)
 
-    # This resizing operation may distort the images because the aspect
-    # ratio is not respected. We select a resize method in a round robin
-    # fashion based on the thread number.
-    # Note that ResizeMethod contains 4 enumerated resizing methods.
-
-    # We select only 1 case for fast_mode bilinear.
-    num_resize_cases = 1 if fast_mode else 4
-    distorted_image = apply_with_random_selector(
-        distorted_image,
-        lambda x, method: tf.image.resize_images(x, [height, width], method=method),
-        num_cases=num_resize_cases)
-
-    tf.summary.image('cropped_resized_image',
-                     tf.expand_dims(distorted_image, 0))
-
-    # Randomly flip the image horizontally.
-    distorted_image = tf.image.random_flip_left_right(distorted_image)
-
-    # Randomly distort the colors. There are 4 ways to do it.
-    distorted_image = apply_with_random_selector(
-        distorted_image,
-        lambda x, ordering: distort_color(x, ordering, fast_mode),
-        num_cases=4)
-
-    tf.summary.image('final_distorted_image',
-                     tf.expand_dims(distorted_image, 0))
-    distorted_image = tf.subtract(distorted_image, 0.5)
-    distorted_image = tf.multiply(distorted_image, 2.0)
-    return distorted_image
+    return _distort_cropped_image(distorted_image, height, width, fast_mode)
+
+
+def preprocess_jpeg_for_train(image_buffer, height, width, bbox,
+                              fast_mode=True,
+                              scope=None):
+  """Distort one JPEG image for training a network, decoding only the crop.
+
+  Applies the same distortions as `preprocess_for_train`, but samples the
+  crop window before decoding the image and decodes only this window, see
+  `decode_and_distorted_bounding_box_crop`. The crop window is sampled from
+  the image shape in the JPEG header, given by `tf.image.extract_jpeg_shape`.
+  Requires TensorFlow 1.5 or newer.
+
+  Args:
+    image_buffer: scalar string Tensor with the JPEG-encoded image.
+    height: integer
+    width: integer
+    bbox: 3-D float Tensor of bounding boxes arranged [1, num_boxes, coords]
+      where each coordinate is [0, 1) and the coordinates are arranged
+      as [ymin, xmin, ymax, xmax].
+    fast_mode: Optional boolean, if True avoids slower transformations (i.e.
+      bi-cubic resizing, random_hue or random_contrast).
+    scope: Optional scope for name_scope.
+  Returns:
+    3-D float Tensor of distorted image used for training with range [-1, 1].
+  """
+  with tf.name_scope(scope, 'distort_jpeg_image',
+                     [image_buffer, height, width, bbox]):
+    if bbox is None:
+      bbox = tf.constant([0.0, 0.0, 1.0, 1.0],
+                         dtype=tf.float32,
+                         shape=[1, 1, 4])
+    distorted_image, _ = decode_and_distorted_bounding_box_crop(
+        image_buffer, bbox, height, width)
+    distorted_image = tf.image.convert_image_dtype(distorted_image,
+                                                   dtype=tf.float32)
+    return _distort_cropped_image(distorted_image, height, width, fast_mode)
+
+
+def _distort_cropped_image(distorted_image, height, width, fast_mode):
+  """Resizes, flips and color distorts a cropped image for training."""
+  # This resizing operation may distort the images because the aspect
+  # ratio is not respected. We select a resize method in a round robin
+  # fashion based on the thread number.
+  # Note that ResizeMethod contains 4 enumerated resizing methods.
+
+  # We select only 1 case for fast_mode bilinear.
+  num_resize_cases = 1 if fast_mode else 4
+  distorted_image = apply_with_random_selector(
+      distorted_image,
+      lambda x, method: tf.image.resize_images(x, [height, width],
+                                               method=method),
+      num_cases=num_resize_cases)
+
+  tf.summary.image('cropped_resized_image',
+                   tf.expand_dims(distorted_image, 0))
+
+  # Randomly flip the image horizontally.
+  distorted_image = tf.image.random_flip_left_right(distorted_image)
+
+  # Randomly distort the colors. There are 4 ways to do it.
+  distorted_image = apply_with_random_selector(
+      distorted_image,
+      lambda x, ordering: distort_color(x, ordering, fast_mode),
+      num_cases=4)
+
+  tf.summary.image('final_distorted_image',
+                   tf.expand_dims(distorted_image, 0))
+  distorted_image = tf.subtract(distorted_image, 0.5)
+  distorted_image = tf.multiply(distorted_image, 2.0)
+  return distorted_image
 
 
 def preprocess_for_eval(image, height, width,
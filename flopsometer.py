@@ -24,6 +24,8 @@ import tensorflow as tf
 from tensorflow.contrib import slim
 from tensorflow.contrib.layers.python.layers import utils
 
+import sparse_utils
+
 
 def conv2d(inputs, num_outputs, kernel_size, *args, **kwargs):
   """A wrapper/substitute for conv2d that counts the flops.
@@ -32,7 +34,9 @@ def conv2d(inputs, num_outputs, kernel_size, *args, **kwargs):
   layer, including one with a "mask." The optional keyword argument
   `output_mask` specifies which of the position in the output response map need
   actually be calculated, the rest can be discarded and are not counted in the
-  result.
+  result. If the optional keyword argument `return_dense_flops` is True, the
+  operation count of the convolution at all the positions, which are
+  computed by slim.conv2d regardless of the mask, is returned as well.
 
   Since this is a wrapper around slim.conv2d, see that function for details on
   the inputs/outputs.
@@ -46,8 +50,11 @@ def conv2d(inputs, num_outputs, kernel_size, *args, **kwargs):
   Returns:
     outputs:     The result of the convolution from slim.conv2d.
     flops:       The operation count as a scalar integer tensor.
+    dense_flops: With `return_dense_flops`, the operation count without the
+                 mask.
   """
   output_mask = kwargs.pop('output_mask', None)
+  return_dense_flops = kwargs.pop('return_dense_flops', False)
 
   outputs = slim.conv2d(inputs, num_outputs, kernel_size, *args, **kwargs)
 
@@ -61,30 +68,107 @@ def conv2d(inputs, num_outputs, kernel_size, *args, **kwargs):
 
   num_filters_in = inputs_shape[3]
   kernel_h, kernel_w = utils.two_element_tuple(kernel_size)
+  num_dense_positions = tf.to_int64(tf.fill(
+      # tf.fill does not support int64 dims :-|
+      dims=tf.to_int32(tf.stack([batch_size])),
+      value=outputs_shape[1] * outputs_shape[2]))
   if output_mask is None:
-    num_spatial_positions = tf.fill(
-        # tf.fill does not support int64 dims :-|
-        dims=tf.to_int32(tf.stack([batch_size])),
-        value=outputs_shape[1] * outputs_shape[2])
+    num_spatial_positions = num_dense_positions
   else:
-    num_spatial_positions = tf.reduce_sum(output_mask, [1, 2])
-  num_spatial_positions = tf.to_int64(num_spatial_positions)
+    # Count in float32, the mask may have a reduced precision type.
+    num_spatial_positions = tf.to_int64(
+        tf.reduce_sum(tf.to_float(output_mask), [1, 2]))
 
-  num_output_positions = num_spatial_positions * num_outputs
-  flops = 2 * num_output_positions * (kernel_h * kernel_w * num_filters_in)
+  flops_per_position = 2 * num_outputs * (kernel_h * kernel_w * num_filters_in)
+  flops = num_spatial_positions * flops_per_position
 
   # The numbers are slightly different than TensorFlow graph_metrics since we
   # ignore biases. We do not try to mimic graph_metrics because it is
   # inconsistent in the treatment of biases (batch_norm makes biases "free").
+  if return_dense_flops:
+    return outputs, flops, num_dense_positions * flops_per_position
+  return outputs, flops
+
+
+def sparse_conv2d(inputs, positions, num_outputs, kernel_size, *args,
+                  **kwargs):
+  """A version of `conv2d` that is evaluated only at the given positions.
+
+  Computes the same values as a stride-1 'SAME' `conv2d` of `inputs` at
+  `positions`, by gathering the receptive fields of these positions and
+  applying a 'VALID' convolution to them. The variables are the same as the
+  ones of `conv2d`, so the two versions can share weights.
+
+  Args:
+    inputs:      The input response map to the convolution.
+    positions:   A 2-D `int32` `Tensor` of (batch, y, x) indices of the
+                 positions to evaluate, see `sparse_utils.active_positions`.
+    num_outputs: The number of output channels for the convolution.
+    kernel_size: Spatial size of the convolution kernel.
+    *args:       Additional position arguments forwarded to slim.conv2d.
+    **kwargs:    Additional keyword args forwarded to slim.conv2d.
+  Returns:
+    outputs:     A `Tensor` of shape [num_positions, num_outputs].
+    flops:       The operation count as a 1-D integer tensor of length batch.
+  """
+  kernel_h, kernel_w = utils.two_element_tuple(kernel_size)
+  assert kernel_h == kernel_w
+
+  patches = sparse_utils.gather_patches(inputs, positions, kernel_h)
+  outputs = slim.conv2d(
+      patches, num_outputs, kernel_size, *args, padding='VALID', **kwargs)
+  outputs = tf.reshape(outputs, [-1, num_outputs])
+
+  num_filters_in = inputs.get_shape().as_list()[3]
+  # A static batch size keeps the count independent of the values of `inputs`.
+  batch_size = inputs.get_shape()[0].value
+  if batch_size is None:
+    batch_size = tf.shape(inputs)[0]
+  num_spatial_positions = tf.unsorted_segment_sum(
+      tf.ones_like(positions[:, 0]), positions[:, 0], batch_size)
+  num_spatial_positions = tf.to_int64(num_spatial_positions)
+
+  num_output_positions = num_spatial_positions * num_outputs
+  flops = 2 * num_output_positions * (kernel_h * kernel_w * num_filters_in)
+
   return outputs, flops
 
 
+def tile_rounded_flops(flops, mask, tile_size):
+  """Rounds the flops counted at the active positions up to whole tiles.
+
+  A layer which evaluates every tile with an active position as a dense patch
+  also computes the inactive positions of these tiles. The flops counted at
+  the active positions of `mask` are scaled by the ratio of the number of
+  positions of the active tiles to the number of active positions, i.e. the
+  cost of a position is assumed to be the same for all the positions. The
+  tiles are the ones of `sparse_utils.pad_to_tiles`, the positions outside of
+  the map are counted as well.
+
+  Args:
+    flops:     A 1-D integer `Tensor` of length batch, counted at the active
+               positions of `mask`.
+    mask:      A 4-D `Tensor` of shape [batch, height, width, 1]. Positions
+               with non-zero values are active.
+    tile_size: A positive `int`.
+  Returns:
+    flops:     The tile-rounded operation count as a 1-D `int64` tensor.
+  """
+  mask = tf.to_float(tf.not_equal(mask, 0))
+  num_positions = tf.reduce_sum(mask, [1, 2, 3])
+  num_tile_positions = tile_size**2 * tf.reduce_sum(
+      sparse_utils.tile_max(mask, tile_size), [1, 2, 3])
+  ratio = num_tile_positions / tf.maximum(num_positions, 1.)
+  return tf.to_int64(tf.round(tf.to_double(flops) * tf.to_double(ratio)))
+
+
 def conv2d_same(inputs,
                 num_outputs,
                 kernel_size,
                 stride,
                 rate=1,
                 output_mask=None,
+                return_dense_flops=False,
                 scope=None):
   """Version of TF-Slim resnet_utils.conv2d_same that uses the flopsometer."""
   if stride == 1:
@@ -96,6 +180,7 @@ def conv2d_same(inputs,
         rate=rate,
         padding='SAME',
         output_mask=output_mask,
+        return_dense_flops=return_dense_flops,
         scope=scope)
   else:
     kernel_size_effective = kernel_size + (kernel_size - 1) * (rate - 1)
@@ -112,4 +197,5 @@ def conv2d_same(inputs,
         rate=rate,
         padding='VALID',
         output_mask=output_mask,
+        return_dense_flops=return_dense_flops,
         scope=scope)
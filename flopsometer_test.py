@@ -23,6 +23,7 @@ import numpy as np
 import tensorflow as tf
 
 import flopsometer
+import sparse_utils
 
 
 class FlopsometerTest(tf.test.TestCase):
@@ -78,6 +79,50 @@ class FlopsometerTest(tf.test.TestCase):
       flops_out = sess.run(flops)
       self.assertAllEqual(flops_out, expected_flops)
 
+  def testConv2dDenseFlops(self):
+    inputs = tf.zeros([2, 16, 16, 4])
+    mask = np.zeros([2, 16, 16], dtype=np.float32)
+    mask[:, :4, :4] = 1.
+    _, flops, dense_flops = flopsometer.conv2d(
+        inputs, 8, [3, 3], stride=1, padding='SAME',
+        output_mask=tf.constant(mask), return_dense_flops=True)
+    per_position_flops = 2 * 3 * 3 * 8 * 4
+    with self.test_session() as sess:
+      sess.run(tf.global_variables_initializer())
+      (flops_out, dense_flops_out) = sess.run((flops, dense_flops))
+      self.assertAllEqual(flops_out, [per_position_flops * 4 * 4] * 2)
+      self.assertAllEqual(dense_flops_out, [per_position_flops * 16 * 16] * 2)
+
+  def testSparseConv2d(self):
+    inputs = tf.random_normal([2, 8, 8, 4])
+    mask = np.float32(np.random.random([2, 8, 8, 1]) <= 0.3)
+    mask_tf = tf.constant(mask)
+    dense_outputs, dense_flops = flopsometer.conv2d(
+        inputs, 8, [3, 3], stride=1, padding='SAME', output_mask=mask_tf,
+        scope='conv')
+    positions = sparse_utils.active_positions(mask_tf)
+    sparse_outputs, sparse_flops = flopsometer.sparse_conv2d(
+        inputs, positions, 8, [3, 3], scope='conv', reuse=True)
+    with self.test_session() as sess:
+      sess.run(tf.global_variables_initializer())
+      (dense_outputs_out, dense_flops_out, sparse_outputs_out,
+       sparse_flops_out) = sess.run(
+           (dense_outputs, dense_flops, sparse_outputs, sparse_flops))
+      self.assertAllClose(sparse_outputs_out,
+                          dense_outputs_out[mask[:, :, :, 0] > 0])
+      self.assertAllEqual(sparse_flops_out, dense_flops_out)
+
+  def testTileRoundedFlops(self):
+    mask = np.zeros([2, 3, 3, 1], dtype=np.float32)
+    mask[0, 0, 0, 0] = 1.
+    mask[1] = 1.
+    flops = flopsometer.tile_rounded_flops(
+        tf.constant([10, 90], dtype=tf.int64), tf.constant(mask), 2)
+    with self.test_session() as sess:
+      flops_out = sess.run(flops)
+    # One tile of four positions and four tiles of sixteen positions.
+    self.assertAllEqual(flops_out, [40, 160])
+
 
 if __name__ == '__main__':
   tf.test.main()
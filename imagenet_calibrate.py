@@ -0,0 +1,228 @@
+# Copyright 2016 Google Inc. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# ==============================================================================
+
+"""Searches per-block halting thresholds of a trained ResNet-ACT/SACT model.
+
+The thresholds are fed into a single graph, so every operating point is
+evaluated without rebuilding the model. The held-out images are read once
+and kept in memory.
+"""
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import time
+
+import numpy as np
+import tensorflow as tf
+from tensorflow.contrib import slim
+
+import calibration_utils
+import imagenet_data_provider
+import imagenet_model
+import resnet_act
+import utils
+
+FLAGS = tf.app.flags.FLAGS
+
+tf.app.flags.DEFINE_string('checkpoint_dir', '',
+                           'Directory with the checkpoints.')
+
+tf.app.flags.DEFINE_string('dataset_dir', None, 'Directory with Imagenet data.')
+
+tf.app.flags.DEFINE_string(
+    'split_name', 'validation',
+    'The name of the train/test split with the held-out images.')
+
+tf.app.flags.DEFINE_integer('num_examples', 1000,
+                            'The number of held-out examples.')
+
+tf.app.flags.DEFINE_integer('batch_size', 32,
+                            'The number of examples per batch.')
+
+tf.app.flags.DEFINE_integer('image_size', 224,
+                            'Image resolution for resize.')
+
+tf.app.flags.DEFINE_string(
+    'model', '101',
+    'Depth of the network (50, 101, 152, 200), or number of layers'
+    ' in each block (e.g. 3_4_23_3).')
+
+tf.app.flags.DEFINE_string(
+    'model_type', 'sact',
+    'Options: act, act_early_stopping, sact, '
+    'or a comma separated list with the type of every block, e.g. '
+    'vanilla,vanilla,sact,sact')
+
+tf.app.flags.DEFINE_float(
+    'sparse_threshold', 0.0,
+    'For sact models: residual units with at most this fraction of active '
+    'positions are computed only at these positions. '
+    'Zero disables sparse evaluation.')
+
+tf.app.flags.DEFINE_bool(
+    'compact_batch', False,
+    'For act_early_stopping models: run each residual unit only '
+    'for the images which have not halted yet.')
+
+tf.app.flags.DEFINE_bool(
+    'use_while_loop', False,
+    'For act_early_stopping and sact models: iterate the intermediate '
+    'residual units in a tf.while_loop. Inference only, see the flag of '
+    'imagenet_eval. Not supported with --precision=float16, --tile_size or '
+    '--sact_early_stopping.')
+
+tf.app.flags.DEFINE_bool(
+    'sact_early_stopping', False,
+    'For sact models: skip the remaining residual units of a block once all '
+    'the positions of the batch have halted.')
+
+tf.app.flags.DEFINE_string(
+    'halting_head', 'conv',
+    'For sact models, the halting head: conv (3x3 convolution of the unit '
+    'outputs), conv1x1, separable (1x1 convolution to a single channel '
+    'followed by a 3x3 convolution) or bottleneck (3x3 convolution of the '
+    'narrow features of the residual branch). Should match the trained '
+    'model.')
+
+tf.app.flags.DEFINE_string(
+    'tile_size', '1',
+    'For sact blocks, the size of the tiles for which the halting is decided, '
+    'or an underscore separated list with the size for every block '
+    '(e.g. 1_1_4_2). Should match the trained model.')
+
+tf.app.flags.DEFINE_string(
+    'precision', 'float32',
+    'Type of the convolutions and the activations: float32 or float16. The '
+    'variables and the halting computations are float32. float16 only saves '
+    'memory and time on GPUs, the CPU kernels of TensorFlow emulate it. '
+    'bfloat16 is not supported.')
+
+tf.app.flags.DEFINE_string(
+    'eps_values', '0.01_0.02_0.05_0.1_0.2_0.3',
+    'An underscore separated increasing list of the thresholds to consider '
+    'for every block.')
+
+tf.app.flags.DEFINE_string(
+    'budget_type', 'flops',
+    'Options: flops (the budget is in GFLOPs per image), latency (the budget '
+    'is in milliseconds per image).')
+
+tf.app.flags.DEFINE_float('budget', 5.0, 'The computational budget.')
+
+tf.app.flags.DEFINE_string(
+    'output_file', '',
+    'Optional path to write the evaluated Pareto frontier to.')
+
+
+def main(_):
+  assert resnet_act.is_adaptive(FLAGS.model_type)
+  assert FLAGS.budget_type in ('flops', 'latency')
+  eps_values = utils.split_and_float(FLAGS.eps_values)
+
+  g = tf.Graph()
+  with g.as_default():
+    data_tuple = imagenet_data_provider.provide_data(
+        FLAGS.split_name,
+        FLAGS.batch_size,
+        dataset_dir=FLAGS.dataset_dir,
+        is_training=False,
+        image_size=FLAGS.image_size)
+    images, one_hot_labels, _, num_classes = data_tuple
+    labels = tf.argmax(one_hot_labels, 1)
+
+    with slim.arg_scope(imagenet_model.resnet_arg_scope(is_training=False)):
+      model = utils.split_and_int(FLAGS.model)
+      logits, end_points = imagenet_model.get_network(
+          images,
+          model,
+          num_classes,
+          model_type=FLAGS.model_type,
+          sparse_threshold=FLAGS.sparse_threshold,
+          compact_batch=FLAGS.compact_batch,
+          use_while_loop=FLAGS.use_while_loop,
+          sact_early_stopping=FLAGS.sact_early_stopping,
+          halting_head=FLAGS.halting_head,
+          tile_size=utils.split_and_int(FLAGS.tile_size),
+          dtype=tf.as_dtype(FLAGS.precision))
+
+    correct = tf.equal(tf.argmax(logits, 1), labels)
+    flops = end_points['flops']
+    eps_tensors = [end_points['{}/eps'.format(block_scope)]
+                   for block_scope in end_points['act_block_scopes']]
+
+    checkpoint_path = tf.train.latest_checkpoint(FLAGS.checkpoint_dir)
+    assert checkpoint_path is not None
+
+    saver = tf.train.Saver()
+    sess = tf.Session()
+    saver.restore(sess, checkpoint_path)
+
+    # Read the held-out set once.
+    coord = tf.train.Coordinator()
+    threads = tf.train.start_queue_runners(sess, coord=coord)
+    num_batches = FLAGS.num_examples // FLAGS.batch_size
+    batches = [sess.run((images, labels)) for _ in range(num_batches)]
+    coord.request_stop()
+    coord.join(threads)
+
+    def evaluate_fn(eps):
+      feed_dict = dict(zip(eps_tensors, eps))
+      num_correct = 0
+      total_flops = 0
+      total_time = 0.
+      for (i, (images_value, labels_value)) in enumerate(batches):
+        feed_dict[images] = images_value
+        feed_dict[labels] = labels_value
+        start_time = time.time()
+        (correct_out, flops_out) = sess.run((correct, flops),
+                                            feed_dict=feed_dict)
+        if i:
+          # The first batch warms up the session.
+          total_time += time.time() - start_time
+        num_correct += np.sum(correct_out)
+        total_flops += np.sum(flops_out)
+
+      num_images = len(batches) * FLAGS.batch_size
+      accuracy = num_correct / num_images
+      if FLAGS.budget_type == 'flops':
+        cost = total_flops / num_images / 1e9
+      else:
+        cost = 1e3 * total_time / max(num_images - FLAGS.batch_size, 1)
+      tf.logging.info('eps %s: accuracy %.4f, cost %.3f', eps, accuracy, cost)
+      return accuracy, cost
+
+    (selected, _, frontier) = calibration_utils.greedy_threshold_search(
+        evaluate_fn, len(eps_tensors), eps_values, FLAGS.budget)
+
+    if selected.cost > FLAGS.budget:
+      print('The budget cannot be met with the given thresholds.')
+    print('Selected thresholds: {}'.format(', '.join(
+        '{}={}'.format(block_scope, eps) for (block_scope, eps) in zip(
+            end_points['act_block_scopes'], selected.eps))))
+    print('Accuracy {:.4f}, cost {:.3f}'.format(selected.accuracy,
+                                                selected.cost))
+
+    if FLAGS.output_file:
+      with tf.gfile.Open(FLAGS.output_file, 'w') as f:
+        f.write('eps,accuracy,cost\n')
+        for point in frontier:
+          f.write('{},{},{}\n'.format('_'.join(str(x) for x in point.eps),
+                                      point.accuracy, point.cost))
+
+
+if __name__ == '__main__':
+  tf.app.run()
@@ -28,10 +28,17 @@ from tensorflow.contrib.slim import dataset_data_provider
 
 from external import inception_preprocessing
 from external import datasets_imagenet
+import utils
+
+# The oldest TensorFlow version with `tf.image.extract_jpeg_shape` and
+# `tf.image.decode_and_crop_jpeg`.
+DECODE_AND_CROP_MIN_VERSION = '1.5'
 
 
 def provide_data(split_name, batch_size, dataset_dir=None, is_training=False,
-                 num_readers=4, num_preprocessing_threads=4, image_size=224):
+                 num_readers=4, num_preprocessing_threads=4, image_size=224,
+                 use_tf_data=False, shuffle_buffer_size=10000,
+                 decode_and_crop=False):
   """Provides batches of Imagenet data.
 
   Applies the processing in external/inception_preprocessing
@@ -44,7 +51,20 @@ def provide_data(split_name, batch_size, dataset_dir=None, is_training=False,
                  Defaults to "~/tensorflow/data/imagenet"
     is_training: Whether to apply data augmentation and shuffling.
     num_readers: Number of parallel readers. Always set to one for evaluation.
-    num_preprocessing_threads: Number of preprocessing threads.
+    num_preprocessing_threads: Number of preprocessing threads. Autotuned
+      with `use_tf_data`.
+    image_size: The size of the preprocessed images.
+    use_tf_data: Whether to read the data with a `tf.data` input pipeline,
+      see `utils.tf_data_batches`, instead of queue runners. Requires
+      TensorFlow `utils.TF_DATA_MIN_VERSION` or newer.
+    shuffle_buffer_size: The number of examples in the shuffle buffer of the
+      `tf.data` input pipeline for training.
+    decode_and_crop: For training, whether to sample the random crop before
+      decoding the image and to decode only the crop, see
+      `inception_preprocessing.preprocess_jpeg_for_train`. The crop is then
+      sampled from the image shape read by `tf.image.extract_jpeg_shape`
+      from the JPEG header rather than from the decoded image. Requires JPEG
+      images and TensorFlow `DECODE_AND_CROP_MIN_VERSION` or newer.
 
   Returns:
     images: A `Tensor` of size [batch_size, image_size, image_size, 3]
@@ -54,7 +74,8 @@ def provide_data(split_name, batch_size, dataset_dir=None, is_training=False,
     dataset.num_classes: The number of object classes in the dataset.
 
   Raises:
-    ValueError: if the split_name is not either 'train' or 'validation'.
+    ValueError: if the split_name is not either 'train' or 'validation', or
+      if decode_and_crop is used with an older TensorFlow.
   """
 
   with tf.device('/cpu:0'):
@@ -65,24 +86,46 @@ def provide_data(split_name, batch_size, dataset_dir=None, is_training=False,
       num_readers = 1
 
     dataset = datasets_imagenet.get_split(split_name, dataset_dir)
-    provider = dataset_data_provider.DatasetDataProvider(
-        dataset,
-        num_readers=num_readers,
-        shuffle=is_training,
-        common_queue_capacity=5 * batch_size,
-        common_queue_min=batch_size)
-
-    [image, bbox, label] = provider.get(['image', 'object/bbox', 'label'])
-    bbox = tf.expand_dims(bbox, 0)
-
-    image = inception_preprocessing.preprocess_image(
-      image, image_size, image_size, is_training, bbox, fast_mode=False)
-
-    images, labels = tf.train.batch(
-        [image, label],
-        batch_size=batch_size,
-        num_threads=num_preprocessing_threads,
-        capacity=5 * batch_size)
+
+    decode_and_crop = decode_and_crop and is_training
+    if decode_and_crop:
+      utils.check_tf_version(DECODE_AND_CROP_MIN_VERSION, 'decode_and_crop')
+    # With decode_and_crop, the image is decoded during the preprocessing.
+    image_item = 'image/encoded' if decode_and_crop else 'image'
+
+    def _preprocess(image, bbox):
+      bbox = tf.expand_dims(bbox, 0)
+      if decode_and_crop:
+        return inception_preprocessing.preprocess_jpeg_for_train(
+            image, image_size, image_size, bbox, fast_mode=False)
+      return inception_preprocessing.preprocess_image(
+          image, image_size, image_size, is_training, bbox, fast_mode=False)
+
+    if use_tf_data:
+      def _decode(serialized):
+        [image, bbox, label] = dataset.decoder.decode(
+            serialized, [image_item, 'object/bbox', 'label'])
+        return _preprocess(image, bbox), label
+
+      images, labels = utils.tf_data_batches(
+          dataset, _decode, batch_size, shuffle=is_training,
+          num_readers=num_readers, shuffle_buffer_size=shuffle_buffer_size)
+    else:
+      provider = dataset_data_provider.DatasetDataProvider(
+          dataset,
+          num_readers=num_readers,
+          shuffle=is_training,
+          common_queue_capacity=5 * batch_size,
+          common_queue_min=batch_size)
+
+      [image, bbox, label] = provider.get([image_item, 'object/bbox', 'label'])
+      image = _preprocess(image, bbox)
+
+      images, labels = tf.train.batch(
+          [image, label],
+          batch_size=batch_size,
+          num_threads=num_preprocessing_threads,
+          capacity=5 * batch_size)
 
     one_hot_labels = tf.one_hot(labels, dataset.num_classes)
 
@@ -23,15 +23,25 @@ import tensorflow as tf
 from tensorflow.contrib import slim
 
 import imagenet_data_provider
+import utils
 
 
 class ImagenetDataProviderTest(tf.test.TestCase):
 
-  def _testImageNet(self, split_name, is_training, expected_num_samples):
+  def _testImageNet(self, split_name, is_training, expected_num_samples,
+                    use_tf_data=False, decode_and_crop=False):
+    if use_tf_data and not utils.tf_version_at_least(
+        utils.TF_DATA_MIN_VERSION):
+      self.skipTest('tf.data input pipelines need a newer TensorFlow.')
+    if decode_and_crop and not utils.tf_version_at_least(
+        imagenet_data_provider.DECODE_AND_CROP_MIN_VERSION):
+      self.skipTest('decode_and_crop needs a newer TensorFlow.')
     images, one_hot_labels, num_samples, num_classes = \
         imagenet_data_provider.provide_data(split_name, 1,
                                             dataset_dir='testdata/imagenet',
-                                            is_training=is_training)
+                                            is_training=is_training,
+                                            use_tf_data=use_tf_data,
+                                            decode_and_crop=decode_and_crop)
     self.assertEqual(num_samples, expected_num_samples)
     self.assertEqual(num_classes, 1001)
     with self.test_session() as sess:
@@ -43,9 +53,18 @@ class ImagenetDataProviderTest(tf.test.TestCase):
   def testImageNetTrainSet(self):
     self._testImageNet('train', True, 1281167)
 
+  def testImageNetTrainSetDecodeAndCrop(self):
+    self._testImageNet('train', True, 1281167, decode_and_crop=True)
+
   def testImageNetValidationSet(self):
     self._testImageNet('validation', False, 50000)
 
+  def testImageNetTrainSetTfData(self):
+    self._testImageNet('train', True, 1281167, use_tf_data=True)
+
+  def testImageNetValidationSetTfData(self):
+    self._testImageNet('validation', False, 50000, use_tf_data=True)
+
 
 if __name__ == '__main__':
   tf.test.main()
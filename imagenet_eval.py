@@ -26,6 +26,7 @@ from tensorflow.contrib import slim
 
 import imagenet_data_provider
 import imagenet_model
+import resnet_act
 import summary_utils
 import utils
 
@@ -42,6 +43,11 @@ tf.app.flags.DEFINE_string('eval_dir', '/tmp/resnet/',
 
 tf.app.flags.DEFINE_string('dataset_dir', None, 'Directory with Imagenet data.')
 
+tf.app.flags.DEFINE_bool(
+    'use_tf_data', False,
+    'Read the data with a tf.data input pipeline instead of queue runners. '
+    'Requires TensorFlow 1.12 or newer.')
+
 tf.app.flags.DEFINE_integer('eval_interval_secs', 600,
                             'The frequency, in seconds, with which evaluation is run.')
 
@@ -71,12 +77,74 @@ tf.app.flags.DEFINE_string(
     'model_type', 'vanilla',
     'Options: vanilla (basic ResNet model), act (Adaptive Computation Time), '
     'act_early_stopping (act implementation which actually saves time), '
-    'sact (Spatially Adaptive Computation Time)')
+    'sact (Spatially Adaptive Computation Time), '
+    'or a comma separated list with the type of every block, e.g. '
+    'vanilla,vanilla,sact,sact')
 
 tf.app.flags.DEFINE_float('tau', 1.0, 'The value of tau (ponder relative cost).')
 
 tf.app.flags.DEFINE_bool('evaluate_once', False, 'Evaluate the model just once?')
 
+tf.app.flags.DEFINE_float(
+    'sparse_threshold', 0.0,
+    'For sact models: residual units with at most this fraction of active '
+    'positions are computed only at these positions. '
+    'Zero disables sparse evaluation.')
+
+tf.app.flags.DEFINE_bool(
+    'compact_batch', False,
+    'For evaluation of act_early_stopping models: run each residual unit only '
+    'for the images which have not halted yet.')
+
+tf.app.flags.DEFINE_bool(
+    'use_while_loop', False,
+    'For evaluation of act_early_stopping and sact models: build a single '
+    'copy of the intermediate residual units of each block and iterate it in '
+    'a tf.while_loop, which makes the graph smaller and faster to build. '
+    'Inference only: the loop is built without back-propagation, so it '
+    'cannot be used for training. Not supported with --precision=float16, '
+    '--tile_size, --cross_block_halting or --sact_early_stopping.')
+
+tf.app.flags.DEFINE_bool(
+    'jit_halting', False,
+    'For act, act_early_stopping and sact models: compile the halting '
+    'computations of every residual unit with XLA.')
+
+tf.app.flags.DEFINE_bool(
+    'jit_units', False, 'Compile every residual unit with XLA.')
+
+tf.app.flags.DEFINE_string(
+    'precision', 'float32',
+    'Type of the convolutions and the activations: float32 or float16. The '
+    'variables and the halting computations are float32. float16 only saves '
+    'memory and time on GPUs, the CPU kernels of TensorFlow emulate it. '
+    'bfloat16 is not supported.')
+
+tf.app.flags.DEFINE_string(
+    'halting_head', 'conv',
+    'For sact models, the halting head: conv (3x3 convolution of the unit '
+    'outputs), conv1x1, separable (1x1 convolution to a single channel '
+    'followed by a 3x3 convolution) or bottleneck (3x3 convolution of the '
+    'narrow features of the residual branch).')
+
+tf.app.flags.DEFINE_string(
+    'tile_size', '1',
+    'For sact blocks, the size of the tiles for which the halting is decided, '
+    'or an underscore separated list with the size for every block '
+    '(e.g. 1_1_4_2). Tiles larger than one position give contiguous active '
+    'regions.')
+
+tf.app.flags.DEFINE_bool(
+    'cross_block_halting', False,
+    'For sact models, compute the first unit of a block only where the '
+    'previous block used more than one unit. The other positions halt after '
+    'the first unit.')
+
+tf.app.flags.DEFINE_bool(
+    'sact_early_stopping', False,
+    'For evaluation of sact models: skip the remaining residual units of a '
+    'block once all the positions of the batch have halted.')
+
 
 def main(_):
   g = tf.Graph()
@@ -86,7 +154,8 @@ def main(_):
         FLAGS.batch_size,
         dataset_dir=FLAGS.dataset_dir,
         is_training=False,
-        image_size=FLAGS.image_size)
+        image_size=FLAGS.image_size,
+        use_tf_data=FLAGS.use_tf_data)
     images, one_hot_labels, examples_per_epoch, num_classes = data_tuple
 
     # Define the model:
@@ -96,7 +165,17 @@ def main(_):
           images,
           model,
           num_classes,
-          model_type=FLAGS.model_type)
+          model_type=FLAGS.model_type,
+          sparse_threshold=FLAGS.sparse_threshold,
+          compact_batch=FLAGS.compact_batch,
+          use_while_loop=FLAGS.use_while_loop,
+          jit_halting=FLAGS.jit_halting,
+          jit_units=FLAGS.jit_units,
+          dtype=tf.as_dtype(FLAGS.precision),
+          halting_head=FLAGS.halting_head,
+          tile_size=utils.split_and_int(FLAGS.tile_size),
+          cross_block_halting=FLAGS.cross_block_halting,
+          sact_early_stopping=FLAGS.sact_early_stopping)
 
       predictions = tf.argmax(end_points['predictions'], 1)
 
@@ -110,7 +189,7 @@ def main(_):
                   end_points['predictions'], tf.expand_dims(labels, 1), 5),
       }
       metric_map.update(summary_utils.flops_metric_map(end_points, True))
-      if FLAGS.model_type in ['act', 'act_early_stopping', 'sact']:
+      if resnet_act.is_adaptive(FLAGS.model_type):
         metric_map.update(summary_utils.act_metric_map(end_points, True))
 
       names_to_values, names_to_updates = tf.contrib.metrics.aggregate_metric_map(
@@ -121,7 +200,7 @@ def main(_):
         summ = tf.Print(summ, [value], name)
         tf.add_to_collection(tf.GraphKeys.SUMMARIES, summ)
 
-      if FLAGS.model_type == 'sact':
+      if resnet_act.has_sact(FLAGS.model_type):
         summary_utils.add_heatmaps_image_summary(end_points, border=10)
 
       # This ensures that we make a single pass over all of the data.
@@ -26,6 +26,7 @@ from tensorflow.contrib import slim
 
 import imagenet_data_provider
 import imagenet_model
+import resnet_act
 import summary_utils
 import utils
 
@@ -52,7 +53,9 @@ tf.app.flags.DEFINE_string(
     'model_type', 'vanilla',
     'Options: act (Adaptive Computation Time), '
     'act_early_stopping (act implementation which actually saves time), '
-    'sact (Spatially Adaptive Computation Time)')
+    'sact (Spatially Adaptive Computation Time), '
+    'or a comma separated list with the type of every block, e.g. '
+    'vanilla,vanilla,sact,sact')
 
 tf.app.flags.DEFINE_string('checkpoint_dir', '',
                            'Directory with the checkpoints.')
@@ -62,9 +65,30 @@ tf.app.flags.DEFINE_string('export_path', '',
 
 tf.app.flags.DEFINE_string('dataset_dir', None, 'Directory with Imagenet data.')
 
+tf.app.flags.DEFINE_string(
+    'halting_head', 'conv',
+    'For sact models, the halting head: conv (3x3 convolution of the unit '
+    'outputs), conv1x1, separable (1x1 convolution to a single channel '
+    'followed by a 3x3 convolution) or bottleneck (3x3 convolution of the '
+    'narrow features of the residual branch). Should match the trained '
+    'model.')
+
+tf.app.flags.DEFINE_string(
+    'tile_size', '1',
+    'For sact blocks, the size of the tiles for which the halting is decided, '
+    'or an underscore separated list with the size for every block '
+    '(e.g. 1_1_4_2). Should match the trained model.')
+
+tf.app.flags.DEFINE_string(
+    'precision', 'float32',
+    'Type of the convolutions and the activations: float32 or float16. The '
+    'variables and the halting computations are float32. float16 only saves '
+    'memory and time on GPUs, the CPU kernels of TensorFlow emulate it. '
+    'bfloat16 is not supported.')
+
 
 def main(_):
-  assert FLAGS.model_type in ('act', 'act_early_stopping', 'sact')
+  assert resnet_act.is_adaptive(FLAGS.model_type)
 
   g = tf.Graph()
   with g.as_default():
@@ -78,15 +102,23 @@ def main(_):
     # Define the model:
     with slim.arg_scope(imagenet_model.resnet_arg_scope(is_training=False)):
       model = utils.split_and_int(FLAGS.model)
+      tile_size = utils.split_and_int(FLAGS.tile_size)
       logits, end_points = imagenet_model.get_network(
           images,
           model,
           num_classes,
-          model_type=FLAGS.model_type)
+          model_type=FLAGS.model_type,
+          halting_head=FLAGS.halting_head,
+          tile_size=tile_size,
+          dtype=tf.as_dtype(FLAGS.precision),
+          return_halting_distribution=True,
+          # The data for act_numpy, which does not support the tiles.
+          return_unit_data=(max(tile_size) == 1))
 
       summary_utils.export_to_h5(FLAGS.checkpoint_dir, FLAGS.export_path,
                                  images, end_points, FLAGS.num_examples,
-                                 FLAGS.batch_size, FLAGS.model_type=='sact')
+                                 FLAGS.batch_size,
+                                 resnet_act.has_sact(FLAGS.model_type))
 
 
 if __name__ == '__main__':
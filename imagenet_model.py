@@ -26,7 +26,9 @@ from tensorflow.contrib.slim.nets import resnet_utils
 
 import act
 import flopsometer
+import mixed_precision
 import resnet_act
+import sparse_utils
 
 
 def bottleneck(inputs,
@@ -35,12 +37,30 @@ def bottleneck(inputs,
                stride,
                rate=1,
                residual_mask=None,
+               sparse_threshold=None,
+               return_features=False,
+               realized_flops=None,
                scope=None):
+  """Bottleneck residual unit.
+
+  If `stride` is greater than one, `residual_mask` has the resolution of the
+  inputs and is downsampled with `sparse_utils.downsample_mask`. In that case
+  conv1 and the residual branch are evaluated densely.
+
+  If `return_features` is set, also returns the outputs of the narrow 3x3
+  convolution of the residual branch, which can be used by a cheaper halting
+  head. With `residual_mask`, they are valid only at the active positions.
+
+  If `realized_flops` is a list, the flops actually executed by the unit are
+  appended to it: all the positions if the residual branch is evaluated
+  densely, only the active positions and their halo if it is sparse.
+  """
   with tf.variable_scope(scope, 'bottleneck_v2', [inputs]) as sc:
     flops = 0
 
     depth_in = slim.utils.last_dimension(inputs.get_shape(), min_rank=4)
-    preact = slim.batch_norm(inputs, activation_fn=tf.nn.relu, scope='preact')
+    preact = mixed_precision.batch_norm(
+        inputs, activation_fn=tf.nn.relu, scope='preact')
     if depth == depth_in:
       shortcut = resnet_utils.subsample(inputs, stride, 'shortcut')
     else:
@@ -53,42 +73,96 @@ def bottleneck(inputs,
           scope='shortcut')
       flops += current_flops
 
-    if residual_mask is not None:
-      # Max-pooling trick only works correctly when stride is 1.
-      # We assume that stride=2 happens in the first layer where
-      # residual_mask is None.
-      assert stride == 1
+    if residual_mask is not None and stride > 1:
+      # Max-pooling trick only works correctly when stride is 1. conv1 is
+      # evaluated at the resolution of the inputs, so it is computed densely.
+      residual_mask = sparse_utils.downsample_mask(residual_mask, stride)
+      diluted_residual_mask = None
+      sparse_threshold = None
+    elif residual_mask is not None:
       diluted_residual_mask = slim.max_pool2d(
           residual_mask, [3, 3], stride=1, padding='SAME')
     else:
       diluted_residual_mask = None
 
-    residual, current_flops = flopsometer.conv2d(
-        preact,
-        depth_bottleneck, [1, 1],
-        stride=1,
-        output_mask=diluted_residual_mask,
-        scope='conv1')
-    flops += current_flops
+    def _dense_residual():
+      flops = 0
+      dense_flops = 0
+      residual, current_flops, current_dense_flops = flopsometer.conv2d(
+          preact,
+          depth_bottleneck, [1, 1],
+          stride=1,
+          output_mask=diluted_residual_mask,
+          return_dense_flops=True,
+          scope='conv1')
+      flops += current_flops
+      dense_flops += current_dense_flops
 
-    residual, current_flops = flopsometer.conv2d_same(
-        residual,
-        depth_bottleneck,
-        3,
-        stride,
-        rate=rate,
-        output_mask=residual_mask,
-        scope='conv2')
-    flops += current_flops
+      residual, current_flops, current_dense_flops = flopsometer.conv2d_same(
+          residual,
+          depth_bottleneck,
+          3,
+          stride,
+          rate=rate,
+          output_mask=residual_mask,
+          return_dense_flops=True,
+          scope='conv2')
+      flops += current_flops
+      dense_flops += current_dense_flops
+      features = residual
+
+      residual, current_flops, current_dense_flops = flopsometer.conv2d(
+          residual,
+          depth, [1, 1],
+          stride=1,
+          normalizer_fn=None,
+          activation_fn=None,
+          output_mask=residual_mask,
+          return_dense_flops=True,
+          scope='conv3')
+      flops += current_flops
+      dense_flops += current_dense_flops
+
+      return residual, flops, features, dense_flops
+
+    def _sparse_residual():
+      # conv1 is evaluated on the 3x3 halo of the active positions,
+      # conv2 and conv3 only on the active positions.
+      assert rate == 1
+      diluted_positions = sparse_utils.active_positions(diluted_residual_mask)
+      positions = sparse_utils.active_positions(residual_mask)
+
+      flops = 0
+      residual, current_flops = flopsometer.sparse_conv2d(
+          preact, diluted_positions, depth_bottleneck, [1, 1], scope='conv1')
+      residual = sparse_utils.scatter_positions(
+          residual, diluted_positions, preact)
+      flops += current_flops
+
+      residual, current_flops = flopsometer.sparse_conv2d(
+          residual, positions, depth_bottleneck, 3, scope='conv2')
+      residual = sparse_utils.scatter_positions(residual, positions, preact)
+      flops += current_flops
+      features = residual
+
+      residual, current_flops = flopsometer.sparse_conv2d(
+          residual,
+          positions,
+          depth, [1, 1],
+          normalizer_fn=None,
+          activation_fn=None,
+          scope='conv3')
+      residual = sparse_utils.scatter_positions(residual, positions, preact)
+      flops += current_flops
+
+      return residual, flops, features, flops
 
-    residual, current_flops = flopsometer.conv2d(
-        residual,
-        depth, [1, 1],
-        stride=1,
-        normalizer_fn=None,
-        activation_fn=None,
-        output_mask=residual_mask,
-        scope='conv3')
+    (residual, current_flops, features,
+     executed_flops) = sparse_utils.dense_or_sparse(
+         residual_mask, sparse_threshold, _dense_residual, _sparse_residual)
+    if realized_flops is not None:
+      # The shortcut is always evaluated densely.
+      realized_flops.append(flops + executed_flops)
     flops += current_flops
 
     if residual_mask is not None:
@@ -96,6 +170,8 @@ def bottleneck(inputs,
 
     outputs = shortcut + residual
 
+    if return_features:
+      return outputs, flops, features
     return outputs, flops
 
 
@@ -104,15 +180,35 @@ def resnet_v2(inputs,
               num_classes=None,
               global_pool=True,
               model_type='vanilla',
+              sparse_threshold=None,
+              compact_batch=False,
+              use_while_loop=False,
+              jit_halting=False,
+              jit_units=False,
+              recompute_units=False,
+              dtype=tf.float32,
+              valid_mask=None,
+              halting_head='conv',
+              tile_size=1,
+              cross_block_halting=False,
+              sact_early_stopping=False,
+              return_halting_distribution=False,
+              return_unit_data=False,
               scope=None,
               reuse=None,
               end_points=None):
-  with tf.variable_scope(scope, 'resnet_v2', [inputs], reuse=reuse) as sc:
+  if dtype != tf.float32 and use_while_loop:
+    raise ValueError('use_while_loop is only supported for float32 models.')
+  with tf.variable_scope(
+      scope, 'resnet_v2', [inputs], reuse=reuse,
+      custom_getter=mixed_precision.get_custom_getter(dtype)) as sc:
     if end_points is None:
       end_points = {}
     end_points['inputs'] = inputs
     end_points['flops'] = end_points.get('flops', 0)
-    net = inputs
+    # The model runs in `dtype`, the trainable variables are stored in
+    # float32 and the halting computations are performed in float32.
+    net = tf.cast(inputs, dtype)
     # We do not include batch normalization or activation functions in conv1
     # because the first ResNet unit will perform these. Cf. Appendix of [2].
     with slim.arg_scope([slim.conv2d], activation_fn=None, normalizer_fn=None):
@@ -125,13 +221,27 @@ def resnet_v2(inputs,
         net,
         blocks,
         model_type=model_type,
-        end_points=end_points)
+        end_points=end_points,
+        sparse_threshold=sparse_threshold,
+        compact_batch=compact_batch,
+        use_while_loop=use_while_loop,
+        jit_halting=jit_halting,
+        jit_units=jit_units,
+        recompute_units=recompute_units,
+        valid_mask=valid_mask,
+        halting_head=halting_head,
+        tile_size=tile_size,
+        cross_block_halting=cross_block_halting,
+        sact_early_stopping=sact_early_stopping,
+        return_halting_distribution=return_halting_distribution,
+        return_unit_data=return_unit_data)
 
     if global_pool or num_classes is not None:
       # This is needed because the pre-activation variant does not have batch
       # normalization or activation functions in the residual unit output. See
       # Appendix of [2].
-      net = slim.batch_norm(net, activation_fn=tf.nn.relu, scope='postnorm')
+      net = mixed_precision.batch_norm(
+          net, activation_fn=tf.nn.relu, scope='postnorm')
 
     if global_pool:
       # Global average pooling.
@@ -145,12 +255,17 @@ def resnet_v2(inputs,
           normalizer_fn=None,
           scope='logits')
       end_points['flops'] += current_flops
+      net = tf.to_float(net)
       end_points['predictions'] = slim.softmax(net, scope='predictions')
     return net, end_points
 
 
 def resnet_arg_scope(is_training=True):
-  return resnet_utils.resnet_arg_scope(is_training)
+  with slim.arg_scope(resnet_utils.resnet_arg_scope(is_training)):
+    # Normalize reduced precision activations in float32.
+    with slim.arg_scope([slim.conv2d],
+                        normalizer_fn=mixed_precision.batch_norm) as arg_sc:
+      return arg_sc
   # with slim.arg_scope(resnet_utils.resnet_arg_scope(is_training)):
     # # This forces batch_norm to compute the moving averages in-place
     # # instead of using a global collection which does not work with tf.cond.
@@ -164,6 +279,20 @@ def get_network(images,
                 model_type='vanilla',
                 global_pool=True,
                 base_channels=64,
+                sparse_threshold=None,
+                compact_batch=False,
+                use_while_loop=False,
+                jit_halting=False,
+                jit_units=False,
+                recompute_units=False,
+                dtype=tf.float32,
+                valid_mask=None,
+                halting_head='conv',
+                tile_size=1,
+                cross_block_halting=False,
+                sact_early_stopping=False,
+                return_halting_distribution=False,
+                return_unit_data=False,
                 scope=None,
                 reuse=None,
                 end_points=None):
@@ -183,6 +312,8 @@ def get_network(images,
   else:
     num_units = model
   assert len(num_units) == num_blocks
+  # The model type of every block, e.g. 'vanilla,vanilla,sact,sact'.
+  model_types = resnet_act.parse_model_type(model_type, num_blocks)
 
   b = resnet_utils.Block
   bc = base_channels
@@ -201,7 +332,21 @@ def get_network(images,
       blocks,
       num_classes,
       global_pool=global_pool,
-      model_type=model_type,
+      model_type=model_types,
+      sparse_threshold=sparse_threshold,
+      compact_batch=compact_batch,
+      use_while_loop=use_while_loop,
+      jit_halting=jit_halting,
+      jit_units=jit_units,
+      recompute_units=recompute_units,
+      dtype=dtype,
+      valid_mask=valid_mask,
+      halting_head=halting_head,
+      tile_size=tile_size,
+      cross_block_halting=cross_block_halting,
+      sact_early_stopping=sact_early_stopping,
+      return_halting_distribution=return_halting_distribution,
+      return_unit_data=return_unit_data,
       scope=scope,
       reuse=reuse,
       end_points=end_points)
@@ -108,6 +108,62 @@ class ImagenetModelTest(tf.test.TestCase):
         expected_flops = 15602814976
         self.assertAllEqual(flops, [expected_flops] * 3)
 
+  def testSparseSact(self):
+    batch_size = 2
+    height, width = 64, 64
+    num_classes = 10
+
+    with self.test_session() as sess:
+      images = tf.random_uniform((batch_size, height, width, 3))
+      with slim.arg_scope(imagenet_model.resnet_arg_scope(is_training=False)):
+        logits, end_points = imagenet_model.get_network(
+            images, [3, 3, 3, 3], num_classes, model_type='sact',
+            base_channels=2, scope='resnet_v2')
+        sparse_logits, sparse_end_points = imagenet_model.get_network(
+            images, [3, 3, 3, 3], num_classes, model_type='sact',
+            base_channels=2, sparse_threshold=1.0, scope='resnet_v2',
+            reuse=True)
+
+      sess.run(tf.global_variables_initializer())
+      (logits_out, flops_out, sparse_logits_out,
+       sparse_flops_out) = sess.run(
+           (logits, end_points['flops'], sparse_logits,
+            sparse_end_points['flops']))
+      self.assertAllClose(logits_out, sparse_logits_out)
+      self.assertAllEqual(flops_out, sparse_flops_out)
+
+  def testCrossBlockHalting(self):
+    batch_size = 2
+    height, width = 64, 64
+    num_classes = 10
+
+    with self.test_session() as sess:
+      images = tf.random_uniform((batch_size, height, width, 3))
+      with slim.arg_scope(imagenet_model.resnet_arg_scope(is_training=False)):
+        _, end_points = imagenet_model.get_network(
+            images, [2, 2, 2, 2], num_classes, model_type='sact',
+            base_channels=2, scope='resnet_v2')
+        _, cross_end_points = imagenet_model.get_network(
+            images, [2, 2, 2, 2], num_classes, model_type='sact',
+            base_channels=2, cross_block_halting=True, scope='resnet_v2',
+            reuse=True)
+
+      sess.run(tf.global_variables_initializer())
+      # All the positions of block1 halt after the first unit.
+      feed_dict = {end_points['block1/eps']: 0.99,
+                   cross_end_points['block1/eps']: 0.99}
+      (flops_out, cross_flops_out, cross_num_units_out) = sess.run(
+          ([end_points['block1/flops'], end_points['block2/flops']],
+           [cross_end_points['block1/flops'],
+            cross_end_points['block2/flops']],
+           cross_end_points['block2/num_units']),
+          feed_dict=feed_dict)
+      self.assertAllEqual(cross_flops_out[0], flops_out[0])
+      self.assertTrue(np.all(cross_flops_out[1] < flops_out[1]))
+      # block2 computes only the shortcut of its first unit and halts.
+      self.assertAllEqual(cross_num_units_out,
+                          np.ones_like(cross_num_units_out))
+
   def testVisualizationBasic(self):
     batch_size = 5
     height, width = 128, 128
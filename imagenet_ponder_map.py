@@ -27,6 +27,7 @@ import matplotlib
 import matplotlib.image
 matplotlib.use('agg')  # disables drawing to X
 import matplotlib.pyplot as plt
+import numpy as np
 import tensorflow as tf
 from tensorflow.contrib import slim
 
@@ -55,19 +56,92 @@ tf.app.flags.DEFINE_integer(
     'Resize the input image so that the longer edge has this many pixels.'
     'Not resizing if set to zero (the default).')
 
+tf.app.flags.DEFINE_integer(
+    'batch_size', 1,
+    'The number of images processed together. The images are padded to the '
+    'size of their bucket. Values greater than one require --image_size, '
+    'which bounds the number of buckets.')
+
+tf.app.flags.DEFINE_integer(
+    'bucket_step', 64,
+    'The height and the width of the images are padded to a multiple of '
+    'this value, which defines the buckets of the images processed together. '
+    'Should be a multiple of 32, the output stride of the network. A network '
+    'is built for every bucket, at most 2 * ceil(image_size / bucket_step) - 1 '
+    'of them, since the longer edge of the resized images is image_size.')
+
+tf.app.flags.DEFINE_string(
+    'halting_head', 'conv',
+    'For sact models, the halting head: conv (3x3 convolution of the unit '
+    'outputs), conv1x1, separable (1x1 convolution to a single channel '
+    'followed by a 3x3 convolution) or bottleneck (3x3 convolution of the '
+    'narrow features of the residual branch). Should match the trained '
+    'model.')
+
+tf.app.flags.DEFINE_string(
+    'tile_size', '1',
+    'For sact blocks, the size of the tiles for which the halting is decided, '
+    'or an underscore separated list with the size for every block '
+    '(e.g. 1_1_4_2). Should match the trained model.')
+
+tf.app.flags.DEFINE_string(
+    'precision', 'float32',
+    'Type of the convolutions and the activations: float32 or float16. The '
+    'variables and the halting computations are float32. float16 only saves '
+    'memory and time on GPUs, the CPU kernels of TensorFlow emulate it. '
+    'bfloat16 is not supported.')
+
+
 def preprocessing(image):
   image = tf.subtract(image, 0.5)
   image = tf.multiply(image, 2.0)
   return image
 
 
-def reverse_preprocessing(image):
-  image = tf.multiply(image, 0.5)
-  image = tf.add(image, 0.5)
-  return image
+def _bucket_shape(height, width):
+  """Returns the padded size of an image, a multiple of the bucket step.
+
+  Without batching, every image is processed at its own size by a single
+  network with dynamic shapes, and None is returned.
+  """
+  if FLAGS.batch_size == 1:
+    return None
+  step = FLAGS.bucket_step
+  return (int(math.ceil(height / step)) * step,
+          int(math.ceil(width / step)) * step)
+
+
+def _save_results(current_path, image_out, ponder_cost_map_out):
+  basename = os.path.splitext(os.path.basename(current_path))[0]
+  if FLAGS.image_size:
+    matplotlib.image.imsave(
+        os.path.join(FLAGS.output_dir, '{}_im.jpg'.format(basename)),
+        image_out)
+  matplotlib.image.imsave(
+      os.path.join(FLAGS.output_dir, '{}_ponder.jpg'.format(basename)),
+      ponder_cost_map_out,
+      cmap='viridis')
+
+  min_ponder = ponder_cost_map_out.min()
+  max_ponder = ponder_cost_map_out.max()
+  print('Minimum/maximum ponder cost {:.2f}/{:.2f}'.format(
+      min_ponder, max_ponder))
+
+  fig = plt.figure(figsize=(0.2, 2))
+  ax = fig.add_axes([0.0, 0.0, 1.0, 1.0])
+  cb = matplotlib.colorbar.ColorbarBase(
+      ax, cmap='viridis',
+      norm=matplotlib.colors.Normalize(vmin=min_ponder, vmax=max_ponder))
+  ax.tick_params(labelsize=12)
+  filename = os.path.join(FLAGS.output_dir, '{}_colorbar.pdf'.format(basename))
+  plt.savefig(filename, bbox_inches='tight')
+  plt.close(fig)
 
 
 def main(_):
+  if FLAGS.batch_size > 1 and not FLAGS.image_size:
+    # Every size of the original images could need its own network.
+    raise ValueError('batch_size greater than one requires image_size.')
   if not tf.gfile.Exists(FLAGS.output_dir):
     tf.gfile.MakeDirs(FLAGS.output_dir)
 
@@ -95,57 +169,92 @@ def main(_):
   else:
     images_resized = images
 
-  images_resized = preprocessing(images_resized)
-
-  # Define the model:
-  with slim.arg_scope(imagenet_model.resnet_arg_scope(is_training=False)):
-    model = utils.split_and_int(FLAGS.model)
-    logits, end_points = imagenet_model.get_network(
-        images_resized,
-        model,
-        num_classes,
-        model_type='sact')
-    ponder_cost_map = summary_utils.sact_map(end_points, 'ponder_cost')
+  image_preprocessed = tf.squeeze(preprocessing(images_resized), 0)
 
   checkpoint_path = tf.train.latest_checkpoint(FLAGS.checkpoint_dir)
   assert checkpoint_path is not None
 
-  saver = tf.train.Saver()
+  model = utils.split_and_int(FLAGS.model)
   sess = tf.Session()
 
-  saver.restore(sess, checkpoint_path)
-
+  # The images are padded to a few bucket sizes. A network with static shapes
+  # is built for every bucket, all of them share the variables. Without
+  # batching, a single network with dynamic shapes and without padding is
+  # used for all the images.
+  networks = {}
+
+  def _get_network(bucket_shape):
+    if bucket_shape not in networks:
+      if bucket_shape is None:
+        batch_images = tf.placeholder(tf.float32, [1, None, None, 3])
+        batch_valid_mask = None
+      else:
+        batch_images = tf.placeholder(
+            tf.float32, [FLAGS.batch_size] + list(bucket_shape) + [3])
+        batch_valid_mask = tf.placeholder(
+            tf.float32, [FLAGS.batch_size] + list(bucket_shape) + [1])
+      with slim.arg_scope(imagenet_model.resnet_arg_scope(is_training=False)):
+        _, end_points = imagenet_model.get_network(
+            batch_images,
+            model,
+            num_classes,
+            model_type='sact',
+            valid_mask=batch_valid_mask,
+            halting_head=FLAGS.halting_head,
+            tile_size=utils.split_and_int(FLAGS.tile_size),
+            dtype=tf.as_dtype(FLAGS.precision),
+            scope='resnet_v2',
+            reuse=True if networks else None)
+        ponder_cost_map = summary_utils.sact_map(end_points, 'ponder_cost')
+      if not networks:
+        saver = tf.train.Saver()
+        saver.restore(sess, checkpoint_path)
+      networks[bucket_shape] = (batch_images, batch_valid_mask,
+                                tf.squeeze(ponder_cost_map, [3]))
+    return networks[bucket_shape]
+
+  def _process_bucket(bucket_shape, bucket):
+    (batch_images, batch_valid_mask, ponder_cost_map) = _get_network(
+        bucket_shape)
+    if bucket_shape is None:
+      ((_, image_value),) = bucket
+      ponder_cost_map_out = sess.run(
+          ponder_cost_map, feed_dict={batch_images: image_value[None]})
+    else:
+      # Zero padding of the preprocessed images, like in SAME convolutions.
+      images_value = np.zeros(batch_images.get_shape().as_list(),
+                              dtype=np.float32)
+      valid_mask_value = np.zeros(batch_valid_mask.get_shape().as_list(),
+                                  dtype=np.float32)
+      for (i, (_, image_value)) in enumerate(bucket):
+        (height, width) = image_value.shape[:2]
+        images_value[i, :height, :width] = image_value
+        valid_mask_value[i, :height, :width] = 1.
+      ponder_cost_map_out = sess.run(
+          ponder_cost_map,
+          feed_dict={batch_images: images_value,
+                     batch_valid_mask: valid_mask_value})
+    for (i, (current_path, image_value)) in enumerate(bucket):
+      (height, width) = image_value.shape[:2]
+      # Reverse the preprocessing and crop the padding.
+      _save_results(current_path,
+                    np.clip(image_value * 0.5 + 0.5, 0., 1.),
+                    ponder_cost_map_out[i, :height, :width])
+
+  buckets = {}
   for current_path in glob.glob(FLAGS.images_pattern):
     print('Processing {}'.format(current_path))
-
-    [image_resized_out, ponder_cost_map_out] = sess.run(
-        [tf.squeeze(reverse_preprocessing(images_resized), 0),
-         tf.squeeze(ponder_cost_map, [0, 3])],
-        feed_dict={path: current_path})
-
-    basename = os.path.splitext(os.path.basename(current_path))[0]
-    if FLAGS.image_size:
-      matplotlib.image.imsave(
-          os.path.join(FLAGS.output_dir, '{}_im.jpg'.format(basename)),
-          image_resized_out)
-    matplotlib.image.imsave(
-        os.path.join(FLAGS.output_dir, '{}_ponder.jpg'.format(basename)),
-        ponder_cost_map_out,
-        cmap='viridis')
-
-    min_ponder = ponder_cost_map_out.min()
-    max_ponder = ponder_cost_map_out.max()
-    print('Minimum/maximum ponder cost {:.2f}/{:.2f}'.format(
-        min_ponder, max_ponder))
-
-    fig = plt.figure(figsize=(0.2, 2))
-    ax = fig.add_axes([0.0, 0.0, 1.0, 1.0])
-    cb = matplotlib.colorbar.ColorbarBase(
-        ax, cmap='viridis',
-        norm=matplotlib.colors.Normalize(vmin=min_ponder, vmax=max_ponder))
-    ax.tick_params(labelsize=12)
-    filename = os.path.join(FLAGS.output_dir, '{}_colorbar.pdf'.format(basename))
-    plt.savefig(filename, bbox_inches='tight')
+    image_value = sess.run(image_preprocessed, feed_dict={path: current_path})
+    bucket_shape = _bucket_shape(*image_value.shape[:2])
+    bucket = buckets.setdefault(bucket_shape, [])
+    bucket.append((current_path, image_value))
+    if len(bucket) == FLAGS.batch_size:
+      _process_bucket(bucket_shape, bucket)
+      del buckets[bucket_shape]
+
+  # Process the incomplete batches.
+  for (bucket_shape, bucket) in buckets.items():
+    _process_bucket(bucket_shape, bucket)
 
 
 if __name__ == '__main__':
@@ -24,6 +24,8 @@ from tensorflow.contrib import slim
 
 import imagenet_data_provider
 import imagenet_model
+import mixed_precision
+import resnet_act
 import summary_utils
 import training_utils
 import utils
@@ -61,6 +63,22 @@ tf.app.flags.DEFINE_integer('task', 0, 'Task id of the replica running the train
 
 tf.app.flags.DEFINE_string('dataset_dir', None, 'Directory with ImageNet data.')
 
+tf.app.flags.DEFINE_bool(
+    'use_tf_data', False,
+    'Read the data with a tf.data input pipeline instead of queue runners. '
+    'Requires TensorFlow 1.12 or newer.')
+
+tf.app.flags.DEFINE_integer(
+    'shuffle_buffer_size', 10000,
+    'With --use_tf_data, the number of training examples in the shuffle '
+    'buffer.')
+
+tf.app.flags.DEFINE_bool(
+    'decode_and_crop', False,
+    'Sample the random crop of every training image before decoding it and '
+    'decode only the crop, at a reduced scale if it is large. Requires JPEG '
+    'images and TensorFlow 1.5 or newer.')
+
 # Training parameters.
 tf.app.flags.DEFINE_integer('batch_size', 32,
                         'The number of images in each batch.')
@@ -94,13 +112,82 @@ tf.app.flags.DEFINE_string(
     'model_type', 'vanilla',
     'Options: vanilla (basic ResNet model), act (Adaptive Computation Time), '
     'act_early_stopping (act implementation which actually saves time), '
-    'sact (Spatially Adaptive Computation Time)')
+    'sact (Spatially Adaptive Computation Time), '
+    'or a comma separated list with the type of every block, e.g. '
+    'vanilla,vanilla,sact,sact')
 
 tf.app.flags.DEFINE_float('tau', 1.0, 'Target value of tau (ponder relative cost).')
 
+tf.app.flags.DEFINE_float(
+    'target_flops', 0.0,
+    'If positive, tau is adapted during training, starting from --tau, so '
+    'that the model reaches this mean number of GFLOPs per image. --tau '
+    'should then be positive.')
+
+tf.app.flags.DEFINE_float(
+    'target_ponder_cost', 0.0,
+    'If positive, tau is adapted during training, starting from --tau, so '
+    'that the model reaches this mean total ponder cost. --tau should then '
+    'be positive.')
+
+tf.app.flags.DEFINE_float(
+    'tau_rate', 0.01,
+    'The step size of the updates of log(tau) for --target_flops and '
+    '--target_ponder_cost.')
+
+tf.app.flags.DEFINE_bool(
+    'flops_weighted_ponder_cost', False,
+    'Weight the ponder cost of every block by the FLOPs of its residual '
+    'units, normalized to average to one over the blocks.')
+
 tf.app.flags.DEFINE_string('finetune_path', '',
                        'Path for the initial checkpoint for finetuning.')
 
+tf.app.flags.DEFINE_bool(
+    'jit_halting', False,
+    'For act, act_early_stopping and sact models: compile the halting '
+    'computations of every residual unit with XLA.')
+
+tf.app.flags.DEFINE_bool(
+    'jit_units', False, 'Compile every residual unit with XLA.')
+
+tf.app.flags.DEFINE_bool(
+    'recompute_units', False,
+    'Recompute every residual unit during the backward pass instead of '
+    'keeping its activations. Reduces the memory used by training.')
+
+tf.app.flags.DEFINE_string(
+    'precision', 'float32',
+    'Type of the convolutions and the activations: float32 or float16. The '
+    'variables and the halting computations are float32. float16 only saves '
+    'memory and time on GPUs, the CPU kernels of TensorFlow emulate it. '
+    'bfloat16 is not supported.')
+
+tf.app.flags.DEFINE_string(
+    'halting_head', 'conv',
+    'For sact models, the halting head: conv (3x3 convolution of the unit '
+    'outputs), conv1x1, separable (1x1 convolution to a single channel '
+    'followed by a 3x3 convolution) or bottleneck (3x3 convolution of the '
+    'narrow features of the residual branch).')
+
+tf.app.flags.DEFINE_string(
+    'tile_size', '1',
+    'For sact blocks, the size of the tiles for which the halting is decided, '
+    'or an underscore separated list with the size for every block '
+    '(e.g. 1_1_4_2). Tiles larger than one position give contiguous active '
+    'regions.')
+
+tf.app.flags.DEFINE_bool(
+    'cross_block_halting', False,
+    'For sact models, compute the first unit of a block only where the '
+    'previous block used more than one unit. The other positions halt after '
+    'the first unit.')
+
+tf.app.flags.DEFINE_float(
+    'loss_scale', 1.0,
+    'The loss is multiplied by this value before computing the gradients. '
+    'Prevents the underflow of the float16 gradients, e.g. 128.')
+
 
 def main(_):
   g = tf.Graph()
@@ -115,7 +202,10 @@ def main(_):
           FLAGS.batch_size,
           dataset_dir=FLAGS.dataset_dir,
           is_training=True,
-          image_size=FLAGS.image_size)
+          image_size=FLAGS.image_size,
+          use_tf_data=FLAGS.use_tf_data,
+          shuffle_buffer_size=FLAGS.shuffle_buffer_size,
+          decode_and_crop=FLAGS.decode_and_crop)
       images, labels, examples_per_epoch, num_classes = data_tuple
 
       # Define the model:
@@ -125,13 +215,33 @@ def main(_):
             images,
             model,
             num_classes,
-            model_type=FLAGS.model_type)
+            model_type=FLAGS.model_type,
+            jit_halting=FLAGS.jit_halting,
+            jit_units=FLAGS.jit_units,
+            recompute_units=FLAGS.recompute_units,
+            dtype=tf.as_dtype(FLAGS.precision),
+            halting_head=FLAGS.halting_head,
+            tile_size=utils.split_and_int(FLAGS.tile_size),
+            cross_block_halting=FLAGS.cross_block_halting)
 
         # Specify the loss function:
         tf.losses.softmax_cross_entropy(
             onehot_labels=labels, logits=logits, label_smoothing=0.1, weights=1.0)
-        if FLAGS.model_type in ('act', 'act_early_stopping', 'sact'):
-          training_utils.add_all_ponder_costs(end_points, weights=FLAGS.tau)
+        tau = FLAGS.tau
+        if FLAGS.target_flops > 0 or FLAGS.target_ponder_cost > 0:
+          tau = training_utils.adaptive_tau(
+              end_points,
+              FLAGS.tau,
+              target_flops=FLAGS.target_flops * 1e9,
+              target_ponder_cost=FLAGS.target_ponder_cost,
+              rate=FLAGS.tau_rate)
+          tf.summary.scalar('training/Tau', tau)
+        if (resnet_act.is_adaptive(FLAGS.model_type) and
+            FLAGS.flops_weighted_ponder_cost):
+          training_utils.add_all_flops_weighted_ponder_costs(
+              end_points, weights=tau)
+        elif resnet_act.is_adaptive(FLAGS.model_type):
+          training_utils.add_all_ponder_costs(end_points, weights=tau)
         total_loss = tf.losses.get_total_loss()
 
         # Configure the learning rate using an exponetial decay.
@@ -146,6 +256,8 @@ def main(_):
             staircase=True)
 
         opt = tf.train.MomentumOptimizer(learning_rate, FLAGS.momentum)
+        if FLAGS.loss_scale != 1.0:
+          opt = mixed_precision.LossScaleOptimizer(opt, FLAGS.loss_scale)
 
         init_fn = training_utils.finetuning_init_fn(FLAGS.finetune_path)
 
@@ -159,12 +271,12 @@ def main(_):
         tf.summary.scalar('training/Learning Rate', learning_rate)
 
         metric_map = {}  # summary_utils.flops_metric_map(end_points, False)
-        if FLAGS.model_type in ('act', 'act_early_stopping', 'sact'):
+        if resnet_act.is_adaptive(FLAGS.model_type):
           metric_map.update(summary_utils.act_metric_map(end_points, False))
         for name, value in metric_map.iteritems():
           tf.summary.scalar(name, value)
 
-        if FLAGS.model_type == 'sact':
+        if resnet_act.has_sact(FLAGS.model_type):
           summary_utils.add_heatmaps_image_summary(end_points, border=10)
 
         startup_delay_steps = FLAGS.task * FLAGS.startup_delay_steps
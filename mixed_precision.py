@@ -0,0 +1,130 @@
+# Copyright 2016 Google Inc. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# ==============================================================================
+
+"""Utilities for running the models in reduced precision.
+
+The convolutions and the activations use float16, while the variables are
+stored in float32, and batch normalization and the halting computations of the
+ACT modules are performed in float32.
+
+float16 halves the memory and the bandwidth of the activations only on GPUs.
+The CPU kernels of TensorFlow emulate the float16 convolutions, so they are
+not faster than float32 ones. bfloat16 is not supported: its convolutions are
+not implemented by the CPU and GPU kernels of the TensorFlow versions in
+`requirements.txt`.
+"""
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import tensorflow as tf
+
+from tensorflow.contrib import slim
+
+
+def float32_variable_storage_getter(getter, name, shape=None, dtype=None,
+                                    *args, **kwargs):
+  """Custom getter which stores the floating point variables in float32.
+
+  The variables requested in a reduced precision type are created in float32
+  and cast to the requested type, so the updates of the optimizer are not
+  lost to rounding and the checkpoints are compatible with float32 models.
+  The cast variables cannot be assigned to, so the layers which update their
+  variables in the forward pass, like `batch_norm`, should request float32
+  variables.
+  """
+  storage_dtype = dtype
+  if dtype is not None and dtype.is_floating:
+    storage_dtype = tf.float32
+  variable = getter(name, shape, dtype=storage_dtype, *args, **kwargs)
+  if storage_dtype != dtype:
+    variable = tf.cast(variable, dtype)
+  return variable
+
+
+# The types of the convolutions and the activations of the models.
+SUPPORTED_DTYPES = (tf.float32, tf.float16)
+
+
+def get_custom_getter(dtype):
+  """Returns the custom getter of the model variables for `dtype`.
+
+  Raises:
+    ValueError: If `dtype` is not in `SUPPORTED_DTYPES`.
+  """
+  if dtype not in SUPPORTED_DTYPES:
+    raise ValueError('Unsupported model dtype {}, expected one of {}.'.format(
+        dtype.name, ', '.join(x.name for x in SUPPORTED_DTYPES)))
+  if dtype == tf.float32:
+    return None
+  return float32_variable_storage_getter
+
+
+def batch_norm(inputs, *args, **kwargs):
+  """A substitute for slim.batch_norm which normalizes in float32.
+
+  The statistics of reduced precision activations are computed in float32 and
+  the moving averages are float32 variables. The outputs have the type of
+  `inputs`. For float32 inputs, this is the same as slim.batch_norm.
+  """
+  if inputs.dtype.base_dtype == tf.float32:
+    return slim.batch_norm(inputs, *args, **kwargs)
+  outputs = slim.batch_norm(tf.to_float(inputs), *args, **kwargs)
+  return tf.cast(outputs, inputs.dtype.base_dtype)
+
+
+class LossScaleOptimizer(tf.train.Optimizer):
+  """An optimizer which multiplies the loss by a constant loss scale.
+
+  The gradients of the scaled loss are divided by the loss scale before they
+  are applied, so the small gradients of the 16-bit activations do not
+  underflow in the backward pass.
+  """
+
+  def __init__(self, optimizer, loss_scale, name='LossScaleOptimizer'):
+    """Creates the optimizer.
+
+    Args:
+      optimizer: The wrapped `tf.train.Optimizer`.
+      loss_scale: A positive `float`. The loss scale.
+      name: Name of the optimizer.
+    """
+    super(LossScaleOptimizer, self).__init__(
+        use_locking=False, name=name)
+    self._optimizer = optimizer
+    self._loss_scale = loss_scale
+
+  def compute_gradients(self, loss, *args, **kwargs):
+    grads_and_vars = self._optimizer.compute_gradients(
+        loss * self._loss_scale, *args, **kwargs)
+    return [(self._unscale(grad), var) for (grad, var) in grads_and_vars]
+
+  def _unscale(self, grad):
+    if grad is None:
+      return None
+    if isinstance(grad, tf.IndexedSlices):
+      return tf.IndexedSlices(grad.values / self._loss_scale, grad.indices,
+                              grad.dense_shape)
+    return grad / self._loss_scale
+
+  def apply_gradients(self, *args, **kwargs):
+    return self._optimizer.apply_gradients(*args, **kwargs)
+
+  def get_slot(self, *args, **kwargs):
+    return self._optimizer.get_slot(*args, **kwargs)
+
+  def get_slot_names(self, *args, **kwargs):
+    return self._optimizer.get_slot_names(*args, **kwargs)
@@ -0,0 +1,69 @@
+# Copyright 2016 Google Inc. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# ==============================================================================
+
+"""Tests for mixed_precision."""
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import tensorflow as tf
+from tensorflow.contrib import slim
+
+import mixed_precision
+
+
+class MixedPrecisionTest(tf.test.TestCase):
+
+  def testFloat32VariableStorage(self):
+    inputs = tf.random_normal([2, 5, 5, 3], dtype=tf.float16)
+    with tf.variable_scope(
+        'model',
+        custom_getter=mixed_precision.get_custom_getter(tf.float16)):
+      outputs = slim.conv2d(
+          inputs, 4, 3, normalizer_fn=mixed_precision.batch_norm)
+    self.assertEqual(outputs.dtype, tf.float16)
+    self.assertEqual(len(tf.global_variables()), 4)
+    for v in tf.global_variables():
+      self.assertEqual(v.dtype.base_dtype, tf.float32)
+    with self.test_session() as sess:
+      sess.run(tf.global_variables_initializer())
+      sess.run(tf.get_collection(tf.GraphKeys.UPDATE_OPS))
+
+  def testNoCustomGetterForFloat32(self):
+    self.assertIsNone(mixed_precision.get_custom_getter(tf.float32))
+
+  def testUnsupportedDtype(self):
+    with self.assertRaises(ValueError):
+      mixed_precision.get_custom_getter(tf.bfloat16)
+
+  def testLossScaleOptimizer(self):
+    x = tf.get_variable('x', initializer=tf.constant([1.0, -2.0]))
+    loss = tf.reduce_sum(tf.square(x))
+    optimizer = tf.train.GradientDescentOptimizer(0.1)
+    (grad, _), = optimizer.compute_gradients(loss, [x])
+    scaled_optimizer = mixed_precision.LossScaleOptimizer(optimizer, 128.)
+    (scaled_grad, _), = scaled_optimizer.compute_gradients(loss, [x])
+    train_op = scaled_optimizer.minimize(loss, var_list=[x])
+    with self.test_session() as sess:
+      sess.run(tf.global_variables_initializer())
+      (grad_out, scaled_grad_out) = sess.run((grad, scaled_grad))
+      self.assertAllClose(grad_out, scaled_grad_out)
+      sess.run(train_op)
+      self.assertAllClose(sess.run(x), [0.8, -1.6])
+
+
+if __name__ == '__main__':
+  tf.test.main()
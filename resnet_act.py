@@ -19,140 +19,976 @@ from __future__ import absolute_import
 from __future__ import division
 from __future__ import print_function
 
+import contextlib
 from functools import partial
+import itertools
 
 import h5py
 import tensorflow as tf
 
 from tensorflow.contrib import slim
+from tensorflow.contrib.compiler import jit
+from tensorflow.python.framework import function
 
 import act
 import flopsometer
+import mixed_precision
+import sparse_utils
 
 
 SACT_KERNEL_SIZE = 3
 INIT_BIAS = -3.
 
+# Makes the names of the recomputation functions unique. The gradient of a
+# function call is looked up by the name of the function.
+_recompute_counter = itertools.count()
+
+MODEL_TYPES = ('vanilla', 'act', 'act_early_stopping', 'sact')
+ADAPTIVE_MODEL_TYPES = ('act', 'act_early_stopping', 'sact')
+
+
+def _split_model_type(model_type):
+  if isinstance(model_type, (list, tuple)):
+    return list(model_type)
+  return model_type.split(',')
+
+
+def parse_model_type(model_type, num_blocks):
+  """Returns the list of the model types of the blocks.
+
+  Args:
+    model_type: One of `MODEL_TYPES`, used for all the blocks, or a comma
+      separated string (or a list) with the model type of every block, e.g.
+      'vanilla,vanilla,sact,sact'.
+    num_blocks: The number of blocks of the model.
+
+  Returns:
+    A list of `num_blocks` model types.
+
+  Raises:
+    ValueError: If the number of model types does not match the number of
+      blocks or a model type is unknown.
+  """
+  model_types = _split_model_type(model_type)
+  if len(model_types) == 1:
+    model_types *= num_blocks
+  if len(model_types) != num_blocks:
+    raise ValueError('Expected 1 or {} model types, got {}.'.format(
+        num_blocks, model_type))
+  for block_model_type in model_types:
+    if block_model_type not in MODEL_TYPES:
+      raise ValueError('Unknown model type {}.'.format(block_model_type))
+  return model_types
+
+
+def is_adaptive(model_type):
+  """Whether any block of `model_type` has adaptive computation time."""
+  return any(block_model_type in ADAPTIVE_MODEL_TYPES
+             for block_model_type in _split_model_type(model_type))
+
+
+def has_sact(model_type):
+  """Whether any block of `model_type` is a SACT block."""
+  return 'sact' in _split_model_type(model_type)
+
 
 def get_halting_proba(outputs):
   with tf.variable_scope('halting_proba'):
     x = outputs
     x = tf.reduce_mean(x, [1, 2], keep_dims=True)
 
-    x = slim.batch_norm(x, scope='global_bn')
-    halting_proba, flops = flopsometer.conv2d(
+    x = mixed_precision.batch_norm(x, scope='global_bn')
+    halting_logit, flops = flopsometer.conv2d(
         x,
         1,
         1,
-        activation_fn=tf.nn.sigmoid,
+        activation_fn=None,
         normalizer_fn=None,
         biases_initializer=tf.constant_initializer(INIT_BIAS),
         scope='global_conv')
+    # The halting probabilities are always computed in float32.
+    halting_proba = tf.sigmoid(tf.to_float(halting_logit))
     halting_proba = tf.squeeze(halting_proba, [1, 2])
 
     return halting_proba, flops
 
 
-def get_halting_proba_conv(outputs, residual_mask=None):
-  with tf.variable_scope('halting_proba'):
-    flops = 0
+def _halo_positions(residual_mask, kernel_size):
+  """Returns the positions in the receptive fields of the active positions."""
+  if kernel_size > 1:
+    residual_mask = slim.max_pool2d(
+        residual_mask, [kernel_size, kernel_size], stride=1, padding='SAME')
+  return sparse_utils.active_positions(residual_mask)
 
-    x = outputs
 
-    local_feature = slim.batch_norm(x, scope='local_bn')
-    halting_logit, current_flops = flopsometer.conv2d(
-        local_feature,
-        1,
-        SACT_KERNEL_SIZE,
-        activation_fn=None,
-        normalizer_fn=None,
-        biases_initializer=tf.constant_initializer(INIT_BIAS),
-        output_mask=residual_mask,
-        scope='local_conv')
+def _resize_valid_mask(valid_mask, x):
+  """Resizes `valid_mask` to the resolution of `x`, with the type of `x`.
+
+  Uses the nearest neighbor method, like
+  `act.spatially_adaptive_computation_time`.
+  """
+  if x.get_shape()[1:3].is_fully_defined():
+    size = x.get_shape()[1:3].as_list()
+  else:
+    size = tf.shape(x)[1:3]
+  valid_mask = tf.image.resize_nearest_neighbor(
+      tf.to_float(valid_mask), size, align_corners=False)
+  return tf.cast(valid_mask, x.dtype)
+
+
+def _spatial_mean(x, valid_mask=None):
+  """The mean of `x` over the (valid) spatial positions, keeps the dims."""
+  if valid_mask is None:
+    return tf.reduce_mean(x, [1, 2], keep_dims=True)
+  num_valid = tf.reduce_sum(valid_mask, [1, 2], keep_dims=True)
+  return (tf.reduce_sum(x * valid_mask, [1, 2], keep_dims=True) /
+          tf.maximum(num_valid, 1.))
+
+
+def _sparse_batch_norm(x, positions, scope):
+  """Batch norm of `x` at `positions`, the other positions are zero.
+
+  Intended for inference, in training mode the statistics would be computed
+  over `positions`.
+  """
+  outputs = mixed_precision.batch_norm(tf.gather_nd(x, positions), scope=scope)
+  return sparse_utils.scatter_positions(outputs, positions, x)
+
+
+def _sparse_halting_conv(x, positions, kernel_size, biases_initializer, scope):
+  """A single-channel `flopsometer.sparse_conv2d` scattered into a map."""
+  outputs, flops = flopsometer.sparse_conv2d(
+      x,
+      positions,
+      1,
+      kernel_size,
+      activation_fn=None,
+      normalizer_fn=None,
+      biases_initializer=biases_initializer,
+      scope=scope)
+  return sparse_utils.scatter_positions(outputs, positions, x), flops
+
+
+def _local_halting_logit(x, kernel_size, residual_mask=None, sparse=False,
+                         valid_mask=None):
+  """Returns the local halting logits, their flops and the executed flops."""
+  biases_initializer = tf.constant_initializer(INIT_BIAS)
+  if sparse:
+    local_feature = _sparse_batch_norm(
+        x, _halo_positions(residual_mask, kernel_size), scope='local_bn')
+    if valid_mask is not None:
+      local_feature *= valid_mask
+    halting_logit, flops = _sparse_halting_conv(
+        local_feature, sparse_utils.active_positions(residual_mask),
+        kernel_size, biases_initializer, scope='local_conv')
+    return halting_logit, flops, flops
+
+  local_feature = mixed_precision.batch_norm(x, scope='local_bn')
+  if valid_mask is not None:
+    local_feature *= valid_mask
+  return flopsometer.conv2d(
+      local_feature,
+      1,
+      kernel_size,
+      activation_fn=None,
+      normalizer_fn=None,
+      biases_initializer=biases_initializer,
+      output_mask=residual_mask,
+      return_dense_flops=True,
+      scope='local_conv')
+
+
+def _spatial_halting_proba(x, halting_logit, global_feature=None,
+                           valid_mask=None):
+  """Adds the global halting logit and computes the halting probabilities.
+
+  Args:
+    x: The features of the halting head.
+    halting_logit: The local halting logits, a 4-D `Tensor` with one channel.
+    global_feature: An optional spatial mean of `x`, computed if not given.
+    valid_mask: An optional mask of the valid positions of `x`. The mean is
+      computed only over these positions.
+
+  Returns:
+    halting_proba: The halting probabilities, a 4-D `float32` `Tensor`.
+    flops: The operation count of the global halting logit.
+  """
+  if global_feature is None:
+    global_feature = _spatial_mean(x, valid_mask)
+  global_feature = mixed_precision.batch_norm(global_feature,
+                                              scope='global_bn')
+  halting_logit_global, flops = flopsometer.conv2d(
+      global_feature,
+      1,
+      1,
+      activation_fn=None,
+      normalizer_fn=None,
+      biases_initializer=None,  # biases are already present in local logits
+      scope='global_conv')
+
+  # Addition with broadcasting over spatial dimensions.
+  halting_logit += halting_logit_global
+
+  # The halting probabilities are always computed in float32.
+  halting_proba = tf.sigmoid(tf.to_float(halting_logit))
+
+  return halting_proba, flops
+
+
+def get_halting_proba_conv(outputs, residual_mask=None, global_feature=None,
+                           sparse=False, valid_mask=None,
+                           return_realized_flops=False):
+  with tf.variable_scope('halting_proba'):
+    halting_logit, flops, realized_flops = _local_halting_logit(
+        outputs, SACT_KERNEL_SIZE, residual_mask, sparse, valid_mask)
+    halting_proba, current_flops = _spatial_halting_proba(
+        outputs, halting_logit, global_feature, valid_mask)
     flops += current_flops
+    realized_flops += current_flops
 
-    # Add global halting logit.
-    global_feature = tf.reduce_mean(x, [1, 2], keep_dims=True)
-    global_feature = slim.batch_norm(global_feature, scope='global_bn')
-    halting_logit_global, current_flops = flopsometer.conv2d(
-        global_feature,
-        1,
-        1,
-        activation_fn=None,
-        normalizer_fn=None,
-        biases_initializer=None,  # biases are already present in local logits
-        scope='global_conv')
+    if return_realized_flops:
+      return halting_proba, flops, realized_flops
+    return halting_proba, flops
+
+
+def get_halting_proba_conv1x1(outputs, residual_mask=None,
+                              global_feature=None, sparse=False,
+                              valid_mask=None, return_realized_flops=False):
+  """A cheaper version of `get_halting_proba_conv` with 1x1 local logits."""
+  with tf.variable_scope('halting_proba'):
+    halting_logit, flops, realized_flops = _local_halting_logit(
+        outputs, 1, residual_mask, sparse, valid_mask)
+    halting_proba, current_flops = _spatial_halting_proba(
+        outputs, halting_logit, global_feature, valid_mask)
     flops += current_flops
+    realized_flops += current_flops
+
+    if return_realized_flops:
+      return halting_proba, flops, realized_flops
+    return halting_proba, flops
+
 
-    # Addition with broadcasting over spatial dimensions.
-    halting_logit += halting_logit_global
+def get_halting_proba_separable(outputs, residual_mask=None,
+                                global_feature=None, sparse=False,
+                                valid_mask=None, return_realized_flops=False):
+  """A cheaper version of `get_halting_proba_conv` with separable logits.
 
-    halting_proba = tf.sigmoid(halting_logit)
+  The features are reduced to a single channel by a 1x1 convolution, followed
+  by a 3x3 convolution of this channel. The receptive field is the same as
+  for `get_halting_proba_conv` at the cost of `get_halting_proba_conv1x1`.
+  """
+  with tf.variable_scope('halting_proba'):
+    flops = 0
+    realized_flops = 0
+    biases_initializer = tf.constant_initializer(INIT_BIAS)
 
+    if sparse:
+      # The pointwise logits are needed on the 3x3 halo of the active
+      # positions.
+      halo_positions = _halo_positions(residual_mask, SACT_KERNEL_SIZE)
+      local_feature = _sparse_batch_norm(outputs, halo_positions,
+                                         scope='local_bn')
+      if valid_mask is not None:
+        local_feature *= valid_mask
+      pointwise_logit, current_flops = _sparse_halting_conv(
+          local_feature, halo_positions, 1, None, scope='pointwise_conv')
+      flops += current_flops
+      realized_flops += current_flops
+
+      halting_logit, current_flops = _sparse_halting_conv(
+          pointwise_logit, sparse_utils.active_positions(residual_mask),
+          SACT_KERNEL_SIZE, biases_initializer, scope='local_conv')
+      flops += current_flops
+      realized_flops += current_flops
+    else:
+      if residual_mask is not None:
+        # The pointwise logits are needed on the 3x3 halo of the active
+        # positions.
+        diluted_residual_mask = slim.max_pool2d(
+            residual_mask, [3, 3], stride=1, padding='SAME')
+      else:
+        diluted_residual_mask = None
+
+      local_feature = mixed_precision.batch_norm(outputs, scope='local_bn')
+      if valid_mask is not None:
+        local_feature *= valid_mask
+      pointwise_logit, current_flops, current_dense_flops = (
+          flopsometer.conv2d(
+              local_feature,
+              1,
+              1,
+              activation_fn=None,
+              normalizer_fn=None,
+              biases_initializer=None,
+              output_mask=diluted_residual_mask,
+              return_dense_flops=True,
+              scope='pointwise_conv'))
+      flops += current_flops
+      realized_flops += current_dense_flops
+
+      halting_logit, current_flops, current_dense_flops = flopsometer.conv2d(
+          pointwise_logit,
+          1,
+          SACT_KERNEL_SIZE,
+          activation_fn=None,
+          normalizer_fn=None,
+          biases_initializer=biases_initializer,
+          output_mask=residual_mask,
+          return_dense_flops=True,
+          scope='local_conv')
+      flops += current_flops
+      realized_flops += current_dense_flops
+
+    halting_proba, current_flops = _spatial_halting_proba(
+        outputs, halting_logit, global_feature, valid_mask)
+    flops += current_flops
+    realized_flops += current_flops
+
+    if return_realized_flops:
+      return halting_proba, flops, realized_flops
     return halting_proba, flops
 
 
+# Halting heads of the SACT models. All the heads are called as
+# `halting_proba, flops = head(features, residual_mask, global_feature,
+# sparse, valid_mask)`, where `global_feature` is an optional precomputed
+# spatial mean of the features, `sparse` selects the evaluation of the local
+# logits only at the active positions of `residual_mask` and `valid_mask` is
+# an optional mask of the positions which are not padding. The padding is
+# zeroed before the local logits and excluded from the spatial mean. With
+# `return_realized_flops=True`, the heads also return the flops actually
+# executed, with the local logits computed at all the positions unless
+# `sparse`. The 'bottleneck' head is applied to the narrow intermediate
+# features of the residual branch instead of the outputs of the unit.
+SACT_HALTING_HEADS = {
+    'conv': get_halting_proba_conv,
+    'conv1x1': get_halting_proba_conv1x1,
+    'separable': get_halting_proba_separable,
+    'bottleneck': get_halting_proba_conv,
+}
+
+
+def _sact_halting_proba(halting_head, inputs, outputs, features,
+                        residual_mask, sparse_threshold, spatial_means,
+                        valid_mask=None):
+  """Computes the halting probabilities of a SACT unit.
+
+  If the fraction of the active positions of `residual_mask` is at most
+  `sparse_threshold`, the halting head is evaluated only at the active
+  positions and the spatial mean of the states is updated from the one of
+  `inputs` with the values at the active positions, the only ones changed by
+  the unit.
+
+  Args:
+    halting_head: Name of the halting head in `SACT_HALTING_HEADS`.
+    inputs: Input states of the unit.
+    outputs: Output states of the unit.
+    features: The inputs of the halting head, `outputs` or the intermediate
+      features for the 'bottleneck' head, zero at the inactive positions.
+    residual_mask: The mask of the active positions or None.
+    sparse_threshold: See `stack_blocks`.
+    spatial_means: An optional dict from the states to their spatial means.
+      The spatial mean of `outputs` is added to it.
+    valid_mask: An optional mask of the valid positions, at any resolution,
+      see `stack_blocks`. The padding is masked out of the halting head and
+      the spatial means are computed over the valid positions.
+
+  Returns:
+    halting_proba: The halting probabilities.
+    flops: The operation count of the halting head.
+    realized_flops: The operation count of the evaluated version of the
+      halting head, dense or sparse.
+  """
+  head = SACT_HALTING_HEADS[halting_head]
+  use_states = features is outputs
+  if valid_mask is not None:
+    valid_mask = _resize_valid_mask(valid_mask, features)
+
+  def _dense_head():
+    global_feature = _spatial_mean(features, valid_mask)
+    halting_proba, flops, realized_flops = head(
+        features, residual_mask, global_feature, valid_mask=valid_mask,
+        return_realized_flops=True)
+    return halting_proba, flops, realized_flops, global_feature
+
+  def _sparse_head():
+    positions = sparse_utils.active_positions(residual_mask)
+    sh = tf.shape(features)
+    if valid_mask is None:
+      num_spatial_positions = tf.cast(sh[1] * sh[2], features.dtype)
+    else:
+      num_spatial_positions = tf.maximum(
+          tf.reduce_sum(valid_mask, [1, 2]), 1.)
+    if not use_states:
+      # The features are zero at the inactive positions.
+      global_feature = sparse_utils.sum_positions(
+          tf.gather_nd(features, positions), positions, sh[0])
+      global_feature /= num_spatial_positions
+    elif spatial_means is not None and inputs in spatial_means:
+      delta = (tf.gather_nd(outputs, positions) -
+               tf.gather_nd(inputs, positions))
+      global_feature = spatial_means[inputs] + (sparse_utils.sum_positions(
+          delta, positions, sh[0]) / num_spatial_positions)
+    else:
+      global_feature = tf.squeeze(_spatial_mean(features, valid_mask), [1, 2])
+    global_feature = tf.expand_dims(tf.expand_dims(global_feature, 1), 1)
+    halting_proba, flops, realized_flops = head(
+        features, residual_mask, global_feature, sparse=True,
+        valid_mask=valid_mask, return_realized_flops=True)
+    return halting_proba, flops, realized_flops, global_feature
+
+  (halting_proba, flops, realized_flops,
+   global_feature) = sparse_utils.dense_or_sparse(
+       residual_mask, sparse_threshold, _dense_head, _sparse_head)
+  if use_states and spatial_means is not None:
+    spatial_means[outputs] = tf.squeeze(global_feature, [1, 2])
+  return halting_proba, flops, realized_flops
+
+
 def unit_act(block,
              inputs,
              unit_idx,
              skip_halting_proba=False,
              sact=False,
-             residual_mask=None):
+             residual_mask=None,
+             sparse_threshold=None,
+             halting_head='conv',
+             spatial_means=None,
+             valid_mask=None,
+             realized_flops=None):
+  # The scope name should match the `unit_scope` argument of
+  # `act.adaptive_computation_while_loop`.
   with tf.variable_scope('unit_%d' % (unit_idx + 1), [inputs]):
-    outputs, flops = block.unit_fn(
-        inputs, *block.args[unit_idx], residual_mask=residual_mask)
+    compute_halting_proba = (not skip_halting_proba and
+                             unit_idx < len(block.args) - 1)
+    use_features = (compute_halting_proba and sact and
+                    halting_head == 'bottleneck')
+    unit_kwargs = {}
+    if use_features:
+      unit_kwargs['return_features'] = True
+    if realized_flops is not None:
+      # The flops executed by the residual branch and the halting head.
+      unit_realized_flops = []
+      unit_kwargs['realized_flops'] = unit_realized_flops
+    unit_results = block.unit_fn(
+        inputs,
+        *block.args[unit_idx],
+        residual_mask=residual_mask,
+        sparse_threshold=sparse_threshold,
+        **unit_kwargs)
+
+    if use_features:
+      outputs, flops, features = unit_results
+    else:
+      outputs, flops = unit_results
+      features = outputs
 
-    if not skip_halting_proba and unit_idx < len(block.args) - 1:
+    if residual_mask is not None and not unit_idx:
+      # The mask of the first unit has the resolution of the inputs, see
+      # `act.spatially_adaptive_computation_time`.
+      residual_mask = sparse_utils.downsample_mask_like(residual_mask, outputs)
+
+    if use_features and residual_mask is not None:
+      # Same features for the dense and the sparse residual branches.
+      features *= residual_mask
+
+    if compute_halting_proba:
       if sact:
-        halting_proba, current_flops = get_halting_proba_conv(
-            outputs, residual_mask)
+        halting_proba, current_flops, current_realized_flops = (
+            _sact_halting_proba(halting_head, inputs, outputs, features,
+                                residual_mask, sparse_threshold,
+                                spatial_means, valid_mask))
         flops += current_flops
       else:
         halting_proba, current_flops = get_halting_proba(outputs)
         flops += current_flops
+        current_realized_flops = current_flops
+      if realized_flops is not None:
+        unit_realized_flops.append(current_realized_flops)
     else:
       halting_proba = None
 
+    if realized_flops is not None:
+      # Only the first call of the unit is kept. With early stopping, it is
+      # the one outside of tf.cond.
+      realized_flops.setdefault(unit_idx, tf.add_n(unit_realized_flops))
+
     return outputs, halting_proba, flops
 
 
-def stack_blocks(net, blocks, model_type, end_points=None):
-  """Utility function for assembling SACT models consisting of 'blocks.'"""
+def _jit_unit(unit, *args, **kwargs):
+  """Calls `unit` with all its ops marked for XLA compilation."""
+  with jit.experimental_jit_scope():
+    return unit(*args, **kwargs)
+
+
+def _tile_flops_unit(unit, tile_flops, tile_size, *args, **kwargs):
+  """Calls `unit` and appends its tile-rounded flops to `tile_flops`.
+
+  See `flopsometer.tile_rounded_flops`. A unit without a `residual_mask` is
+  evaluated densely.
+  """
+  (outputs, halting_proba, flops) = unit(*args, **kwargs)
+  residual_mask = kwargs.get('residual_mask')
+  if residual_mask is None:
+    residual_mask = tf.ones_like(outputs[:, :, :, :1])
+  else:
+    residual_mask = sparse_utils.downsample_mask_like(residual_mask, outputs)
+  tile_flops.append(
+      flopsometer.tile_rounded_flops(flops, residual_mask, tile_size))
+  return outputs, halting_proba, flops
+
+
+def _halting_proba_unit(unit, halting_probas, *args, **kwargs):
+  """Calls `unit` and keeps the halting probabilities of its first call.
+
+  The halting probabilities are stored in the dict `halting_probas` from the
+  unit indices. With early stopping, the first call is the one outside of
+  `tf.cond`, see `unit_act`.
+  """
+  (outputs, halting_proba, flops) = unit(*args, **kwargs)
+  if halting_proba is not None:
+    halting_probas.setdefault(args[1], halting_proba)
+  return outputs, halting_proba, flops
+
+
+def _unit_flops(unit, inputs, outputs, max_units, sact):
+  """Computes the FLOPs of every unit of a block from its active positions.
+
+  The FLOPs of a SACT unit with the residual mask `M` are
+  `c + a * |D(M)| + b * |M|`, where `D(M)` is the 3x3 halo of the active
+  positions, which is evaluated by the first convolution of the residual
+  branch (and the pointwise logits of the 'separable' head), and `|.|` is
+  the number of positions. The coefficients are found by calling the unit
+  with no, all, and a single corner active position. Only the FLOPs of these
+  calls are needed, so the calls do not evaluate the convolutions. The first
+  unit of a block, and every unit of an ACT block, is evaluated without a
+  mask, its FLOPs are the constant `c`.
+
+  Args:
+    unit: A function with the signature of `unit_act`, with the block bound.
+    inputs: The inputs of the block.
+    outputs: The outputs of the block, which have the shape of the inputs of
+      every unit apart from the first one.
+    max_units: The number of units of the block.
+    sact: Whether the block is a SACT block.
+
+  Returns:
+    An `int64` `Tensor` of shape [batch, max_units, 3] with the coefficients
+    `c`, `a` and `b` of every unit for every object.
+  """
+  (_, _, flops) = unit(inputs, 0)
+  zeros = tf.zeros_like(flops)
+  unit_flops = [tf.stack([flops, zeros, zeros], 1)]
+  ones = tf.ones_like(outputs[:, :, :, :1])
+  sh = tf.shape(ones)
+  corner = tf.pad(ones[:, :1, :1],
+                  [[0, 0], [0, sh[1] - 1], [0, sh[2] - 1], [0, 0]])
+  num_positions = tf.to_int64(sh[1] * sh[2])
+  num_corner_halo = tf.to_int64(tf.minimum(sh[1], 2) * tf.minimum(sh[2], 2))
+  for unit_idx in range(1, max_units):
+    if not sact:
+      (_, _, flops) = unit(outputs, unit_idx)
+      unit_flops.append(tf.stack([flops, zeros, zeros], 1))
+      continue
+    (_, _, constant_flops) = unit(outputs, unit_idx,
+                                  residual_mask=tf.zeros_like(ones))
+    (_, _, dense_flops) = unit(outputs, unit_idx, residual_mask=ones)
+    (_, _, corner_flops) = unit(outputs, unit_idx, residual_mask=corner)
+    # a + b and num_corner_halo * a + b.
+    position_flops = (dense_flops - constant_flops) // num_positions
+    corner_flops -= constant_flops
+    # A single position has no halo, then a = 0.
+    halo_flops = ((corner_flops - position_flops) //
+                  tf.maximum(num_corner_halo - 1, 1))
+    unit_flops.append(
+        tf.stack([constant_flops, halo_flops, position_flops - halo_flops], 1))
+  return tf.stack(unit_flops, 1)
+
+
+def _realized_block_flops(model_type, flops, num_units, max_units,
+                          unit_realized_flops, compact_batch=False,
+                          sact_early_stopping=False):
+  """Sums the flops executed by the units of an adaptive block.
+
+  The flops executed by every unit are given in the dict
+  `unit_realized_flops` from the unit indices, see `unit_act`: at all the
+  positions of the whole batch if the unit is evaluated densely, at the
+  active positions and their halo if it is sparse. 'act' blocks and 'sact'
+  blocks execute all the units. 'act_early_stopping' blocks (and 'sact'
+  blocks with `sact_early_stopping`) skip the units once the whole batch has
+  halted. The 'act_early_stopping' blocks with `compact_batch` execute the
+  units only for the objects which have not halted, i.e. the counted flops.
+  """
+  if model_type == 'act_early_stopping' and compact_batch:
+    return flops
+  realized_flops = []
+  for unit_idx in range(max_units):
+    unit_flops = unit_realized_flops[unit_idx]
+    if unit_idx and (model_type == 'act_early_stopping' or (
+        model_type == 'sact' and sact_early_stopping)):
+      # The unit is skipped once all the objects (or positions) have halted.
+      unit_flops *= tf.to_int64(tf.reduce_max(num_units) > unit_idx)
+    realized_flops.append(unit_flops)
+  return tf.add_n(realized_flops)
+
+
+def _batch_norm_is_training():
+  """Whether `slim.batch_norm` is in training mode in the current arg scope."""
+  key = getattr(slim.batch_norm, '_key_op', str(slim.batch_norm))
+  batch_norm_scope = tf.contrib.framework.current_arg_scope().get(key, {})
+  return batch_norm_scope.get('is_training', True)
+
+
+@contextlib.contextmanager
+def _discard_update_ops():
+  """Drops the ops added to the `UPDATE_OPS` collection inside the context."""
+  update_ops = tf.get_collection_ref(tf.GraphKeys.UPDATE_OPS)
+  num_update_ops = len(update_ops)
+  yield
+  del update_ops[num_update_ops:]
+
+
+def _recompute_unit(unit, block, inputs, unit_idx, residual_mask=None,
+                    **kwargs):
+  """Calls `unit` without keeping its intermediate activations for backprop.
+
+  The outputs of the unit are passed through an identity function whose
+  gradient builds the unit again and backpropagates through the new copy, so
+  only the inputs and the outputs of the unit are kept until the backward
+  pass. The flops and the batch norm updates of the copy are discarded.
+
+  Args:
+    unit: A function with the signature of `unit_act`.
+    block: A `resnet_utils.Block` object.
+    inputs: Input `Tensor` of the unit.
+    unit_idx: Index of the unit in the block.
+    residual_mask: An optional mask of the positions to compute.
+    **kwargs: Additional keyword arguments of `unit`.
+
+  Returns:
+    The outputs of `unit`.
+  """
+  var_scope = tf.get_variable_scope()
+  (outputs, halting_proba, flops) = unit(
+      block, inputs, unit_idx, residual_mask=residual_mask, **kwargs)
+
+  unit_inputs = [inputs]
+  if residual_mask is not None:
+    unit_inputs.append(residual_mask)
+  variables = tf.get_collection(
+      tf.GraphKeys.TRAINABLE_VARIABLES,
+      scope='{}/unit_{}/'.format(var_scope.name, unit_idx + 1))
+  variables = [tf.convert_to_tensor(v) for v in variables]
+  unit_outputs = [outputs]
+  if halting_proba is not None:
+    unit_outputs.append(halting_proba)
+
+  def _grad(op, *grads):
+    num_inputs = len(unit_inputs)
+    # Start the recomputation only once the gradients are available.
+    with tf.control_dependencies(grads):
+      new_inputs = [tf.identity(x) for x in op.inputs[:num_inputs]]
+    new_residual_mask = new_inputs[1] if residual_mask is not None else None
+    with tf.variable_scope(var_scope, reuse=True), _discard_update_ops():
+      (new_outputs, new_halting_proba, _) = unit(
+          block, new_inputs[0], unit_idx, residual_mask=new_residual_mask,
+          **kwargs)
+    new_unit_outputs = [new_outputs]
+    if new_halting_proba is not None:
+      new_unit_outputs.append(new_halting_proba)
+    input_grads = tf.gradients(
+        new_unit_outputs, new_inputs + variables, grad_ys=grads)
+    return input_grads + [None] * len(unit_outputs)
+
+  defun_inputs = unit_inputs + variables + unit_outputs
+
+  @function.Defun(
+      *[x.dtype for x in defun_inputs],
+      func_name='RecomputeUnit_{}'.format(next(_recompute_counter)),
+      python_grad_func=_grad)
+  def _identity(*args):
+    return args[-len(unit_outputs):]
+
+  identity_outputs = _identity(*defun_inputs)
+  if not isinstance(identity_outputs, (list, tuple)):
+    identity_outputs = [identity_outputs]
+  for (x, y) in zip(unit_outputs, identity_outputs):
+    y.set_shape(x.get_shape())
+
+  outputs = identity_outputs[0]
+  if halting_proba is not None:
+    halting_proba = identity_outputs[1]
+  return outputs, halting_proba, flops
+
+
+def stack_blocks(net, blocks, model_type, end_points=None,
+                 sparse_threshold=None, compact_batch=False,
+                 use_while_loop=False, eps=1e-2, jit_halting=False,
+                 jit_units=False, recompute_units=False, valid_mask=None,
+                 halting_head='conv', tile_size=1,
+                 cross_block_halting=False, sact_early_stopping=False,
+                 return_halting_distribution=False, return_unit_data=False):
+  """Utility function for assembling SACT models consisting of 'blocks.'
+
+  Args:
+    net: Input `Tensor` of the first block.
+    blocks: A list of `resnet_utils.Block` objects.
+    model_type: One of 'vanilla', 'act', 'act_early_stopping' or 'sact', or
+      a list with the model type of every block, see `parse_model_type`.
+    end_points: An optional dict to store the end points in. The scopes of
+      the adaptive blocks are stored in `end_points['act_block_scopes']` and
+      the ones of the SACT blocks in `end_points['sact_block_scopes']`. The
+      model types of the blocks are stored in
+      `end_points['block_model_types']`. Besides the counted flops, the
+      flops actually executed by the chosen implementation (e.g. for the
+      whole batch with early stopping, or densely for 'sact' blocks) are
+      stored in
+      `end_points['<block scope>/realized_flops']`. They are the sums of the
+      flops executed by the units, which store the flops of the evaluated
+      versions of their residual branch and halting head in a
+      `realized_flops` dict under their unit index, see `unit_act`.
+    sparse_threshold: An optional `float`. For SACT models, the residual
+      units and the halting heads with at most this fraction of active
+      positions are evaluated only at the active positions (and their halo)
+      instead of densely. Intended for inference.
+    compact_batch: For 'act_early_stopping' models, run each unit only for
+      the objects which have not halted yet.
+    use_while_loop: For 'act_early_stopping' and 'sact' models, build the
+      intermediate units of each block once and iterate them in a
+      `tf.while_loop`, see `act.adaptive_computation_while_loop`. Reduces the
+      size of the graph for deep models. Inference only: the loop is built
+      without back-propagation, so `slim.batch_norm` must be in inference
+      mode (`is_training=False`) in the enclosing arg scope.
+    eps: Default value of the halting threshold of ACT models. The threshold
+      of every block is a `tf.placeholder_with_default` stored in
+      `end_points['<block scope>/eps']`, so it can be changed by feeding it.
+    jit_halting: For ACT models, compile the halting computations of every
+      unit with XLA. Reduces the overhead of the many small element-wise ops,
+      which dominates for small feature maps on CPU.
+    jit_units: Compile every residual unit with XLA.
+    recompute_units: Keep only the inputs and the outputs of every residual
+      unit for the backward pass and compute the unit again to get its
+      gradients. Trades an extra forward pass of the units for a much
+      smaller activation memory during training.
+    valid_mask: For 'sact' blocks, an optional 4-D `Tensor` with ones at the
+      valid positions of the input images and zeros at the padding, see
+      `act.spatially_adaptive_computation_time`. Used for batches of images
+      of different sizes. The padding is also masked out of the halting
+      heads, so the halting of the valid positions does not depend on the
+      padded size, up to the receptive fields of the residual units which
+      overlap the padding.
+    halting_head: For 'sact' blocks, the name of the halting head in
+      `SACT_HALTING_HEADS`. The 'bottleneck' head requires units which
+      accept a `return_features` argument.
+    tile_size: For 'sact' blocks, an `int` or a list with an `int` for every
+      block (a list of length one is used for all the blocks). The blocks
+      with a tile size greater than one decide the halting for every
+      `tile_size x tile_size` tile instead of every position, see
+      `act.spatially_adaptive_computation_time`. The flops of these blocks
+      rounded up to whole tiles are stored in
+      `end_points['<block scope>/tile_flops']`, see
+      `flopsometer.tile_rounded_flops`.
+    cross_block_halting: If True, the first unit of a 'sact' block which
+      follows another 'sact' block computes its residual branch only at the
+      positions where the previous block used more than one unit (with a 3x3
+      halo). The other positions halt after the first unit, see the
+      `first_unit_mask` argument of `act.spatially_adaptive_computation_time`.
+      The savings are included in `end_points['<block scope>/flops']`.
+      Requires static spatial sizes.
+    sact_early_stopping: For 'sact' blocks, skip the remaining units of a
+      block with `tf.cond` once all the positions of the batch have halted,
+      see the `early_stopping` argument of
+      `act.spatially_adaptive_computation_time`. Intended for inference.
+    return_halting_distribution: If True, the halting distributions of the
+      adaptive blocks are stored in
+      `end_points['<block scope>/halting_distribution']`. Otherwise they are
+      not assembled, since they have `max_units` values for every object (or
+      position for 'sact' blocks) and are only needed for the analysis of
+      the trained models, see `summary_utils.export_to_h5`.
+    return_unit_data: If True, the halting probabilities computed by the
+      units of the adaptive blocks are stored in
+      `end_points['<block scope>/halting_proba']`, with `max_units - 1`
+      values for every object (or position for 'sact' blocks), and the FLOPs
+      of the units as a function of their active positions in
+      `end_points['<block scope>/unit_flops']`, see `_unit_flops`. They are
+      used to recompute the halting for other values of `eps`, see
+      `act_numpy.what_if`. The units after the halting unit of an object are
+      evaluated by 'act' blocks and, for the probabilities only, by
+      'act_early_stopping' blocks. The 'sact' blocks compute the halting
+      probabilities of the halted positions from their frozen states.
+
+  Returns:
+    net: Output `Tensor` of the last block.
+    end_points: A dict of end points.
+
+  Raises:
+    ValueError: If `model_type` is invalid, see `parse_model_type`, if
+      `valid_mask` is used with 'act' or 'act_early_stopping' blocks, without
+      'sact' blocks or with `use_while_loop`, or if a tile size greater than
+      one is used with `use_while_loop`, or if `cross_block_halting` is
+      used with `valid_mask` or `use_while_loop`, or if `sact_early_stopping`
+      is used with `use_while_loop` or a tile size greater than one, or if
+      `use_while_loop` is used with `slim.batch_norm` in training mode, or
+      if `return_unit_data` is used with `sparse_threshold`,
+      `use_while_loop`, `compact_batch`, `valid_mask`, `cross_block_halting`
+      or a tile size greater than one.
+  """
+  model_types = parse_model_type(model_type, len(blocks))
+  if isinstance(tile_size, (list, tuple)):
+    tile_sizes = list(tile_size)
+  else:
+    tile_sizes = [tile_size]
+  if len(tile_sizes) == 1:
+    tile_sizes *= len(blocks)
+  assert len(tile_sizes) == len(blocks)
+  # The tile sizes are used only by the SACT blocks.
+  tile_sizes = [
+      block_tile_size if block_model_type == 'sact' else 1
+      for (block_model_type, block_tile_size) in zip(model_types, tile_sizes)]
   if end_points is None:
     end_points = {}
   end_points['flops'] = end_points.get('flops', 0)
   end_points['block_scopes'] = [block.scope for block in blocks]
   end_points['block_num_units'] = [len(block.args) for block in blocks]
+  end_points['block_model_types'] = model_types
+  end_points['act_block_scopes'] = [
+      block.scope for (block, block_model_type) in zip(blocks, model_types)
+      if block_model_type in ADAPTIVE_MODEL_TYPES]
+  end_points['sact_block_scopes'] = [
+      block.scope for (block, block_model_type) in zip(blocks, model_types)
+      if block_model_type == 'sact']
 
-  assert model_type in ('vanilla', 'act', 'act_early_stopping', 'sact')
+  assert halting_head in SACT_HALTING_HEADS
+  if valid_mask is not None and (
+      'sact' not in model_types or 'act' in model_types or
+      'act_early_stopping' in model_types or use_while_loop):
+    raise ValueError('valid_mask is only supported for sact models without '
+                     'use_while_loop.')
+  if use_while_loop and _batch_norm_is_training():
+    raise ValueError('use_while_loop is only supported for inference, with '
+                     'slim.batch_norm in inference mode (is_training=False).')
+  if use_while_loop and max(tile_sizes) > 1:
+    raise ValueError('tile_size is not supported with use_while_loop.')
+  if cross_block_halting and (valid_mask is not None or use_while_loop):
+    raise ValueError('cross_block_halting is not supported with valid_mask '
+                     'or use_while_loop.')
+  if sact_early_stopping and (use_while_loop or max(tile_sizes) > 1):
+    raise ValueError('sact_early_stopping is not supported with '
+                     'use_while_loop or tile_size.')
+  if return_unit_data and (sparse_threshold or use_while_loop or
+                           compact_batch or valid_mask is not None or
+                           cross_block_halting or max(tile_sizes) > 1):
+    raise ValueError('return_unit_data is not supported with '
+                     'sparse_threshold, use_while_loop, compact_batch, '
+                     'valid_mask, cross_block_halting or tile_size.')
   model_type_to_func = {
     'act': act.adaptive_computation_time_wrapper,
-    'act_early_stopping': act.adaptive_computation_early_stopping,
-    'sact': act.spatially_adaptive_computation_time,
+    'act_early_stopping': partial(act.adaptive_computation_early_stopping,
+                                  compact_batch=compact_batch),
+    'sact': partial(act.spatially_adaptive_computation_time,
+                    valid_mask=valid_mask,
+                    early_stopping=sact_early_stopping),
   }
-  act_func = model_type_to_func.get(model_type, None)
+  if use_while_loop:
+    model_type_to_func.update({
+      'act_early_stopping': partial(act.adaptive_computation_while_loop,
+                                    compact_batch=compact_batch),
+      'sact': partial(act.adaptive_computation_while_loop, spatial=True),
+    })
+
+  unit_fn = partial(_jit_unit, unit_act) if jit_units else unit_act
+  # The spatial means of the states for the sparse halting heads.
+  spatial_means = {}
+  if recompute_units:
+    unit_fn = partial(_recompute_unit, unit_fn)
 
-  for block in blocks:
+  # The mask of the first unit of the next block for cross_block_halting.
+  first_unit_mask = None
+  for (block, block_model_type, block_tile_size) in zip(blocks, model_types,
+                                                        tile_sizes):
+    act_func = model_type_to_func.get(block_model_type, None)
     if act_func:
+      block_eps = tf.placeholder_with_default(
+          tf.constant(eps, dtype=tf.float32), [],
+          name='{}_eps'.format(block.scope))
+      unit_realized_flops = None
+      if not (block_model_type == 'act_early_stopping' and compact_batch):
+        unit_realized_flops = {}
+      block_unit = partial(unit_fn, block, sact=(block_model_type == 'sact'),
+                           sparse_threshold=sparse_threshold,
+                           halting_head=halting_head,
+                           spatial_means=spatial_means,
+                           valid_mask=valid_mask,
+                           realized_flops=unit_realized_flops)
+      if return_unit_data:
+        halting_probas = {}
+        block_unit = partial(_halting_proba_unit, block_unit, halting_probas)
+      act_kwargs = {}
+      if use_while_loop and block_model_type != 'act':
+        act_kwargs['realized_flops'] = unit_realized_flops
+      if block_tile_size > 1:
+        tile_flops = []
+        block_unit = partial(_tile_flops_unit, block_unit, tile_flops,
+                             block_tile_size)
+        act_kwargs['tile_size'] = block_tile_size
+      if block_model_type == 'sact' and first_unit_mask is not None:
+        act_kwargs['first_unit_mask'] = first_unit_mask
+      block_inputs = net
       (ponder_cost, num_units, flops, halting_distribution, net) = act_func(
           net,
-          partial(unit_act, block, sact=(model_type == 'sact')),
+          block_unit,
           len(block.args),
-          scope=block.scope)
+          eps=block_eps,
+          jit_halting=jit_halting,
+          scope=block.scope,
+          return_halting_distribution=return_halting_distribution,
+          **act_kwargs)
+      if block_tile_size > 1:
+        end_points['{}/tile_flops'.format(block.scope)] = tf.add_n(tile_flops)
+      realized_flops = _realized_block_flops(
+          block_model_type, flops, num_units, len(block.args),
+          unit_realized_flops,
+          compact_batch=compact_batch,
+          sact_early_stopping=sact_early_stopping)
 
+      end_points['{}/eps'.format(block.scope)] = block_eps
       end_points['{}/ponder_cost'.format(block.scope)] = ponder_cost
       end_points['{}/num_units'.format(block.scope)] = num_units
-      end_points['{}/halting_distribution'.format(
-          block.scope)] = halting_distribution
+      if return_halting_distribution:
+        end_points['{}/halting_distribution'.format(
+            block.scope)] = halting_distribution
+      if return_unit_data:
+        end_points['{}/halting_proba'.format(block.scope)] = tf.stack(
+            [tf.squeeze(halting_probas[unit_idx],
+                        [halting_probas[unit_idx].get_shape().ndims - 1])
+             for unit_idx in range(len(block.args) - 1)], -1)
+        with tf.variable_scope(block.scope, reuse=True):
+          with _discard_update_ops():
+            end_points['{}/unit_flops'.format(block.scope)] = _unit_flops(
+                partial(unit_act, block, sact=(block_model_type == 'sact'),
+                        halting_head=halting_head),
+                block_inputs, net, len(block.args),
+                block_model_type == 'sact')
+      if cross_block_halting and block_model_type == 'sact':
+        # The positions which used more than one unit and their halo.
+        first_unit_mask = tf.to_float(tf.expand_dims(num_units, 3) > 1)
+        first_unit_mask = slim.max_pool2d(
+            first_unit_mask, [3, 3], stride=1, padding='SAME')
+      else:
+        first_unit_mask = None
     else:
       with tf.variable_scope(block.scope, 'block', [net]):
         flops = 0
         for unit_idx in range(len(block.args)):
-          net, _, current_flops = unit_act(
+          net, _, current_flops = unit_fn(
               block, net, unit_idx, skip_halting_proba=True)
           flops += current_flops
+      first_unit_mask = None
+      realized_flops = flops
 
     end_points['{}/flops'.format(block.scope)] = flops
+    end_points['{}/realized_flops'.format(block.scope)] = realized_flops
     end_points['flops'] += flops
     end_points[block.scope] = net
 
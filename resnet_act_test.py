@@ -0,0 +1,171 @@
+# Copyright 2016 Google Inc. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# ==============================================================================
+
+"""Tests for resnet_act."""
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import numpy as np
+import tensorflow as tf
+from tensorflow.contrib import slim
+from tensorflow.contrib.slim.nets import resnet_utils
+
+import flopsometer
+import resnet_act
+
+
+class ModelTypeTest(tf.test.TestCase):
+
+  def testParseModelType(self):
+    self.assertEqual(resnet_act.parse_model_type('sact', 3),
+                     ['sact', 'sact', 'sact'])
+    self.assertEqual(resnet_act.parse_model_type('vanilla,act,sact', 3),
+                     ['vanilla', 'act', 'sact'])
+    self.assertEqual(resnet_act.parse_model_type(['vanilla', 'sact'], 2),
+                     ['vanilla', 'sact'])
+    with self.assertRaises(ValueError):
+      resnet_act.parse_model_type('vanilla,sact', 3)
+    with self.assertRaises(ValueError):
+      resnet_act.parse_model_type('vanilla,sacts,sact', 3)
+
+  def testIsAdaptive(self):
+    self.assertFalse(resnet_act.is_adaptive('vanilla'))
+    self.assertTrue(resnet_act.is_adaptive('vanilla,vanilla,act,act'))
+    self.assertFalse(resnet_act.has_sact('vanilla,vanilla,act,act'))
+    self.assertTrue(resnet_act.has_sact('vanilla,vanilla,sact,sact'))
+
+
+class HaltingHeadsTest(tf.test.TestCase):
+
+  def _headFlops(self, halting_head, residual_mask=None):
+    with tf.Graph().as_default() as g:
+      features = tf.random_normal([1, 8, 8, 64])
+      if residual_mask is not None:
+        residual_mask = tf.constant(residual_mask, dtype=tf.float32)
+      halting_proba, flops = resnet_act.SACT_HALTING_HEADS[halting_head](
+          features, residual_mask)
+      self.assertEqual(halting_proba.dtype, tf.float32)
+      self.assertEqual(halting_proba.get_shape().as_list(), [1, 8, 8, 1])
+      with self.test_session(graph=g) as sess:
+        sess.run(tf.global_variables_initializer())
+        return sess.run(flops)
+
+  def testFlops(self):
+    global_flops = 2 * 64
+    self.assertAllEqual(self._headFlops('conv'),
+                        [2 * 64 * 9 * 64 + global_flops])
+    self.assertAllEqual(self._headFlops('conv1x1'),
+                        [2 * 64 * 64 + global_flops])
+    self.assertAllEqual(self._headFlops('separable'),
+                        [2 * 64 * 64 + 2 * 64 * 9 + global_flops])
+
+  def testFlopsResidualMask(self):
+    residual_mask = np.zeros([1, 8, 8, 1])
+    residual_mask[0, 4, 4, 0] = 1.
+    global_flops = 2 * 64
+    self.assertAllEqual(self._headFlops('conv', residual_mask),
+                        [2 * 9 * 64 + global_flops])
+    # The pointwise logits are computed on the 3x3 halo.
+    self.assertAllEqual(self._headFlops('separable', residual_mask),
+                        [2 * 9 * 64 + 2 * 9 + global_flops])
+
+  def testSparseHeads(self):
+    rng = np.random.RandomState(0)
+    features = tf.constant(rng.randn(2, 6, 6, 8), dtype=tf.float32)
+    mask = (rng.uniform(size=[2, 6, 6, 1]) < 0.3).astype(np.float32)
+    residual_mask = tf.constant(mask)
+    for halting_head in ('conv', 'conv1x1', 'separable'):
+      head = resnet_act.SACT_HALTING_HEADS[halting_head]
+      with slim.arg_scope([slim.batch_norm], is_training=False):
+        with tf.variable_scope(halting_head):
+          (halting_proba, flops) = head(features, residual_mask)
+        with tf.variable_scope(halting_head, reuse=True):
+          (sparse_halting_proba, sparse_flops) = head(
+              features, residual_mask, sparse=True)
+      with self.test_session() as sess:
+        sess.run(tf.global_variables_initializer())
+        (halting_proba_out, flops_out, sparse_halting_proba_out,
+         sparse_flops_out) = sess.run(
+             (halting_proba, flops, sparse_halting_proba, sparse_flops))
+      active = mask > 0
+      self.assertAllClose(halting_proba_out[active],
+                          sparse_halting_proba_out[active])
+      self.assertAllEqual(flops_out, sparse_flops_out)
+
+
+def _pointwise_unit(inputs, depth, residual_mask=None, sparse_threshold=None,
+                    realized_flops=None, scope=None):
+  """A residual unit without spatial mixing, for the padding tests."""
+  del sparse_threshold  # Unused.
+  with tf.variable_scope(scope, 'pointwise', [inputs]):
+    residual, flops, dense_flops = flopsometer.conv2d(
+        inputs, depth, 1, activation_fn=tf.nn.relu, normalizer_fn=None,
+        weights_initializer=tf.random_normal_initializer(seed=1),
+        output_mask=residual_mask, return_dense_flops=True, scope='conv')
+    if residual_mask is not None:
+      residual *= residual_mask
+    if realized_flops is not None:
+      realized_flops.append(dense_flops)
+    return inputs + residual, flops
+
+
+class ValidMaskTest(tf.test.TestCase):
+
+  def _ponderMaps(self, halting_head, sparse_threshold):
+    rng = np.random.RandomState(0)
+    image = rng.randn(1, 6, 5, 4).astype(np.float32)
+    # The padding is filled with noise, which must not change the halting.
+    padded_image = rng.randn(2, 8, 8, 4).astype(np.float32)
+    padded_image[0, :6, :5] = image[0]
+    valid_mask = np.zeros([2, 8, 8, 1], dtype=np.float32)
+    valid_mask[0, :6, :5] = 1.
+    valid_mask[1] = 1.
+
+    blocks = [resnet_utils.Block('block1', _pointwise_unit, [(4,)] * 4)]
+    end_points = []
+    with slim.arg_scope([slim.batch_norm], is_training=False):
+      for (inputs, mask, reuse) in ((image, None, False),
+                                    (padded_image, valid_mask, True)):
+        with tf.variable_scope('model', reuse=reuse):
+          if mask is not None:
+            mask = tf.constant(mask)
+          _, model_end_points = resnet_act.stack_blocks(
+              tf.constant(inputs), blocks, 'sact',
+              sparse_threshold=sparse_threshold, eps=0.2,
+              valid_mask=mask, halting_head=halting_head)
+        end_points.append({
+            'ponder_cost': model_end_points['block1/ponder_cost'],
+            'num_units': model_end_points['block1/num_units'],
+        })
+    with self.test_session() as sess:
+      sess.run(tf.global_variables_initializer())
+      return sess.run(end_points)
+
+  def testPaddedPonderMap(self):
+    for halting_head in ('conv', 'separable'):
+      for sparse_threshold in (None, 1.):
+        with tf.Graph().as_default():
+          (unpadded, padded) = self._ponderMaps(halting_head, sparse_threshold)
+        self.assertAllClose(padded['ponder_cost'][:1, :6, :5],
+                            unpadded['ponder_cost'])
+        self.assertAllEqual(padded['num_units'][:1, :6, :5],
+                            unpadded['num_units'])
+        self.assertAllEqual(padded['num_units'][0, 6:], np.zeros([2, 8]))
+
+
+if __name__ == '__main__':
+  tf.test.main()
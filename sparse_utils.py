@@ -0,0 +1,211 @@
+# Copyright 2016 Google Inc. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# ==============================================================================
+
+"""Helpers for evaluating layers only at the active spatial positions."""
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import tensorflow as tf
+
+
+def active_positions(mask):
+  """Returns the indices of the active positions of a mask.
+
+  Args:
+    mask: A 4-D `Tensor` of shape [batch, height, width, 1]. Positions with
+      non-zero values are active.
+
+  Returns:
+    A 2-D `Tensor` of type `int32` and shape [num_positions, 3]. Each row is
+    a (batch, y, x) index of an active position.
+  """
+  return tf.to_int32(tf.where(tf.squeeze(mask, [3]) > 0))
+
+
+def gather_patches(inputs, positions, kernel_size):
+  """Gathers the receptive fields of a stride-1 'SAME' convolution.
+
+  The patches are zero-padded at the borders of the map, so a 'VALID'
+  convolution of a patch gives the same result as the 'SAME' convolution of
+  `inputs` at the center of the patch.
+
+  Args:
+    inputs: A 4-D `Tensor` of shape [batch, height, width, channels].
+    positions: A 2-D `int32` `Tensor` of (batch, y, x) indices, see
+      `active_positions`.
+    kernel_size: An `int`, spatial size of the convolution kernel.
+
+  Returns:
+    A 4-D `Tensor` of shape [num_positions, kernel_size, kernel_size, channels].
+  """
+  pad_beg = (kernel_size - 1) // 2
+  pad_end = kernel_size - 1 - pad_beg
+  padded = tf.pad(inputs,
+                  [[0, 0], [pad_beg, pad_end], [pad_beg, pad_end], [0, 0]])
+
+  # Top-left corner of the patch in the padded map is the position itself.
+  offsets = tf.range(kernel_size)
+  b = positions[:, 0]
+  y = positions[:, 1]
+  x = positions[:, 2]
+  ys = tf.tile(
+      tf.expand_dims(y[:, None] + offsets[None, :], 2), [1, 1, kernel_size])
+  xs = tf.tile(
+      tf.expand_dims(x[:, None] + offsets[None, :], 1), [1, kernel_size, 1])
+  bs = tf.tile(b[:, None, None], [1, kernel_size, kernel_size])
+  indices = tf.stack([bs, ys, xs], axis=3)
+
+  return tf.gather_nd(padded, indices)
+
+
+def scatter_positions(updates, positions, like):
+  """Scatters per-position values back into a dense zero-filled map.
+
+  Args:
+    updates: A 2-D `Tensor` of shape [num_positions, channels].
+    positions: A 2-D `int32` `Tensor` of (batch, y, x) indices, see
+      `active_positions`.
+    like: A 4-D `Tensor`. The batch and spatial dimensions of the result are
+      taken from it.
+
+  Returns:
+    A 4-D `Tensor` of shape [batch, height, width, channels].
+  """
+  sh = tf.shape(like)
+  dense_shape = tf.stack([sh[0], sh[1], sh[2], tf.shape(updates)[1]])
+  outputs = tf.scatter_nd(positions, updates, dense_shape)
+  outputs.set_shape(like.get_shape()[:3].concatenate(updates.get_shape()[1:]))
+  return outputs
+
+
+def sum_positions(values, positions, batch_size):
+  """Sums per-position values over the positions of every object.
+
+  Args:
+    values: A 2-D `Tensor` of shape [num_positions, channels].
+    positions: A 2-D `int32` `Tensor` of (batch, y, x) indices, see
+      `active_positions`.
+    batch_size: A scalar `int32` `Tensor`, the number of objects.
+
+  Returns:
+    A 2-D `Tensor` of shape [batch_size, channels].
+  """
+  return tf.unsorted_segment_sum(values, positions[:, 0], batch_size)
+
+
+def pad_to_tiles(x, tile_size):
+  """Pads the spatial dimensions of `x` with zeros to multiples of `tile_size`.
+
+  The padding is added at the end, so the tile `(i, j)` covers the positions
+  `[i * tile_size, (i + 1) * tile_size) x [j * tile_size, (j + 1) * tile_size)`.
+
+  Args:
+    x: A 4-D `Tensor` of shape [batch, height, width, channels].
+    tile_size: A positive `int`.
+
+  Returns:
+    A 4-D `Tensor` whose height and width are multiples of `tile_size`.
+  """
+  sh = tf.shape(x)
+  return tf.pad(x, [[0, 0], [0, tf.mod(-sh[1], tile_size)],
+                    [0, tf.mod(-sh[2], tile_size)], [0, 0]])
+
+
+def tile_max(x, tile_size):
+  """Maxima of `x` over the tiles, see `pad_to_tiles`.
+
+  Args:
+    x: A 4-D `Tensor` of shape [batch, height, width, channels] with
+      non-negative values.
+    tile_size: A positive `int`.
+
+  Returns:
+    A 4-D `Tensor` of shape [batch, ceil(height / tile_size),
+    ceil(width / tile_size), channels].
+  """
+  tile = [1, tile_size, tile_size, 1]
+  return tf.nn.max_pool(pad_to_tiles(x, tile_size), tile, tile, 'VALID')
+
+
+def downsample_mask(mask, stride):
+  """Downsamples a mask to the outputs of a unit with stride `stride`.
+
+  An output position is active if any of the `stride x stride` input
+  positions which it subsamples is active. The outputs have the size of a
+  'SAME' convolution with stride `stride`.
+
+  Args:
+    mask: A 4-D `Tensor` of shape [batch, height, width, 1].
+    stride: A positive `int`.
+
+  Returns:
+    A 4-D `Tensor` of shape [batch, ceil(height / stride),
+    ceil(width / stride), 1].
+  """
+  if stride == 1:
+    return mask
+  return tf.nn.max_pool(mask, [1, stride, stride, 1], [1, stride, stride, 1],
+                        'SAME')
+
+
+def downsample_mask_like(mask, like):
+  """Downsamples a mask to the spatial size of `like`, see `downsample_mask`.
+
+  The stride is deduced from the static spatial sizes of `mask` and `like`.
+
+  Raises:
+    ValueError: If the sizes differ and are not known statically.
+  """
+  height = mask.get_shape()[1].value
+  like_height = like.get_shape()[1].value
+  if height is not None and height == like_height:
+    return mask
+  if height is None or like_height is None:
+    raise ValueError('Downsampling a mask requires static spatial sizes.')
+  return downsample_mask(mask, -(-height // like_height))
+
+
+def dense_or_sparse(residual_mask, sparse_threshold, dense_fn, sparse_fn):
+  """Runs a residual branch densely or only at the active positions.
+
+  The sparse version is chosen in the graph when the fraction of active
+  positions in `residual_mask` is at most `sparse_threshold`. Both functions
+  should return the same tuple of `Tensor`s and create the same variables.
+
+  Sparse evaluation is intended for inference: batch normalization in
+  training mode would compute its statistics over the gathered patches.
+
+  Args:
+    residual_mask: A 4-D `float32` mask or None.
+    sparse_threshold: A `float` or None. If None or zero, or if
+      `residual_mask` is None, only `dense_fn` is built.
+    dense_fn: A function building the dense version of the branch.
+    sparse_fn: A function building the sparse version of the branch.
+
+  Returns:
+    The outputs of `dense_fn` or `sparse_fn`.
+  """
+  if residual_mask is None or not sparse_threshold:
+    return dense_fn()
+
+  # Create all the variables and losses outside of tf.cond, like in
+  # act.adaptive_computation_early_stopping. The outputs are not used.
+  dense_fn()
+
+  with tf.variable_scope(tf.get_variable_scope(), reuse=True):
+    active_fraction = tf.reduce_mean(tf.to_float(residual_mask))
+    return tf.cond(active_fraction <= sparse_threshold, sparse_fn, dense_fn)
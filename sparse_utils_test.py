@@ -0,0 +1,97 @@
+# Copyright 2016 Google Inc. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# ==============================================================================
+
+"""Tests for sparse_utils."""
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import numpy as np
+import tensorflow as tf
+
+import sparse_utils
+
+
+class SparseUtilsTest(tf.test.TestCase):
+
+  def testActivePositions(self):
+    mask = np.zeros([2, 3, 4, 1], dtype=np.float32)
+    mask[0, 1, 2, 0] = 1.
+    mask[1, 0, 3, 0] = 1.
+    positions = sparse_utils.active_positions(tf.constant(mask))
+    with self.test_session() as sess:
+      positions_out = sess.run(positions)
+    self.assertAllEqual(positions_out, [[0, 1, 2], [1, 0, 3]])
+
+  def testGatherPatches(self):
+    inputs = np.arange(2 * 4 * 5 * 2, dtype=np.float32).reshape([2, 4, 5, 2])
+    positions = [[0, 0, 0], [1, 2, 3], [1, 3, 4]]
+    patches = sparse_utils.gather_patches(
+        tf.constant(inputs), tf.constant(positions), 3)
+
+    padded = np.pad(inputs, [[0, 0], [1, 1], [1, 1], [0, 0]], 'constant')
+    expected = np.stack(
+        [padded[b, y:y + 3, x:x + 3, :] for (b, y, x) in positions])
+    with self.test_session() as sess:
+      patches_out = sess.run(patches)
+    self.assertAllEqual(patches_out, expected)
+
+  def testScatterPositions(self):
+    like = tf.zeros([2, 3, 4, 5])
+    positions = tf.constant([[0, 1, 2], [1, 0, 3]])
+    updates = tf.constant([[1., 2.], [3., 4.]])
+    outputs = sparse_utils.scatter_positions(updates, positions, like)
+    self.assertEqual(outputs.get_shape().as_list(), [2, 3, 4, 2])
+
+    expected = np.zeros([2, 3, 4, 2])
+    expected[0, 1, 2, :] = [1., 2.]
+    expected[1, 0, 3, :] = [3., 4.]
+    with self.test_session() as sess:
+      outputs_out = sess.run(outputs)
+    self.assertAllEqual(outputs_out, expected)
+
+  def testSumPositions(self):
+    positions = tf.constant([[0, 1, 2], [1, 0, 3], [1, 2, 0]])
+    values = tf.constant([[1., 2.], [3., 4.], [5., 6.]])
+    sums = sparse_utils.sum_positions(values, positions, 3)
+    with self.test_session() as sess:
+      sums_out = sess.run(sums)
+    self.assertAllEqual(sums_out, [[1., 2.], [8., 10.], [0., 0.]])
+
+  def testTileMax(self):
+    x = tf.reshape(tf.range(9, dtype=tf.float32), [1, 3, 3, 1])
+    maxima = sparse_utils.tile_max(x, 2)
+    with self.test_session() as sess:
+      maxima_out = sess.run(maxima)
+    self.assertAllEqual(maxima_out[0, :, :, 0], [[4., 5.], [7., 8.]])
+
+  def testDownsampleMask(self):
+    mask = np.zeros([1, 5, 5, 1], dtype=np.float32)
+    mask[0, 3, 1, 0] = 1.
+    downsampled = sparse_utils.downsample_mask(tf.constant(mask), 2)
+    downsampled_like = sparse_utils.downsample_mask_like(
+        tf.constant(mask), tf.zeros([1, 3, 3, 8]))
+    with self.test_session() as sess:
+      (downsampled_out, downsampled_like_out) = sess.run(
+          (downsampled, downsampled_like))
+    expected = np.zeros([1, 3, 3, 1])
+    expected[0, 1, 0, 0] = 1.
+    self.assertAllEqual(downsampled_out, expected)
+    self.assertAllEqual(downsampled_like_out, expected)
+
+
+if __name__ == '__main__':
+  tf.test.main()
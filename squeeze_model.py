@@ -48,20 +48,30 @@ tf.app.flags.DEFINE_string(
     'model_type', None,
     'Options: vanilla (basic ResNet model), act (Adaptive Computation Time), '
     'act_early_stopping (act implementation which actually saves time), '
-    'sact (Spatially Adaptive Computation Time)')
+    'sact (Spatially Adaptive Computation Time), '
+    'or a comma separated list with the type of every block, e.g. '
+    'vanilla,vanilla,sact,sact for imagenet')
 
 tf.app.flags.DEFINE_string(
     'dataset', None,
     'Options: imagenet, cifar'
 )
 
+tf.app.flags.DEFINE_string(
+    'halting_head', 'conv',
+    'For sact models, the halting head: conv (3x3 convolution of the unit '
+    'outputs), conv1x1, separable (1x1 convolution to a single channel '
+    'followed by a 3x3 convolution) or bottleneck (3x3 convolution of the '
+    'narrow features of the residual branch). Should match the trained '
+    'model.')
+
 
 def main(_):
   if not tf.gfile.Exists(FLAGS.output_dir):
     tf.gfile.MakeDirs(FLAGS.output_dir)
 
   assert FLAGS.model is not None
-  assert FLAGS.model_type in ('vanilla', 'act', 'act_early_stopping', 'sact')
+  assert FLAGS.model_type is not None
   assert FLAGS.dataset in ('imagenet', 'cifar')
 
   batch_size = 1
@@ -83,7 +93,8 @@ def main(_):
           images,
           model,
           num_classes,
-          model_type=FLAGS.model_type)
+          model_type=FLAGS.model_type,
+          halting_head=FLAGS.halting_head)
   elif FLAGS.dataset == 'cifar':
     # Define the model:
     with slim.arg_scope(cifar_model.resnet_arg_scope(is_training=False)):
@@ -91,7 +102,8 @@ def main(_):
           images,
           model=model,
           num_classes=num_classes,
-          model_type=FLAGS.model_type)
+          model_type=FLAGS.model_type,
+          halting_head=FLAGS.halting_head)
 
   tf_global_step = slim.get_or_create_global_step()
 
@@ -52,10 +52,13 @@ def moments_metric_map(x, name, mean_metric, delimiter='_', do_shift=False):
 
 
 def act_metric_map(end_points, mean_metric):
-  """Assembles ACT-specific metrics into a map for use in tf.contrib.metrics."""
+  """Assembles ACT-specific metrics into a map for use in tf.contrib.metrics.
+
+  Only the adaptive blocks have ACT-specific metrics.
+  """
   metric_map = {}
 
-  for block_scope in end_points['block_scopes']:
+  for block_scope in end_points['act_block_scopes']:
     name = '{}/ponder_cost'.format(block_scope)
     ponder_cost = end_points[name]
     ponder_map = moments_metric_map(ponder_cost, name, mean_metric)
@@ -76,19 +79,59 @@ def act_metric_map(end_points, mean_metric):
 
 
 def flops_metric_map(end_points, mean_metric, total_name='Total Flops'):
-  """Assembles flops-count metrics into a map for use in tf.contrib.metrics."""
+  """Assembles flops-count metrics into a map for use in tf.contrib.metrics.
+
+  For the blocks with tile-granular halting, the flops rounded up to whole
+  tiles are also reported, along with the total tile-rounded flops. The
+  realized flops of the blocks, see `resnet_act.stack_blocks`, and the total
+  realized flops are reported as well.
+  """
   metric_map = {}
   total_flops = tf.to_float(end_points['flops'])
   flops_map = moments_metric_map(total_flops, total_name, mean_metric,
       delimiter='/', do_shift=True)
   metric_map.update(flops_map)
 
+  total_tile_flops = total_flops
+  has_tile_flops = False
+  total_realized_flops = total_flops
+  has_realized_flops = False
   for block_scope in end_points['block_scopes']:
     name = '{}/flops'.format(block_scope)
     flops = tf.to_float(end_points[name])
     flops_map = moments_metric_map(flops, name, mean_metric, do_shift=True)
     metric_map.update(flops_map)
 
+    name = '{}/tile_flops'.format(block_scope)
+    if name in end_points:
+      tile_flops = tf.to_float(end_points[name])
+      flops_map = moments_metric_map(tile_flops, name, mean_metric,
+                                     do_shift=True)
+      metric_map.update(flops_map)
+      total_tile_flops += tile_flops - flops
+      has_tile_flops = True
+
+    name = '{}/realized_flops'.format(block_scope)
+    if name in end_points:
+      realized_flops = tf.to_float(end_points[name])
+      flops_map = moments_metric_map(realized_flops, name, mean_metric,
+                                     do_shift=True)
+      metric_map.update(flops_map)
+      total_realized_flops += realized_flops - flops
+      has_realized_flops = True
+
+  if has_tile_flops:
+    flops_map = moments_metric_map(total_tile_flops,
+                                   '{} Rounded to Tiles'.format(total_name),
+                                   mean_metric, delimiter='/', do_shift=True)
+    metric_map.update(flops_map)
+
+  if has_realized_flops:
+    flops_map = moments_metric_map(total_realized_flops,
+                                   '{} Realized'.format(total_name),
+                                   mean_metric, delimiter='/', do_shift=True)
+    metric_map.update(flops_map)
+
   return metric_map
 
 
@@ -114,12 +157,17 @@ def sact_image_heatmap(end_points,
 
   resolution = tf.shape(images)[1:3]
 
-  max_value = sum(end_points['block_num_units'])
+  # Only the SACT blocks have ponder cost maps.
+  block_num_units = dict(
+      zip(end_points['block_scopes'], end_points['block_num_units']))
+  sact_block_num_units = [
+      block_num_units[scope] for scope in end_points['sact_block_scopes']]
+  max_value = sum(sact_block_num_units)
   if metric_name == 'ponder_cost':
-    max_value += len(end_points['block_num_units'])
+    max_value += len(sact_block_num_units)
 
   heatmaps = []
-  for scope in end_points['block_scopes']:
+  for scope in end_points['sact_block_scopes']:
     h = end_points['{}/{}'.format(scope, metric_name)]
     h = tf.to_float(h)
     h = h[:num_images, :, :]
@@ -172,7 +220,7 @@ def sact_map(end_points, metric_name):
   resolution = sh[1:3]
 
   heatmaps = []
-  for scope in end_points['block_scopes']:
+  for scope in end_points['sact_block_scopes']:
     h = end_points['{}/{}'.format(scope, metric_name)]
     h = tf.to_float(h)
     h = tf.expand_dims(h, 3)
@@ -186,17 +234,35 @@ def sact_map(end_points, metric_name):
 
 def export_to_h5(checkpoint_dir, export_path, images, end_points, num_samples,
                  batch_size, sact):
-  """Exports ponder cost maps and other useful info to an HDF5 file."""
+  """Exports ponder cost maps and other useful info to an HDF5 file.
+
+  The model should be built with `return_halting_distribution=True`, see
+  `resnet_act.stack_blocks`. If it is also built with
+  `return_unit_data=True`, the halting probabilities and the FLOPs of the
+  units, which are needed by `act_numpy`, are exported as well. The values of
+  `eps` and the model types of the blocks are stored in the `eps` and
+  `model_types` attributes.
+  """
   output_file = h5py.File(export_path, 'w')
 
-  output_file.attrs['block_scopes'] = end_points['block_scopes']
+  # Only the adaptive blocks have halting distributions.
+  output_file.attrs['block_scopes'] = end_points['act_block_scopes']
+  block_model_types = dict(zip(end_points['block_scopes'],
+                               end_points['block_model_types']))
+  output_file.attrs['model_types'] = [
+      block_model_types[block_scope]
+      for block_scope in end_points['act_block_scopes']]
   keys_to_tensors = {}
-  for block_scope in end_points['block_scopes']:
+  for block_scope in end_points['act_block_scopes']:
     for k in ('{}/ponder_cost'.format(block_scope),
               '{}/num_units'.format(block_scope),
               '{}/halting_distribution'.format(block_scope),
               '{}/flops'.format(block_scope)):
       keys_to_tensors[k] = end_points[k]
+    for k in ('{}/halting_proba'.format(block_scope),
+              '{}/unit_flops'.format(block_scope)):
+      if k in end_points:
+        keys_to_tensors[k] = end_points[k]
   keys_to_tensors['images'] = images
   keys_to_tensors['flops'] = end_points['flops']
 
@@ -209,8 +275,9 @@ def export_to_h5(checkpoint_dir, export_path, images, end_points, num_samples,
     sh = tensor.get_shape().as_list()
     sh[0] = num_samples
     print(key, sh)
+    # The FLOPs are stored as integers, float32 would round them.
     keys_to_datasets[key] = output_file.create_dataset(
-        key, sh, compression='lzf')
+        key, sh, dtype=tensor.dtype.as_numpy_dtype, compression='lzf')
 
   variables_to_restore = slim.get_model_variables()
   checkpoint_path = tf.train.latest_checkpoint(checkpoint_dir)
@@ -233,6 +300,10 @@ def export_to_h5(checkpoint_dir, export_path, images, end_points, num_samples,
     init_fn(sess)
     sv.start_queue_runners(sess)
 
+    output_file.attrs['eps'] = sess.run(
+        [end_points['{}/eps'.format(block_scope)]
+         for block_scope in end_points['act_block_scopes']])
+
     for i in range(num_batches):
       tf.logging.info('Evaluating batch %d/%d', i + 1, num_batches)
       end_points_out = sess.run(keys_to_tensors)
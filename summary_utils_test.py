@@ -38,6 +38,7 @@ class SummaryUtilsTest(tf.test.TestCase):
         'inputs': tf.ones([batch, height, width, channels]),
         'block_num_units': [10],
         'block_scopes': ['block_1'],
+        'sact_block_scopes': ['block_1'],
         'block_1/ponder_cost': 5 * tf.ones([batch, height / 2, width / 2]),
     }
 
@@ -19,17 +19,112 @@ from __future__ import absolute_import
 from __future__ import division
 from __future__ import print_function
 
+import math
+
 import tensorflow as tf
 
 
 def add_all_ponder_costs(end_points, weights):
   total_ponder_cost = 0.
-  for scope in end_points['block_scopes']:
+  for scope in end_points['act_block_scopes']:
     ponder_cost = end_points['{}/ponder_cost'.format(scope)]
     total_ponder_cost += tf.reduce_mean(ponder_cost)
   tf.losses.add_loss(total_ponder_cost * weights)
 
 
+def add_all_flops_weighted_ponder_costs(end_points, weights, normalize=True):
+  """Adds the ponder costs of the blocks weighted by the FLOPs of their units.
+
+  A unit of a deep block with many channels costs more than a unit of a
+  shallow block, so the plain sum of `add_all_ponder_costs` does not reflect
+  the actual computation. Here the mean ponder cost of every adaptive block
+  is weighted by the FLOPs of one of its units, estimated from the
+  flopsometer as the mean FLOPs of the block divided by the mean number of
+  units. The weights are treated as constants.
+
+  Args:
+    end_points: The end points of `resnet_act.stack_blocks`.
+    weights: The weight of the total ponder cost (tau).
+    normalize: If True, the unit FLOPs are divided by their mean over the
+      adaptive blocks, so the weights average to one and `weights` keeps the
+      scale of `add_all_ponder_costs`. Otherwise the ponder costs are
+      weighted by the unit FLOPs in GFLOPs.
+  """
+  ponder_costs = []
+  unit_flops = []
+  for scope in end_points['act_block_scopes']:
+    ponder_cost = end_points['{}/ponder_cost'.format(scope)]
+    ponder_costs.append(tf.reduce_mean(ponder_cost))
+    num_units = tf.to_float(end_points['{}/num_units'.format(scope)])
+    flops = tf.to_float(end_points['{}/flops'.format(scope)])
+    unit_flops.append(
+        tf.reduce_mean(flops) / tf.maximum(tf.reduce_mean(num_units), 1.))
+  unit_flops = tf.stop_gradient(tf.stack(unit_flops))
+  if normalize:
+    unit_flops /= tf.reduce_mean(unit_flops)
+  else:
+    unit_flops *= 1e-9
+  total_ponder_cost = tf.reduce_sum(unit_flops * tf.stack(ponder_costs))
+  tf.losses.add_loss(total_ponder_cost * weights)
+
+
+def adaptive_tau(end_points, initial_tau, target_flops=0.,
+                 target_ponder_cost=0., rate=0.01):
+  """Creates a tau which is adapted during training to reach a budget.
+
+  The logarithm of tau is stored in a non-trainable variable, so it is saved
+  in the checkpoints. At every training step it is increased by `rate` times
+  the relative excess of the measured cost of the batch over the target (an
+  integral controller, or a dual ascent step on the Lagrange multiplier of
+  the budget constraint). Tau grows while the model is above the budget and
+  shrinks below it. The update op is added to the `UPDATE_OPS` collection,
+  so it is run by `slim.learning.create_train_op`.
+
+  Args:
+    end_points: The end points of `resnet_act.stack_blocks`.
+    initial_tau: The initial value of tau, positive.
+    target_flops: The target mean FLOPs per image, measured by
+      `end_points['flops']`.
+    target_ponder_cost: The target mean total ponder cost of the adaptive
+      blocks. Exactly one of the targets should be positive.
+    rate: The step size of the updates of the logarithm of tau.
+
+  Returns:
+    tau: A scalar `float32` `Tensor`.
+
+  Raises:
+    ValueError: If not exactly one of the targets is positive, or if
+      `initial_tau` is not positive.
+  """
+  if (target_flops > 0) == (target_ponder_cost > 0):
+    raise ValueError('Exactly one of target_flops and target_ponder_cost '
+                     'should be positive.')
+  if initial_tau <= 0:
+    # The logarithm of tau is adapted, so tau cannot start at zero.
+    raise ValueError('initial_tau should be positive, got {}.'.format(
+        initial_tau))
+  if target_flops > 0:
+    cost = tf.reduce_mean(tf.to_float(end_points['flops']))
+    target = target_flops
+  else:
+    cost = tf.add_n([
+        tf.reduce_mean(end_points['{}/ponder_cost'.format(scope)])
+        for scope in end_points['act_block_scopes']])
+    target = target_ponder_cost
+
+  with tf.variable_scope('tau_controller'):
+    log_tau = tf.get_variable(
+        'log_tau', [],
+        initializer=tf.constant_initializer(math.log(initial_tau)),
+        trainable=False)
+  # The relative excess is clipped to limit the steps for bad initial
+  # values of tau.
+  excess = tf.clip_by_value(tf.stop_gradient(cost) / target - 1., -1., 1.)
+  tf.add_to_collection(tf.GraphKeys.UPDATE_OPS,
+                       tf.assign_add(log_tau, rate * excess))
+  return tf.exp(log_tau)
+
+
 def variables_to_str(variables):
   return ', '.join([var.op.name for var in variables])
 
@@ -19,6 +19,76 @@ from __future__ import absolute_import
 from __future__ import division
 from __future__ import print_function
 
+from distutils.version import LooseVersion
+
+import tensorflow as tf
+
+# The oldest TensorFlow version with all the `tf.data` features used by
+# `tf_data_batches`.
+TF_DATA_MIN_VERSION = '1.12'
+
 
 def split_and_int(s):
   return [int(x) for x in s.split('_')]
+
+
+def split_and_float(s):
+  return [float(x) for x in s.split('_')]
+
+
+def tf_version_at_least(min_version):
+  """Whether the installed TensorFlow version is at least `min_version`."""
+  return LooseVersion(tf.__version__) >= LooseVersion(min_version)
+
+
+def check_tf_version(min_version, feature):
+  """Raises a ValueError if TensorFlow is older than `min_version`.
+
+  Args:
+    min_version: The oldest supported version, e.g. '1.12'.
+    feature: A description of the feature which needs this version.
+
+  Raises:
+    ValueError: If the installed TensorFlow version is older.
+  """
+  if not tf_version_at_least(min_version):
+    raise ValueError('{} requires TensorFlow {} or newer, found {}.'.format(
+        feature, min_version, tf.__version__))
+
+
+def tf_data_batches(dataset, decode_fn, batch_size, shuffle, num_readers=4,
+                    shuffle_buffer_size=10000):
+  """Reads batches of a TF-Slim dataset with a `tf.data` input pipeline.
+
+  The record files are read in parallel by an interleave, the records are
+  decoded and preprocessed by a parallel map and the batches are prefetched.
+  The numbers of parallel calls and of prefetched batches are autotuned. The
+  dataset is repeated indefinitely, like with `DatasetDataProvider`.
+
+  Args:
+    dataset: A `slim.dataset.Dataset` of TFRecord files.
+    decode_fn: A function which maps a serialized example to a tuple of
+      preprocessed `Tensor`s, e.g. by decoding it with `dataset.decoder`.
+    batch_size: The number of examples in each batch.
+    shuffle: Whether to shuffle the files and the examples.
+    num_readers: The number of files read in parallel.
+    shuffle_buffer_size: The number of examples in the shuffle buffer.
+
+  Returns:
+    A tuple of batched `Tensor`s with the outputs of `decode_fn`.
+
+  Raises:
+    ValueError: If TensorFlow is older than `TF_DATA_MIN_VERSION`.
+  """
+  check_tf_version(TF_DATA_MIN_VERSION, 'The tf.data input pipeline')
+  files = tf.data.Dataset.list_files(dataset.data_sources, shuffle=shuffle)
+  records = files.apply(tf.contrib.data.parallel_interleave(
+      tf.data.TFRecordDataset, cycle_length=num_readers, sloppy=shuffle))
+  if shuffle:
+    records = records.shuffle(shuffle_buffer_size)
+  records = records.repeat()
+  batches = records.map(decode_fn,
+                        num_parallel_calls=tf.contrib.data.AUTOTUNE)
+  batches = batches.batch(batch_size, drop_remainder=True)
+  batches = batches.prefetch(tf.contrib.data.AUTOTUNE)
+  return batches.make_one_shot_iterator().get_next()